@@ -1,9 +1,83 @@
+import gzip
+import json
+import random
+import threading
+import time
+from collections import deque
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+
+CONNECT_TIMEOUT = 3.05  # Établissement TCP (+TLS)
+READ_TIMEOUT = 10.0  # Attente de la réponse une fois la requête envoyée
+DEADLINE = 15.0  # Durée max d'une action, tentatives comprises
+MAX_ATTEMPTS = 3
+BACKOFF_BASE = 0.2  # Secondes, doublé à chaque tentative (jitter complet)
+BACKOFF_MAX = 2.0
+POOL_SIZE = 4  # Connexions keep-alive gardées vers le serveur
+STATS_WINDOW = 200  # Dernières latences gardées par action
+
+# 503: le serveur a annulé sa transaction (ex. collision de code), rien n'a été appliqué
+RETRY_ANY = {503}
+RETRY_IDEMPOTENT = {502, 503, 504}
+
+
+class CallStats:
+    """Latences des derniers appels d'une action (ms)"""
+
+    def __init__(self):
+        self.latencies = deque(maxlen=STATS_WINDOW)
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+
+    def snapshot(self) -> dict:
+        ms = sorted(self.latencies)
+
+        def pct(p):
+            return round(ms[min(len(ms) - 1, int(p / 100 * len(ms)))], 1) if ms else None
+
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "p50_ms": pct(50),
+            "p95_ms": pct(95),
+            "max_ms": round(ms[-1], 1) if ms else None,
+        }
+
+
+def _not_sent(exc: Exception) -> bool:
+    """Vrai si la requête n'a pas pu partir (connexion impossible): rejouable sans risque"""
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(exc.args[0], "reason", None) if exc.args else None
+    return isinstance(exc, requests.exceptions.ConnectionError) and isinstance(reason, NewConnectionError)
 
 
 class ApiClient:
-    def __init__(self, base_url: str):
+    """
+    Client du serveur Smart Locker. Une session requests gardée ouverte
+    (connexions keep-alive réutilisées d'une action à l'autre), timeouts
+    de connexion et de lecture séparés, délai global par action.
+
+    Les actions du kiosque modifient l'état côté serveur: elles ne sont
+    rejouées que si la requête n'a pas pu partir, ou si le serveur a
+    répondu 503 (rien appliqué). Les appels idempotents sont aussi
+    rejoués sur timeout de lecture et 502/504.
+    """
+
+    def __init__(self, base_url: str, deadline: float = DEADLINE):
         self.base_url = base_url.rstrip("/")
+        self.deadline = deadline
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._stats = {}
+        self._stats_lock = threading.Lock()
 
     def open_deposit(self, locker_id: int, tracking_code: str):
         """
@@ -14,6 +88,32 @@ class ApiClient:
         """
         return self._post("/api/deposit/open", {"lockerId": locker_id, "trackingCode": tracking_code})
 
+    def register_deposit(self, locker_id: int, box_id: int, closet_id: int, tracking_code: str, password: str = None):
+        """
+        Enregistre un dépôt commencé sur une box prêtée (lease_boxes):
+        la porte est déjà ouverte. Rejouable, le serveur répond pareil.
+        Le mot de passe du bail permet au serveur de reprendre la box si le
+        bail a expiré entre-temps (202 `flagged` s'il ne peut pas).
+        """
+        return self._post(
+            "/api/deposit/open",
+            {
+                "lockerId": locker_id,
+                "boxId": box_id,
+                "closetId": closet_id,
+                "password": password,
+                "trackingCode": tracking_code,
+            },
+            idempotent=True,
+        )
+
+    def lease_boxes(self, locker_id: int, count: int):
+        """
+        Renouvelle les baux de la machine et en demande jusqu'à `count`.
+        Retour: {ttl, boxes: [{boxId, closetId, password, orderId, size, expiresIn}]}
+        """
+        return self._post("/api/leases", {"lockerId": locker_id, "count": count}, idempotent=True)
+
     def close_deposit(self, locker_id: int, box_id: int, closet_id: int, tracking_code: str):
         """
         Confirme la fermeture après dépôt.
@@ -40,9 +140,69 @@ class ApiClient:
         """
         return self._post("/api/withdraw/close", {"lockerId": locker_id, "boxId": box_id, "closetId": closet_id})
 
-    def _post(self, path: str, body: dict):
-        try:
-            resp = requests.post(f"{self.base_url}{path}", json=body, timeout=5)
-            return resp.json(), resp.status_code
-        except Exception as exc:  # pragma: no cover
-            return {"message": f"Serveur injoignable: {exc}"}, 503
+    def send_telemetry(self, locker_id: int, samples: list):
+        """
+        Envoie un lot de télémétrie, compressé (gzip).
+        samples: [{ts, metrics: {nom: valeur}}]. Rejouable: le serveur
+        remplace les échantillons déjà reçus. 503: réessayer plus tard.
+        """
+        return self._request(
+            "POST", "/api/telemetry", {"machineId": locker_id, "samples": samples}, idempotent=True, compress=True
+        )
+
+    def stats(self) -> dict:
+        """Latences par action: {path: {calls, errors, retries, p50_ms, p95_ms, max_ms}}"""
+        with self._stats_lock:
+            return {path: s.snapshot() for path, s in self._stats.items()}
+
+    def close(self):
+        self.session.close()
+
+    def _post(self, path: str, body: dict, idempotent: bool = False):
+        return self._request("POST", path, body, idempotent)
+
+    def _request(self, method: str, path: str, body: dict = None, idempotent: bool = False, compress: bool = False):
+        """Retourne (json, status). Erreurs réseau: 503 (injoignable) ou 504 (délai dépassé)."""
+        if compress:
+            payload = {
+                "data": gzip.compress(json.dumps(body, separators=(",", ":")).encode("utf-8")),
+                "headers": {"Content-Type": "application/json", "Content-Encoding": "gzip"},
+            }
+        else:
+            payload = {"json": body}
+        start = time.monotonic()
+        deadline = start + self.deadline
+        retry_statuses = RETRY_IDEMPOTENT if idempotent else RETRY_ANY
+        attempt = 0
+        while True:
+            attempt += 1
+            remaining = deadline - time.monotonic()
+            timeout = (min(CONNECT_TIMEOUT, remaining), min(READ_TIMEOUT, remaining))
+            try:
+                resp = self.session.request(method, f"{self.base_url}{path}", timeout=timeout, **payload)
+            except requests.RequestException as exc:
+                retryable = _not_sent(exc) or (idempotent and isinstance(exc, requests.exceptions.Timeout))
+                if isinstance(exc, requests.exceptions.Timeout):
+                    result = {"message": "Le serveur ne répond pas, réessayez"}, 504
+                else:
+                    result = {"message": f"Serveur injoignable: {exc}"}, 503
+            else:
+                try:
+                    result = resp.json(), resp.status_code
+                except ValueError:
+                    result = {"message": f"Réponse invalide du serveur ({resp.status_code})"}, 502
+                retryable = resp.status_code in retry_statuses
+
+            pause = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempt - 1)))
+            if not retryable or attempt >= MAX_ATTEMPTS or time.monotonic() + pause >= deadline:
+                self._record(path, start, attempt, result[1])
+                return result
+            time.sleep(pause)
+
+    def _record(self, path: str, start: float, attempts: int, status: int):
+        with self._stats_lock:
+            stats = self._stats.setdefault(path, CallStats())
+            stats.calls += 1
+            stats.retries += attempts - 1
+            stats.errors += status >= 500
+            stats.latencies.append((time.monotonic() - start) * 1000)
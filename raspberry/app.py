@@ -1,24 +1,135 @@
+import hashlib
 import os
 import time
-from flask import Flask, jsonify, render_template, request
+from flask import Flask, Response, jsonify, make_response, render_template, request
 from serial_controller import SerialController, SerialError
 from api_client import ApiClient
+from journal import Journal
+from leases import LeaseManager
+from doors import DoorWatcher
+from events import EventBroker
+from telemetry import TelemetryAgent
+from assets import StaticAssets
 
 
 SERVER_BASE_URL = os.environ.get("SERVER_BASE_URL", "http://localhost:5000")
 LOCKER_ID = int(os.environ.get("LOCKER_ID", "1"))  # ID de la machine entière
-SERIAL_PORT = os.environ.get("SERIAL_PORT", "/dev/ttyACM0")
+SERIAL_PORT = os.environ.get("SERIAL_PORT", "/dev/ttyACM0")  # "sim": sans Arduino (dev)
 SERIAL_BAUD = int(os.environ.get("SERIAL_BAUD", "115200"))
-
-
-app = Flask(__name__)
-serial_ctrl = SerialController(SERIAL_PORT, SERIAL_BAUD)
+DOOR_POLL_INTERVAL = float(os.environ.get("DOOR_POLL_INTERVAL", "0.25"))  # 0: pas de poller
+DOOR_STATE_MAX_AGE = float(os.environ.get("DOOR_STATE_MAX_AGE", "1.0"))  # Âge max de l'état en cache
+DOOR_DEBOUNCE = float(os.environ.get("DOOR_DEBOUNCE", "0.5"))  # Porte vue fermée pendant ce délai: fermeture
+DOOR_OPEN_ALARM = float(os.environ.get("DOOR_OPEN_ALARM", "60"))  # Alarme si la porte reste ouverte
+JOURNAL_PATH = os.environ.get("JOURNAL_PATH", os.path.join(os.path.dirname(__file__), "journal.db"))
+CLOSE_SYNC_WAIT = float(os.environ.get("CLOSE_SYNC_WAIT", "2.0"))  # Attente max du serveur avant réponse locale
+LEASE_COUNT = int(os.environ.get("LEASE_COUNT", "2"))  # Boxes prêtées par le serveur (0: désactivé)
+TELEMETRY_INTERVAL = float(os.environ.get("TELEMETRY_INTERVAL", "10"))  # Secondes entre deux lots (0: désactivé)
+
+
+app = Flask(__name__, static_folder=None)
+# static/ servi depuis la mémoire sous des noms hachés, précompressés (voir assets.py)
+assets = StaticAssets(os.path.join(os.path.dirname(__file__), "static"))
+app.add_url_rule("/static/<path:filename>", endpoint="static", view_func=assets.serve)
+app.url_defaults(assets.url_defaults)
+serial_ctrl = SerialController(SERIAL_PORT, SERIAL_BAUD, max_age=DOOR_STATE_MAX_AGE)
+if DOOR_POLL_INTERVAL > 0:
+    serial_ctrl.start_poller(DOOR_POLL_INTERVAL)
 api_client = ApiClient(SERVER_BASE_URL)
+# Écran prévenu par push (SSE) des portes ouvertes/fermées et des alarmes
+broker = EventBroker()
+
+
+def _journal_alarm(action: str, payload: dict, response: dict):
+    """Entrée refusée par le serveur ou box signalée: colis peut-être dans une box inconnue du serveur"""
+    broker.publish("rejected", {
+        "action": action,
+        "boxId": payload.get("boxId"),
+        "message": response.get("message", ""),
+    })
+
+
+# Confirmations de fermeture, rejouées vers le serveur (survit aux redémarrages)
+journal = Journal(JOURNAL_PATH, api_client, on_alarm=_journal_alarm)
+journal.start()
+# Boxes prêtées: un dépôt ouvre la porte sans attendre le serveur
+leases = LeaseManager(api_client, LOCKER_ID, LEASE_COUNT)
+if LEASE_COUNT > 0:
+    leases.start()
+
+
+def _door_closed(box_id: int, context: dict):
+    """Porte refermée (détectée par le watcher): confirmer comme le bouton Confirmer"""
+    if context["action"] == "deposit":
+        body, status = _confirm_deposit_close(box_id, context["closetId"], context["trackingCode"])
+    else:
+        body, status = _confirm_withdraw_close(box_id, context["closetId"])
+    broker.publish("closed", dict(body, boxId=box_id, action=context["action"], status=status))
+
+
+# Fermeture détectée sur le capteur, sans attendre le bouton
+doors = DoorWatcher(serial_ctrl, _door_closed, broker.publish, DOOR_DEBOUNCE, DOOR_OPEN_ALARM)
+doors.start()
+
+
+def _telemetry() -> dict:
+    """Mesures envoyées au serveur; les compteurs `_total` sont cumulés (voir TelemetryAgent)"""
+    serial_stats = serial_ctrl.stats()
+    metrics = {
+        "serial.ready": serial_ctrl.state == "ready",
+        "serial.commands_total": serial_stats["commands"],
+        "serial.timeouts_total": serial_stats["timeouts"],
+        "serial.errors_total": serial_stats["errors"],
+        "serial.reconnects_total": serial_stats["reconnects"],
+        "serial.rtt_p50_ms": serial_stats["rtt_p50_ms"],
+        "serial.rtt_p95_ms": serial_stats["rtt_p95_ms"],
+        "journal.pending": journal.pending_count(),
+        "journal.alarms_total": journal.alarms,
+        "leases.available": leases.available(),
+        "doors.watched": len(doors.watched()),
+    }
+    if serial_ctrl.state == "ready":
+        try:
+            boxes = serial_ctrl.door_states(max_age=TELEMETRY_INTERVAL)["boxes"]
+            metrics["doors.open"] = sum(not b["closed"] for b in boxes)
+            metrics["doors.closed_mask"] = sum(1 << (b["boxId"] - 1) for b in boxes if b["closed"])
+        except SerialError:
+            pass
+    for path, s in api_client.stats().items():
+        name = "api." + path.replace("/api/", "", 1).strip("/").replace("/", "_")
+        metrics[f"{name}.calls_total"] = s["calls"]
+        metrics[f"{name}.errors_total"] = s["errors"]
+        metrics[f"{name}.retries_total"] = s["retries"]
+        metrics[f"{name}.p95_ms"] = s["p95_ms"]
+    return metrics
+
+
+# Télémétrie vers le serveur: un lot compressé par intervalle
+telemetry = TelemetryAgent(api_client, LOCKER_ID, _telemetry, TELEMETRY_INTERVAL)
+if TELEMETRY_INTERVAL > 0:
+    telemetry.start()
+
+
+def _revalidated(body, mimetype: str):
+    """Réponse revalidée à chaque chargement (ETag -> 304), jamais servie périmée"""
+    response = make_response(body)
+    response.mimetype = mimetype
+    response.headers["Cache-Control"] = "no-cache"
+    response.add_etag()
+    return response.make_conditional(request)
 
 
 @app.route("/")
 def home():
-    return render_template("index.html")
+    return _revalidated(render_template("index.html"), "text/html")
+
+
+@app.route("/sw.js", methods=["GET"])
+def service_worker():
+    """Service worker de l'écran, à la racine pour couvrir tout le site. Sa version suit la page et static/."""
+    shell = render_template("index.html")
+    version = hashlib.sha256("\n".join([shell, *assets.urls()]).encode("utf-8")).hexdigest()[:12]
+    script = render_template("sw.js", version=version, shell=["/", *assets.urls()])
+    return _revalidated(script, "text/javascript")
 
 
 @app.route("/api/ping", methods=["GET"])
@@ -26,6 +137,47 @@ def ping():
     return jsonify({"status": "ok"})
 
 
+@app.route("/api/health", methods=["GET"])
+def health():
+    """200 si l'Arduino est branché et a répondu au PING, 503 sinon (simulation comprise)"""
+    serial_status = serial_ctrl.status()
+    ok = serial_status["state"] == "ready"
+    return jsonify({"ok": ok, "serial": serial_status, "journalPending": journal.pending_count()}), 200 if ok else 503
+
+
+@app.route("/api/stats", methods=["GET"])
+def stats():
+    """Latences des appels au serveur par action, confirmations en attente"""
+    return jsonify({
+        "server": api_client.stats(),
+        "journalPending": journal.pending_count(),
+        "leasesAvailable": leases.available(),
+        "doorsWatched": doors.watched(),
+        "telemetryPending": telemetry.pending(),
+    })
+
+
+@app.route("/api/events", methods=["GET"])
+def kiosk_events():
+    """Événements des portes poussés à l'écran (SSE). Réservé au navigateur local: ils portent le mot de passe."""
+    if request.remote_addr not in ("127.0.0.1", "::1"):
+        return jsonify({"message": "Réservé à l'écran du kiosque"}), 403
+    return Response(
+        broker.stream(broker.subscribe()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@app.route("/api/boxes/state", methods=["GET"])
+def boxes_state():
+    """État des portes (capteurs), depuis le cache du poller s'il est assez récent"""
+    try:
+        return jsonify(serial_ctrl.door_states())
+    except SerialError as exc:
+        return jsonify({"message": f"Erreur série: {exc}"}), 500
+
+
 def _validate_box(box_id: int):
     """Valider l'ID de la box (compartiment) - 1 à 15"""
     if box_id == 16:
@@ -39,7 +191,8 @@ def _validate_box(box_id: int):
 def deposit_open():
     """
     Dépôt: Le client envoie seulement le code de suivi.
-    Le serveur décide quelle box utiliser et retourne boxId.
+    Le serveur décide quelle box utiliser et retourne boxId, ou la box
+    vient d'un bail déjà accordé par le serveur (pas d'aller-retour).
     """
     data = request.get_json(force=True)
     tracking_code = data.get("trackingCode")
@@ -47,6 +200,10 @@ def deposit_open():
     if not tracking_code:
         return jsonify({"message": "Code de suivi requis"}), 400
 
+    lease = leases.take()
+    if lease is not None and _validate_box(lease["boxId"])[0]:
+        return _deposit_open_leased(lease, tracking_code)
+
     # Appeler le serveur avec l'ID du locker (machine)
     server_resp, status_code = api_client.open_deposit(LOCKER_ID, tracking_code)
     if status_code != 200:
@@ -62,15 +219,56 @@ def deposit_open():
         msg, code = error
         return jsonify({"message": msg}), code
 
+    # Mot de passe réservé par le serveur: gardé sur disque, affiché seulement à la fermeture
+    password = server_resp.pop("password", None)
+    if password:
+        journal.reserve_code(box_id, server_resp.get("closetId"), password)
+
     # Ouvrir la box physique via Arduino
     try:
         serial_ctrl.open_locker(box_id)
     except SerialError as exc:
         return jsonify({"message": f"Erreur série: {exc}"}), 500
+    doors.watch(box_id, {"action": "deposit", "closetId": server_resp.get("closetId"), "trackingCode": tracking_code})
 
     return jsonify(server_resp)
 
 
+def _deposit_open_leased(lease: dict, tracking_code: str):
+    """
+    Dépôt sur une box prêtée: journalisé avant d'ouvrir (entrée retenue),
+    envoyé au serveur en arrière-plan une fois la porte ouverte. Si la
+    porte ne s'ouvre pas, l'entrée et le code sont effacés et le bail
+    rendu.
+    """
+    box_id, closet_id = lease["boxId"], lease["closetId"]
+    journal.reserve_code(box_id, closet_id, lease["password"])
+    entry_id = journal.record("deposit_open", {
+        "lockerId": LOCKER_ID,
+        "boxId": box_id,
+        "closetId": closet_id,
+        "password": lease["password"],  # Bail expiré entre-temps: le serveur reprend la box avec ces codes
+        "trackingCode": tracking_code,
+    }, held=True)
+
+    try:
+        serial_ctrl.open_locker(box_id)
+    except SerialError as exc:
+        journal.cancel(entry_id)
+        leases.give_back(lease)
+        return jsonify({"message": f"Erreur série: {exc}"}), 500
+    journal.commit(entry_id)
+    doors.watch(box_id, {"action": "deposit", "closetId": closet_id, "trackingCode": tracking_code})
+
+    return jsonify({
+        "boxId": box_id,
+        "closetId": closet_id,
+        "orderId": lease["orderId"],
+        "size": lease["size"],
+        "message": f"Box {box_id} assignée, déposez votre colis",
+    })
+
+
 @app.route("/api/deposit/close", methods=["POST"])
 def deposit_close():
     """
@@ -90,12 +288,41 @@ def deposit_close():
         return jsonify({"message": "closetId et trackingCode requis"}), 400
 
     # Vérifier que la box est fermée
-    if not serial_ctrl.verify_closed(box_id):
+    try:
+        closed = serial_ctrl.verify_closed(box_id)
+    except SerialError as exc:
+        return jsonify({"message": f"Erreur série: {exc}"}), 503
+    if not closed:
         return jsonify({"message": "La box est encore ouverte"}), 409
 
-    # Confirmer au serveur
-    server_resp, status_code = api_client.close_deposit(LOCKER_ID, box_id, closet_id, tracking_code)
-    return jsonify(server_resp), status_code
+    body, status_code = _confirm_deposit_close(box_id, closet_id, tracking_code)
+    doors.cancel(box_id)
+    return jsonify(body), status_code
+
+
+def _confirm_deposit_close(box_id: int, closet_id: int, tracking_code: str):
+    """Porte fermée: journaliser la confirmation, attendre brièvement le serveur. Retourne (réponse, statut)."""
+    password = journal.reserved_code(box_id, closet_id)
+    entry_id = journal.record("deposit_close", {
+        "lockerId": LOCKER_ID,
+        "boxId": box_id,
+        "closetId": closet_id,
+        "trackingCode": tracking_code,
+        "password": password,
+    })
+    result = journal.wait(entry_id, CLOSE_SYNC_WAIT)
+    if result is not None:
+        return result
+
+    # Serveur lent ou injoignable: confirmation envoyée plus tard, le code
+    # affiché est celui réservé par le serveur à l'ouverture
+    return {
+        "boxId": box_id,
+        "closetId": closet_id,
+        "password": password,
+        "pending": True,
+        "message": "Dépôt enregistré" if password else "Dépôt enregistré, code envoyé à la synchronisation",
+    }, 202
 
 
 @app.route("/api/withdraw/open", methods=["POST"])
@@ -112,6 +339,9 @@ def withdraw_open():
 
     # Appeler le serveur avec l'ID du locker (machine) et le mot de passe
     server_resp, status_code = api_client.open_withdraw(LOCKER_ID, password)
+    if status_code == 409 and journal.pending_password(password):
+        # Fermeture du dépôt pas encore confirmée au serveur
+        return jsonify({"message": "Dépôt en cours de synchronisation, réessayez dans un instant"}), 503
     if status_code != 200:
         return jsonify(server_resp), status_code
 
@@ -130,6 +360,7 @@ def withdraw_open():
         serial_ctrl.open_locker(box_id)
     except SerialError as exc:
         return jsonify({"message": f"Erreur série: {exc}"}), 500
+    doors.watch(box_id, {"action": "withdraw", "closetId": server_resp.get("closetId")})
 
     return jsonify(server_resp)
 
@@ -152,13 +383,33 @@ def withdraw_close():
         return jsonify({"message": "closetId requis"}), 400
 
     # Vérifier que la box est fermée
-    if not serial_ctrl.verify_closed(box_id):
+    try:
+        closed = serial_ctrl.verify_closed(box_id)
+    except SerialError as exc:
+        return jsonify({"message": f"Erreur série: {exc}"}), 503
+    if not closed:
         return jsonify({"message": "La box est encore ouverte"}), 409
 
-    # Confirmer au serveur
-    server_resp, status_code = api_client.close_withdraw(LOCKER_ID, box_id, closet_id)
-    return jsonify(server_resp), status_code
+    body, status_code = _confirm_withdraw_close(box_id, closet_id)
+    doors.cancel(box_id)
+    return jsonify(body), status_code
+
+
+def _confirm_withdraw_close(box_id: int, closet_id: int):
+    """Confirmer au serveur via le journal (voir _confirm_deposit_close)"""
+    entry_id = journal.record("withdraw_close", {"lockerId": LOCKER_ID, "boxId": box_id, "closetId": closet_id})
+    result = journal.wait(entry_id, CLOSE_SYNC_WAIT)
+    if result is not None:
+        return result
+
+    return {
+        "boxId": box_id,
+        "closetId": closet_id,
+        "pending": True,
+        "message": "Retrait enregistré",
+    }, 202
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8000, debug=True)
+    # Pas de rechargeur: le port série et le thread du journal n'existent que dans un processus
+    app.run(host="0.0.0.0", port=8000, debug=True, use_reloader=False)
@@ -0,0 +1,114 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+
+from flask import Response, abort, request
+
+try:
+    import brotli  # Optionnel: pip install brotli (sinon gzip seulement)
+except ImportError:
+    brotli = None
+
+
+LOG = logging.getLogger(__name__)
+
+HASH_LENGTH = 12  # Caractères de l'empreinte sha256 dans le nom (app.3f2a9c1b0d4e.js)
+IMMUTABLE = "public, max-age=31536000, immutable"  # Nom haché: le contenu ne change jamais
+REVALIDATE = "no-cache"  # Nom sans empreinte: revalidé (304) à chaque chargement
+COMPRESSIBLE = {".css", ".js", ".html", ".json", ".svg", ".txt"}
+GZIP_LEVEL = 9  # Compressé une fois au démarrage: le niveau max ne coûte rien ensuite
+BROTLI_QUALITY = 11
+
+
+class _Asset:
+    __slots__ = ("name", "hashed", "digest", "mimetype", "variants")
+
+    def __init__(self, name: str, data: bytes):
+        self.name = name
+        self.digest = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+        stem, ext = os.path.splitext(name)
+        self.hashed = f"{stem}.{self.digest}{ext}"
+        self.mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        # Encodage -> contenu; une variante n'est gardée que si elle est plus petite
+        self.variants = {"identity": data}
+        if ext in COMPRESSIBLE:
+            candidates = {"gzip": gzip.compress(data, GZIP_LEVEL, mtime=0)}
+            if brotli is not None:
+                candidates["br"] = brotli.compress(data, quality=BROTLI_QUALITY)
+            for encoding, body in candidates.items():
+                if len(body) < len(data):
+                    self.variants[encoding] = body
+
+
+class StaticAssets:
+    """
+    Fichiers de static/ lus une fois au démarrage et servis depuis la
+    mémoire. `url_for('static', filename='app.js')` donne le nom haché
+    (/static/app.3f2a9c1b0d4e.js), mis en cache un an sans revalidation:
+    un fichier modifié change d'URL. Les variantes gzip (et brotli si le
+    module est installé) sont calculées au démarrage et choisies selon
+    Accept-Encoding. Un fichier modifié n'est vu qu'au redémarrage.
+    """
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        self._assets = {}  # Nom logique -> _Asset
+        self._hashed = {}  # Nom haché -> _Asset
+        self.load()
+
+    def load(self):
+        assets = {}
+        for root, dirs, files in os.walk(self.folder):
+            dirs[:] = [d for d in dirs if not d.startswith((".", "__"))]
+            for filename in files:
+                if filename.startswith("."):
+                    continue
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, self.folder).replace(os.sep, "/")
+                with open(path, "rb") as f:
+                    assets[name] = _Asset(name, f.read())
+        self._assets = assets
+        self._hashed = {asset.hashed: asset for asset in assets.values()}
+        LOG.info(
+            "Loaded %d static assets (%s)", len(assets),
+            "gzip+br" if brotli is not None else "gzip",
+        )
+
+    def hashed_name(self, filename: str) -> str:
+        asset = self._assets.get(filename)
+        return asset.hashed if asset else filename
+
+    def urls(self) -> list:
+        """URLs hachées de tous les fichiers (précache du service worker)"""
+        return sorted(f"/static/{asset.hashed}" for asset in self._assets.values())
+
+    def url_defaults(self, endpoint: str, values: dict):
+        """Hook Flask.url_defaults: url_for('static', ...) -> nom haché"""
+        if endpoint == "static" and "filename" in values:
+            values["filename"] = self.hashed_name(values["filename"])
+
+    def serve(self, filename: str):
+        """Vue de /static/<filename>: nom haché (immuable) ou nom logique (revalidé)"""
+        asset = self._hashed.get(filename)
+        cache_control = IMMUTABLE
+        if asset is None:
+            asset = self._assets.get(filename)
+            cache_control = REVALIDATE
+        if asset is None:
+            abort(404)
+
+        encoding = "identity"
+        for candidate in ("br", "gzip"):
+            if candidate in asset.variants and request.accept_encodings[candidate]:
+                encoding = candidate
+                break
+        response = Response(asset.variants[encoding], mimetype=asset.mimetype)
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+        if len(asset.variants) > 1:
+            response.vary.add("Accept-Encoding")
+        response.headers["Cache-Control"] = cache_control
+        response.set_etag(f"{asset.digest}-{encoding}")
+        return response.make_conditional(request)
@@ -0,0 +1,164 @@
+"""
+Benchmark et test d'endurance du chemin série du kiosque, sans matériel.
+
+    python bench_serial.py --callers 1,4,16 --duration 10
+    python bench_serial.py --callers 8 --duration 300 --drop 0.01 --garble 0.005 --unplug-every 60
+
+Pour chaque nombre d'appelants, un Arduino virtuel (virtual_arduino.py)
+est lancé sur un pty et piloté par SerialController, comme dans app.py.
+Les appelants lisent des capteurs (READ, READALL) dont l'état est connu:
+chaque réponse est classée juste, fausse, absente (timeout) ou en erreur
+(SerialError: port perdu, resynchronisation...). Avec --unplug-every, le
+rapport dit aussi si le contrôleur s'est reconnecté tout seul.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import serial_controller
+from serial_controller import SerialController, SerialError
+from virtual_arduino import BOX_COUNT, VirtualArduino
+
+READY_TIMEOUT = 15.0
+
+
+def percentile(values, p):
+    return round(values[min(len(values) - 1, int(p / 100 * len(values)))], 2) if values else None
+
+
+def run(callers: int, args) -> dict:
+    link = os.path.join(tempfile.mkdtemp(prefix="virtual-arduino-"), "tty")
+    device = VirtualArduino(
+        link=link, latency=args.latency, jitter=args.jitter, boot=args.boot,
+        drop=args.drop, garble=args.garble, split=args.split, hang=args.hang, seed=args.seed,
+    )
+    # Une porte sur trois ouverte: chaque lecture a une réponse attendue
+    for box in range(1, BOX_COUNT + 1):
+        device.doors_open[box] = box % 3 == 0
+    expected = {f"READ:{box}": "OPEN" if box % 3 == 0 else "CLOSED" for box in range(1, BOX_COUNT + 1)}
+    expected["READALL"] = "STATE:%04X" % sum(1 << (box - 1) for box in range(1, BOX_COUNT + 1) if box % 3)
+    ctrl = SerialController(device.start(), timeout=args.timeout, max_age=0)
+    deadline = time.monotonic() + READY_TIMEOUT
+    while ctrl.state != "ready":
+        if time.monotonic() > deadline:
+            raise SystemExit(f"Arduino virtuel pas prêt: {ctrl.status()}")
+        time.sleep(0.01)
+
+    stop = threading.Event()
+    if args.unplug_every:
+        def unplugger():
+            while not stop.wait(args.unplug_every):
+                device.unplug()
+        threading.Thread(target=unplugger, daemon=True).start()
+
+    lock = threading.Lock()
+    latencies, counts, errors = [], {"wrong": 0, "timeouts": 0}, {}
+    end = time.monotonic() + args.duration
+
+    def caller(seed):
+        rnd = random.Random(seed)
+        while time.monotonic() < end:
+            command = "READALL" if rnd.random() < args.readall_ratio else f"READ:{rnd.randint(1, BOX_COUNT)}"
+            start = time.perf_counter()
+            try:
+                response = ctrl.submit(command).result()
+            except SerialError as exc:
+                kind = str(exc).split(" (")[0].split(",")[0].split(":")[0]
+                with lock:
+                    errors[kind] = errors.get(kind, 0) + 1
+                time.sleep(0.05)
+                continue
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                if not response:
+                    counts["timeouts"] += 1
+                    continue
+                latencies.append(elapsed)
+                counts["wrong"] += response.upper() != expected[command]
+
+    threads = [threading.Thread(target=caller, args=(i,)) for i in range(callers)]
+    started = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - started
+    stop.set()
+    # L'Arduino doit être de nouveau joignable à la fin (reprise après défauts)
+    deadline = time.monotonic() + READY_TIMEOUT
+    while ctrl.state != "ready" and time.monotonic() < deadline:
+        time.sleep(0.05)
+    recovered = ctrl.state == "ready"
+    ctrl.close()
+    device.stop()
+
+    latencies.sort()
+    return {
+        "callers": callers,
+        "commands": len(latencies),
+        "throughput_cps": round(len(latencies) / elapsed, 1),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "max_ms": round(latencies[-1], 2) if latencies else None,
+        **counts,
+        "errors": errors,
+        "reconnects": ctrl.reconnects,
+        "recovered": recovered,
+        "device": dict(device.stats),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python bench_serial.py", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--callers", default="1,4,16", help="Nombres d'appelants simultanés à comparer")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--readall-ratio", type=float, default=0.1, help="Part des lectures en READALL")
+    parser.add_argument("--timeout", type=float, default=0.5, help="Attente d'une réponse (s)")
+    parser.add_argument("--latency", type=float, default=0.002)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--boot", type=float, default=0.2)
+    parser.add_argument("--drop", type=float, default=0.0)
+    parser.add_argument("--garble", type=float, default=0.0)
+    parser.add_argument("--split", type=float, default=0.0)
+    parser.add_argument("--hang", type=float, default=0.0)
+    parser.add_argument("--unplug-every", type=float)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--out", help="Fichier JSON du rapport (défaut: sortie standard)")
+    args = parser.parse_args(argv)
+    try:
+        counts = [int(n) for n in args.callers.split(",")]
+    except ValueError as exc:
+        parser.error(str(exc))
+    # Backoff de reconnexion court: un débranchement dure 1 s
+    serial_controller.RECONNECT_MAX = 1.0
+
+    runs = []
+    for callers in counts:
+        result = run(callers, args)
+        print(
+            f"callers={callers}: {result['throughput_cps']} cmd/s, p50 {result['p50_ms']} ms, "
+            f"p95 {result['p95_ms']} ms, p99 {result['p99_ms']} ms, wrong {result['wrong']}, timeouts {result['timeouts']}, "
+            f"errors {sum(result['errors'].values())}, reconnects {result['reconnects']}, "
+            f"recovered {result['recovered']}",
+            file=sys.stderr,
+        )
+        runs.append(result)
+
+    report = {"config": {k: v for k, v in vars(args).items() if k != "out"}, "runs": runs}
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0 if all(r["recovered"] for r in runs) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
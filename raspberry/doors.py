@@ -0,0 +1,119 @@
+import logging
+import threading
+import time
+from typing import Callable
+
+
+LOG = logging.getLogger(__name__)
+
+DEBOUNCE = 0.5  # Secondes de porte vue fermée sans interruption avant de confirmer
+OPEN_ALARM = 60.0  # Secondes de porte ouverte avant l'alarme
+WATCH_MAX = 30 * 60  # Une porte jamais ouverte n'est plus surveillée après ce délai
+TICK = 1.0  # Réévaluation des délais si aucun état n'arrive
+
+
+class DoorWatcher:
+    """
+    Surveille les boxes ouvertes par un dépôt ou un retrait, à partir des
+    états publiés par le poller (SerialController.add_state_listener).
+
+    Par box: armed (porte pas encore vue ouverte) -> open -> closing
+    (vue fermée, anti-rebond) -> fermeture confirmée: on_closed(box_id,
+    context) est appelé une fois, sur le thread du watcher. Une porte
+    ouverte plus de `open_alarm` secondes déclenche on_event("alarm", ...)
+    une fois. Seuls les états lus après l'ouverture sont pris en compte.
+    """
+
+    def __init__(
+        self,
+        serial_ctrl,
+        on_closed: Callable[[int, dict], None],
+        on_event: Callable[[str, dict], None],
+        debounce: float = DEBOUNCE,
+        open_alarm: float = OPEN_ALARM,
+    ):
+        self.on_closed = on_closed
+        self.on_event = on_event
+        self.debounce = debounce
+        self.open_alarm = open_alarm
+        self._watches = {}
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        serial_ctrl.add_state_listener(self._on_state)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="door-watcher", daemon=True)
+            self._thread.start()
+
+    def watch(self, box_id: int, context: dict):
+        """Surveiller une box qui vient d'être ouverte; `context` est repassé à on_closed"""
+        with self._lock:
+            self._watches[box_id] = {
+                "context": context,
+                "started": time.monotonic(),
+                "state": "armed",
+                "opened": None,
+                "closed_since": None,
+                "alarmed": False,
+            }
+
+    def cancel(self, box_id: int):
+        """Fermeture confirmée autrement (bouton Confirmer)"""
+        with self._lock:
+            self._watches.pop(box_id, None)
+
+    def watched(self) -> dict:
+        with self._lock:
+            return {box_id: w["state"] for box_id, w in self._watches.items()}
+
+    def _on_state(self, mask: int, taken_at: float):
+        with self._lock:
+            self._snapshot = (mask, taken_at)
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(TICK)
+            self._wakeup.clear()
+            for kind, box_id, data in self._step(time.monotonic()):
+                try:
+                    if kind == "closed":
+                        self.on_closed(box_id, data)
+                    else:
+                        self.on_event(kind, data)
+                except Exception:
+                    LOG.exception("Door %s handling failed for box %s", kind, box_id)
+
+    def _step(self, now: float):
+        """Faire avancer chaque box surveillée; retourne les actions à lancer hors verrou"""
+        actions = []
+        with self._lock:
+            snapshot = self._snapshot
+            for box_id, w in list(self._watches.items()):
+                if snapshot is not None and snapshot[1] > w["started"]:
+                    mask, taken_at = snapshot
+                    closed = bool(mask >> (box_id - 1) & 1)
+                    if w["state"] == "armed" and not closed:
+                        w["state"], w["opened"] = "open", taken_at
+                        actions.append(("door", box_id, {"boxId": box_id, "state": "open"}))
+                    elif w["state"] == "open" and closed:
+                        w["state"], w["closed_since"] = "closing", taken_at
+                    elif w["state"] == "closing" and not closed:
+                        w["state"] = "open"  # Rebond ou porte rouverte
+                    elif w["state"] == "closing" and taken_at - w["closed_since"] >= self.debounce:
+                        del self._watches[box_id]
+                        actions.append(("door", box_id, {"boxId": box_id, "state": "closed"}))
+                        actions.append(("closed", box_id, w["context"]))
+                        continue
+
+                if w["state"] == "armed" and now - w["started"] > WATCH_MAX:
+                    LOG.info("Box %s never opened, watch dropped", box_id)
+                    del self._watches[box_id]
+                elif w["opened"] is not None and not w["alarmed"] and now - w["opened"] > self.open_alarm:
+                    w["alarmed"] = True
+                    LOG.warning("Box %s left open for more than %.0fs", box_id, self.open_alarm)
+                    actions.append(("alarm", box_id, {"boxId": box_id, "openFor": round(now - w["opened"])}))
+        return actions
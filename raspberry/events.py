@@ -0,0 +1,55 @@
+import json
+import queue
+import threading
+
+
+KEEPALIVE_SECONDS = 15
+SUBSCRIBER_BUFFER = 50
+
+
+class EventBroker:
+    """
+    Diffusion en mémoire des événements du kiosque (portes, fermetures)
+    vers l'écran (SSE). Pas d'historique: à la reconnexion, l'écran repart
+    de son propre état. Un abonné dont la file déborde est déconnecté.
+    """
+
+    def __init__(self, buffer_size: int = SUBSCRIBER_BUFFER):
+        self.buffer_size = buffer_size
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def publish(self, event: str, data: dict):
+        item = (event, json.dumps(data))
+        with self._lock:
+            for sub in list(self._subscribers):
+                try:
+                    sub.put_nowait(item)
+                except queue.Full:
+                    self._subscribers.discard(sub)
+                    sub.overflowed = True
+
+    def subscribe(self):
+        sub = queue.Queue(maxsize=self.buffer_size)
+        sub.overflowed = False
+        with self._lock:
+            self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def stream(self, sub):
+        """Générateur SSE pour un abonné"""
+        try:
+            yield "retry: 2000\n\n"
+            while not sub.overflowed:
+                try:
+                    event, data = sub.get(timeout=KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event}\ndata: {data}\n\n"
+        finally:
+            self.unsubscribe(sub)
@@ -0,0 +1,285 @@
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+
+LOG = logging.getLogger(__name__)
+
+BACKOFF_BASE = 1.0  # Secondes avant le premier rejeu, doublé à chaque échec
+BACKOFF_MAX = 60.0
+CODE_TTL_DAYS = 2  # Codes réservés pour des dépôts jamais fermés
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    action TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT,
+    http_status INTEGER,
+    response TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    sent_at TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_journal_pending ON journal(id) WHERE status = 'pending';
+CREATE TABLE IF NOT EXISTS deposit_codes (
+    box_id INTEGER NOT NULL,
+    closet_id INTEGER NOT NULL,
+    password TEXT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (box_id, closet_id)
+);
+"""
+
+
+class Journal:
+    """
+    Journal local (SQLite) des confirmations de fermeture (et des dépôts
+    commencés sur une box prêtée).
+    Une entrée est écrite sur disque avant de répondre au client, puis un
+    thread la rejoue vers le serveur, dans l'ordre, avec backoff tant que
+    le serveur est injoignable. Les entrées en attente sont reprises au
+    redémarrage.
+
+    Statuts: held (écrite avant une ouverture de porte, pas encore
+    envoyée), pending (à envoyer), sent (acceptée), rejected (refusée par
+    le serveur, 4xx: gardée pour l'exploitant, jamais rejouée). Une entrée
+    held est confirmée (commit) si la porte s'est ouverte, supprimée
+    sinon (cancel); au redémarrage, celles d'un arrêt brutal sont
+    envoyées: la porte a pu s'ouvrir.
+    `on_alarm(action, payload, response)` est appelé pour une entrée
+    refusée ou acceptée avec une box signalée (`flagged`): la porte a déjà
+    été ouverte, le colis est peut-être dans une box que le serveur ignore.
+
+    Le mot de passe d'un dépôt est réservé par le serveur à l'ouverture et
+    gardé ici (deposit_codes) jusqu'à la fermeture: le kiosque peut
+    l'afficher sans attendre la confirmation, et n'en invente jamais.
+    """
+
+    def __init__(self, path: str, api_client, on_alarm=None):
+        self.path = path
+        self.on_alarm = on_alarm
+        self.alarms = 0  # Entrées refusées ou box signalée, depuis le démarrage
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode = WAL")
+        # Une confirmation ne doit pas être perdue sur coupure de courant
+        self._db.execute("PRAGMA synchronous = FULL")
+        self._db.executescript(SCHEMA)
+        held = self._db.execute("UPDATE journal SET status='pending' WHERE status='held'").rowcount
+        self._db.commit()
+        if held:
+            LOG.warning("%s journal entries held across a restart, sending them", held)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._done = threading.Condition()
+        self._thread = None
+        self._actions = {
+            # Dépôt sur une box prêtée (leases.py), toujours journalisé avant sa fermeture
+            "deposit_open": lambda p: api_client.register_deposit(
+                p["lockerId"], p["boxId"], p["closetId"], p["trackingCode"], p.get("password")
+            ),
+            "deposit_close": lambda p: api_client.close_deposit(
+                p["lockerId"], p["boxId"], p["closetId"], p["trackingCode"]
+            ),
+            "withdraw_close": lambda p: api_client.close_withdraw(p["lockerId"], p["boxId"], p["closetId"]),
+        }
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="journal-replay", daemon=True)
+            self._thread.start()
+
+    def reserve_code(self, box_id: int, closet_id: int, password: str):
+        """Garder le mot de passe retourné par le serveur à l'ouverture d'un dépôt"""
+        with self._lock:
+            # Dépôts ouverts mais jamais fermés (abandon, reset admin)
+            self._db.execute(f"DELETE FROM deposit_codes WHERE created_at < datetime('now', '-{CODE_TTL_DAYS} days')")
+            self._db.execute(
+                "INSERT OR REPLACE INTO deposit_codes (box_id, closet_id, password) VALUES (?, ?, ?)",
+                (box_id, closet_id, password),
+            )
+            self._db.commit()
+
+    def reserved_code(self, box_id: int, closet_id: int) -> Optional[str]:
+        """Code réservé à l'ouverture, ou déjà passé dans une confirmation (double appui)"""
+        with self._lock:
+            row = self._db.execute(
+                """
+                SELECT password FROM deposit_codes WHERE box_id=? AND closet_id=?
+                UNION ALL
+                SELECT * FROM (
+                    SELECT json_extract(payload, '$.password') FROM journal
+                    WHERE action='deposit_close'
+                      AND json_extract(payload, '$.boxId')=? AND json_extract(payload, '$.closetId')=?
+                    ORDER BY id DESC LIMIT 1
+                )
+                """,
+                (box_id, closet_id, box_id, closet_id),
+            ).fetchone()
+        return row[0] if row else None
+
+    def record(self, action: str, payload: dict, held: bool = False) -> int:
+        """
+        Écrire une confirmation à rejouer. Retourne l'ID de l'entrée.
+        Pour un dépôt, le code réservé passe dans l'entrée (même transaction).
+        `held`: pas envoyée avant commit(entry_id).
+        """
+        if action not in self._actions:
+            raise ValueError(f"Action inconnue: {action}")
+        with self._lock:
+            cur = self._db.execute(
+                "INSERT INTO journal (action, payload, status) VALUES (?, ?, ?)",
+                (action, json.dumps(payload), "held" if held else "pending"),
+            )
+            if action == "deposit_close":
+                self._db.execute(
+                    "DELETE FROM deposit_codes WHERE box_id=? AND closet_id=?",
+                    (payload["boxId"], payload["closetId"]),
+                )
+            self._db.commit()
+        if not held:
+            self._wakeup.set()
+        return cur.lastrowid
+
+    def commit(self, entry_id: int):
+        """Entrée held à envoyer: l'action a eu lieu"""
+        with self._lock:
+            self._db.execute("UPDATE journal SET status='pending' WHERE id=? AND status='held'", (entry_id,))
+            self._db.commit()
+        self._wakeup.set()
+
+    def cancel(self, entry_id: int):
+        """Entrée held abandonnée (porte jamais ouverte), avec le code réservé de son dépôt"""
+        with self._lock:
+            row = self._db.execute(
+                "DELETE FROM journal WHERE id=? AND status='held' RETURNING payload", (entry_id,)
+            ).fetchone()
+            if row is not None:
+                payload = json.loads(row[0])
+                if "closetId" in payload:
+                    self._db.execute(
+                        "DELETE FROM deposit_codes WHERE box_id=? AND closet_id=?",
+                        (payload["boxId"], payload["closetId"]),
+                    )
+            self._db.commit()
+
+    def wait(self, entry_id: int, timeout: float):
+        """
+        Attendre au plus `timeout` secondes que l'entrée soit traitée.
+        Retourne (réponse, statut HTTP) du serveur, ou None si elle est
+        toujours en attente.
+        """
+        deadline = time.monotonic() + timeout
+        with self._done:
+            while True:
+                entry = self.get(entry_id)
+                if entry["status"] != "pending":
+                    return json.loads(entry["response"]), entry["http_status"]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._done.wait(remaining)
+
+    def get(self, entry_id: int):
+        with self._lock:
+            row = self._db.execute("SELECT * FROM journal WHERE id=?", (entry_id,)).fetchone()
+        return dict(row)
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM journal WHERE status='pending'").fetchone()[0]
+
+    def pending_password(self, password: str) -> bool:
+        """Vrai si un dépôt avec ce mot de passe attend encore d'être confirmé au serveur"""
+        with self._lock:
+            row = self._db.execute(
+                """
+                SELECT 1 FROM journal
+                WHERE status='pending' AND action='deposit_close' AND json_extract(payload, '$.password')=?
+                LIMIT 1
+                """,
+                (password,),
+            ).fetchone()
+        return row is not None
+
+    def _next(self):
+        with self._lock:
+            return self._db.execute(
+                "SELECT id, action, payload, attempts FROM journal WHERE status='pending' ORDER BY id LIMIT 1"
+            ).fetchone()
+
+    def _finish(self, entry_id: int, status: str, response: dict, http_status: int):
+        with self._lock:
+            self._db.execute(
+                """
+                UPDATE journal SET status=?, response=?, http_status=?, attempts=attempts+1, sent_at=CURRENT_TIMESTAMP
+                WHERE id=?
+                """,
+                (status, json.dumps(response), http_status, entry_id),
+            )
+            self._db.commit()
+        with self._done:
+            self._done.notify_all()
+
+    def _retry_later(self, entry_id: int, error: str):
+        with self._lock:
+            self._db.execute(
+                "UPDATE journal SET attempts=attempts+1, last_error=? WHERE id=?", (error, entry_id)
+            )
+            self._db.commit()
+
+    def _alarm(self, action: str, payload, response: dict):
+        self.alarms += 1
+        if self.on_alarm is None:
+            return
+        try:
+            self.on_alarm(action, payload or {}, response)
+        except Exception:  # L'alarme ne doit pas arrêter le rejeu
+            LOG.exception("Journal alarm callback failed")
+
+    def _run(self):
+        failures = 0
+        while True:
+            entry = self._next()
+            if entry is None:
+                failures = 0
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            payload = None
+            try:
+                payload = json.loads(entry["payload"])
+                response, status = self._actions[entry["action"]](payload)
+            except Exception as exc:  # Entrée illisible: ne pas bloquer celles qui suivent
+                LOG.exception("Journal entry %s cannot be replayed", entry["id"])
+                self._finish(entry["id"], "rejected", {"message": str(exc)}, None)
+                self._alarm(entry["action"], payload, {"message": str(exc)})
+                continue
+            if 200 <= status < 300:
+                failures = 0
+                self._finish(entry["id"], "sent", response, status)
+                if entry["attempts"]:
+                    LOG.info("Journal entry %s delivered after %s retries", entry["id"], entry["attempts"])
+                if response.get("flagged"):
+                    LOG.error("Journal entry %s: box flagged by server: %s", entry["id"], response)
+                    self._alarm(entry["action"], payload, response)
+            elif 400 <= status < 500 and status not in (408, 429):
+                failures = 0
+                LOG.error("Journal entry %s rejected by server (%s): %s", entry["id"], status, response)
+                self._finish(entry["id"], "rejected", response, status)
+                self._alarm(entry["action"], payload, response)
+            else:
+                # Serveur injoignable ou en erreur: on garde l'ordre, l'entrée reste en tête
+                failures += 1
+                self._retry_later(entry["id"], f"{status}: {response.get('message', '')}")
+                pause = random.uniform(0.5, 1.0) * min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (failures - 1))
+                LOG.warning("Journal replay failed (%s), retry in %.1fs", status, pause)
+                self._wakeup.wait(pause)
+                self._wakeup.clear()
@@ -16,13 +16,32 @@ if command -v xrandr >/dev/null 2>&1 && command -v xinput >/dev/null 2>&1; then
   fi
 fi
 
+# Persistent profile (no --incognito): HTTP cache and service worker survive reboots
+KIOSK_PROFILE="${KIOSK_PROFILE:-/home/pi/.config/kiosk-chromium}"
+mkdir -p "${KIOSK_PROFILE}"
+# Chromium is killed on shutdown: do not show the "restore pages" bubble
+PREFS="${KIOSK_PROFILE}/Default/Preferences"
+if [ -f "${PREFS}" ]; then
+  sed -i 's/"exited_cleanly":false/"exited_cleanly":true/; s/"exit_type":"[^"]*"/"exit_type":"Normal"/' "${PREFS}" || true
+fi
+
+# Once the service worker is installed, the screen comes from its cache: start at once.
+# Otherwise (first boot, profile wiped) wait for the Flask app, at most 30 s.
+if [ ! -d "${KIOSK_PROFILE}/Default/Service Worker" ]; then
+  for _ in $(seq 1 150); do
+    curl -fs -o /dev/null "${KIOSK_URL}/api/ping" && break
+    sleep 0.2
+  done
+fi
+
 # Hide mouse cursor
 unclutter -idle 0 &
 
 exec /usr/bin/chromium \
   --noerrdialogs \
   --kiosk "${KIOSK_URL}" \
-  --incognito \
+  --user-data-dir="${KIOSK_PROFILE}" \
+  --hide-crash-restore-bubble \
   --disable-translate \
   --overscroll-history-navigation=0 \
   --check-for-update-interval=31536000 \
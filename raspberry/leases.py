@@ -0,0 +1,94 @@
+import logging
+import random
+import threading
+import time
+from typing import Optional
+
+
+LOG = logging.getLogger(__name__)
+
+LEASE_COUNT = 2  # Boxes prêtées demandées au serveur
+SAFETY_MARGIN = 30.0  # Secondes: un bail plus proche de l'échéance n'est plus utilisé
+RETRY_MIN = 5.0  # Secondes avant de redemander si le serveur ne répond pas
+RETRY_MAX = 60.0
+
+
+class LeaseManager:
+    """
+    Boxes prêtées par le serveur (POST /api/leases) avec leur closet ID et
+    leur mot de passe déjà réservés: un dépôt peut ouvrir la porte sans
+    attendre le serveur, l'enregistrement part ensuite par le journal.
+
+    Un thread renouvelle les baux au tiers de leur durée et complète la
+    réserve après chaque dépôt. La liste du serveur fait foi; un bail pris
+    reste écarté jusqu'à ce que le serveur ne le liste plus.
+    """
+
+    def __init__(self, api_client, locker_id: int, count: int = LEASE_COUNT):
+        self.api_client = api_client
+        self.locker_id = locker_id
+        self.count = count
+        self._leases = []
+        self._taken = set()  # orderId des baux utilisés, pas encore enregistrés au serveur
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="box-leases", daemon=True)
+            self._thread.start()
+
+    def take(self) -> Optional[dict]:
+        """Un bail encore valide ({boxId, closetId, password, orderId, size}), ou None"""
+        now = time.monotonic()
+        with self._lock:
+            self._leases = [lease for lease in self._leases if lease["expires"] - SAFETY_MARGIN > now]
+            lease = self._leases.pop(0) if self._leases else None
+            if lease is not None:
+                self._taken.add(lease["orderId"])
+        self._wakeup.set()  # Compléter la réserve
+        return lease
+
+    def give_back(self, lease: dict):
+        """Bail pris mais pas utilisé (porte restée fermée): de nouveau disponible"""
+        with self._lock:
+            self._taken.discard(lease["orderId"])
+            if all(other["orderId"] != lease["orderId"] for other in self._leases):
+                self._leases.insert(0, lease)
+
+    def available(self) -> int:
+        now = time.monotonic()
+        with self._lock:
+            return sum(1 for lease in self._leases if lease["expires"] - SAFETY_MARGIN > now)
+
+    def refresh(self) -> Optional[float]:
+        """Renouveler et compléter les baux. Retourne leur durée (s), None si le serveur a échoué."""
+        sent = time.monotonic()
+        resp, status = self.api_client.lease_boxes(self.locker_id, self.count)
+        if status != 200:
+            LOG.warning("Box lease refresh failed (%s): %s", status, resp.get("message", ""))
+            return None
+        with self._lock:
+            listed = {lease["orderId"] for lease in resp["boxes"]}
+            self._taken &= listed
+            # Échéance comptée depuis l'envoi de la requête: jamais plus tard que côté serveur
+            self._leases = [
+                dict(lease, expires=sent + lease["expiresIn"])
+                for lease in resp["boxes"]
+                if lease["orderId"] not in self._taken
+            ]
+        return float(resp["ttl"])
+
+    def _run(self):
+        failures = 0
+        while True:
+            ttl = self.refresh()
+            if ttl is None:
+                failures += 1
+                pause = random.uniform(0.5, 1.0) * min(RETRY_MAX, RETRY_MIN * 2 ** (failures - 1))
+            else:
+                failures = 0
+                pause = ttl / 3
+            self._wakeup.wait(pause)
+            self._wakeup.clear()
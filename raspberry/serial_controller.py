@@ -1,6 +1,11 @@
 import time
 import logging
-from typing import Optional
+import queue
+import random
+import threading
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from typing import Callable, Optional
 
 try:
     import serial
@@ -10,55 +15,440 @@ except ImportError:  # pragma: no cover
 
 LOG = logging.getLogger(__name__)
 
+READ_SLICE = 0.05  # Timeout d'un readline: le thread I/O ne bloque jamais plus longtemps
+IDLE_POLL = 0.02  # Attente d'une commande quand rien n'est en cours
+QUEUE_TIMEOUT = 5.0  # Attente max dans la file avant l'envoi d'une commande
+EVENT_PREFIX = "EVT"  # Lignes envoyées d'elles-mêmes par l'Arduino (ex. EVT:DOOR:3:OPEN)
+BOX_COUNT = 16
+POLL_INTERVAL = 0.25  # Secondes entre deux READALL du poller
+READALL_UNSUPPORTED = ("ERR", "UNKNOWN")  # Réponses d'un firmware sans READALL: lecture box par box
+STATE_MAX_AGE = 1.0  # Âge max (s) d'un état en cache pour répondre sans lire le capteur
+HANDSHAKE_TIMEOUT = 5.0  # Reset de l'Arduino à l'ouverture du port (~1.5 s pour un Uno)
+HANDSHAKE_INTERVAL = 0.25  # Un PING toutes les 250 ms jusqu'à la première réponse
+HEARTBEAT = 2.0  # Port silencieux depuis ce délai: PING (détecte débranchement et Arduino figé)
+RECONNECT_MIN = 0.5  # Secondes avant de rouvrir le port, doublé à chaque échec
+RECONNECT_MAX = 10.0
+STATS_WINDOW = 200  # Derniers temps de réponse gardés (ms)
+SIMULATION_PORT = "sim"  # SERIAL_PORT=sim: pas d'Arduino, toutes les commandes répondent OK
+
 
 class SerialError(Exception):
     pass
 
 
 class SerialController:
-    def __init__(self, port: str, baud: int = 115200, timeout: float = 2.0):
+    """
+    Pont série vers l'Arduino. Un thread dédié possède le port: les
+    commandes passent par une file et partent une par une (une ligne
+    envoyée, une ligne de réponse), chaque appelant attend son Future.
+    Deux requêtes Flask simultanées ne se mélangent donc plus sur le fil.
+
+    Les lignes que l'Arduino envoie de lui-même (préfixe EVT, ou reçues
+    sans commande en cours) sont passées aux listeners, appelés sur le
+    thread I/O: ils doivent rendre la main vite.
+
+    Le port est ouvert par ce même thread, sans bloquer le démarrage:
+    l'Arduino est prêt dès qu'il répond au PING. Si le port disparaît
+    (câble USB, ré-énumération), il est rouvert avec backoff; en attendant
+    les commandes échouent tout de suite (SerialError). La simulation
+    (réponses OK) n'est utilisée que si elle est demandée (port "sim") ou
+    si pyserial manque.
+    """
+
+    def __init__(self, port: str, baud: int = 115200, timeout: float = 2.0, max_age: float = STATE_MAX_AGE):
         self.port = port
         self.baud = baud
         self.timeout = timeout
+        self.max_age = max_age
         self._serial = None
-        self._connect()
-
-    def _connect(self):
+        self._partial = b""
+        self._last_io = 0.0  # Dernière ligne reçue de l'Arduino
+        # Compteurs des commandes traitées par le thread I/O (télémétrie)
+        self._rtt = deque(maxlen=STATS_WINDOW)
+        self.commands = 0
+        self.timeouts = 0
+        self.errors = 0
+        self._desynced = False  # Réponse manquée: elle peut arriver en retard, à la place d'une autre
+        # Dernier état des portes: (masque des portes fermées, instant d'envoi du READALL)
+        self._snapshot = None
+        self._opened_at = {}  # box -> instant du dernier OPEN: le cache d'avant ne vaut plus
+        self._state_lock = threading.Lock()
+        self._readall = True  # False si le firmware ne connaît pas READALL
+        self._poller = None
+        self._state_listeners = []
+        self._queue = queue.Queue()
+        self._listeners = []
+        self._listeners_lock = threading.Lock()
+        self._closed = threading.Event()
+        self.simulated = serial is None or port == SIMULATION_PORT
         if serial is None:
             LOG.warning("pyserial not installed; running in simulation mode")
-            return
-        try:
-            self._serial = serial.Serial(self.port, self.baud, timeout=self.timeout)
-            time.sleep(2)  # allow Arduino reset
-        except Exception as exc:  # pragma: no cover
-            LOG.error("Serial connection failed: %s", exc)
+        # connecting -> ready -> disconnected -> connecting ... (ou simulation)
+        self.state = "simulation" if self.simulated else "connecting"
+        self.last_error = None
+        self.reconnects = 0  # Connexions rétablies après une perte
+        self.ready_at = None  # time.time() de la dernière connexion réussie
+        self.ready_after = None  # Secondes entre l'ouverture du port et la réponse au PING
+        self._thread = threading.Thread(target=self._run, name="serial-io", daemon=True)
+        self._thread.start()
+
+    def status(self) -> dict:
+        return {
+            "state": self.state,
+            "port": self.port,
+            "readySince": self.ready_at,
+            "readyAfter": self.ready_after,
+            "reconnects": self.reconnects,
+            "lastError": self.last_error,
+        }
+
+    def close(self):
+        """Arrêter le thread I/O et fermer le port (les commandes en file échouent)"""
+        self._closed.set()
+        self._thread.join(timeout=HANDSHAKE_TIMEOUT + self.timeout)
+        if self._serial is not None:
+            self._serial.close()
             self._serial = None
+        self.state = "disconnected"
+        while True:
+            try:
+                command, _, _, future = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if future.set_running_or_notify_cancel():
+                future.set_exception(SerialError("Port série fermé"))
 
-    def _send_command(self, command: str) -> str:
-        if self._serial is None:
-            LOG.info("Simulated serial command: %s", command)
-            return "OK"
+    def stats(self) -> dict:
+        """Commandes, timeouts, erreurs depuis le démarrage; temps de réponse des dernières commandes"""
+        ms = sorted(self._rtt)
+
+        def pct(p):
+            return round(ms[min(len(ms) - 1, int(p / 100 * len(ms)))], 1) if ms else None
+
+        return {
+            "commands": self.commands,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "reconnects": self.reconnects,
+            "rtt_p50_ms": pct(50),
+            "rtt_p95_ms": pct(95),
+        }
+
+    def _connect(self) -> bool:
+        """Ouvrir le port et attendre la réponse au PING (thread I/O uniquement)"""
+        self.state = "connecting"
+        opened = time.monotonic()
         try:
-            self._serial.reset_input_buffer()
-            self._serial.write((command + "\n").encode("utf-8"))
+            self._serial = serial.Serial(self.port, self.baud, timeout=READ_SLICE, write_timeout=self.timeout)
+            if self._handshake():
+                self.ready_after = round(time.monotonic() - opened, 3)
+                if self.ready_at is not None:
+                    self.reconnects += 1
+                self.ready_at = time.time()
+                self.state = "ready"
+                LOG.info("Arduino ready on %s after %.2fs", self.port, self.ready_after)
+                return True
+            error = f"no PING answer within {HANDSHAKE_TIMEOUT:.0f}s"
+        except (serial.SerialException, OSError) as exc:
+            error = str(exc)
+        self._disconnect(error)
+        return False
+
+    def _handshake(self, timeout: float = HANDSHAKE_TIMEOUT) -> bool:
+        """PING jusqu'à un OK, puis vider l'entrée: la prochaine ligne lue répond à la prochaine commande"""
+        self._partial = b""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            self._serial.reset_input_buffer()  # Octets du bootloader
+            self._serial.write(b"PING\n")
             self._serial.flush()
-            response = self._serial.readline().decode("utf-8").strip()
-            LOG.debug("Serial response: %s", response)
-            return response or "OK"
-        except Exception as exc:  # pragma: no cover
-            raise SerialError(str(exc))
+            until = min(deadline, time.monotonic() + HANDSHAKE_INTERVAL)
+            while time.monotonic() < until:
+                if (self._readline() or "").upper() == "OK":
+                    # Réponses à des PING précédents encore en route
+                    time.sleep(HANDSHAKE_INTERVAL / 2)
+                    self._serial.reset_input_buffer()
+                    self._partial = b""
+                    self._desynced = False
+                    return True
+        return False
+
+    def _disconnect(self, error: str):
+        if self.state == "ready":
+            LOG.error("Serial port %s lost: %s", self.port, error)
+        else:
+            LOG.warning("Serial port %s not available: %s", self.port, error)
+        self.state = "disconnected"
+        self.last_error = error
+        if self._serial is not None:
+            try:
+                self._serial.close()
+            except Exception:
+                pass
+        self._serial = None
+
+    def _reject_until(self, until: float):
+        """Attendre avant de rouvrir le port; les commandes reçues entre-temps échouent"""
+        while True:
+            remaining = until - time.monotonic()
+            if remaining <= 0 or self._closed.is_set():
+                return
+            try:
+                command, _, _, future = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                return
+            if future.set_running_or_notify_cancel():
+                future.set_exception(SerialError(f"Arduino non connecté ({self.last_error})"))
+
+    def add_listener(self, callback: Callable[[str], None]):
+        """Recevoir les lignes non sollicitées de l'Arduino"""
+        with self._listeners_lock:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback: Callable[[str], None]):
+        with self._listeners_lock:
+            self._listeners.remove(callback)
+
+    def add_state_listener(self, callback: Callable[[int, float], None]):
+        """Recevoir chaque nouvel état des portes: callback(masque, instant d'envoi du READALL)"""
+        with self._listeners_lock:
+            self._state_listeners.append(callback)
+
+    def submit(self, command: str, timeout: Optional[float] = None) -> Future:
+        """
+        Mettre une commande dans la file. Le Future donne la ligne de
+        réponse (vide si l'Arduino n'a rien répondu dans `timeout`).
+        """
+        future = Future()
+        queued_until = time.monotonic() + QUEUE_TIMEOUT
+        self._queue.put((command, self.timeout if timeout is None else timeout, queued_until, future))
+        return future
+
+    def _request(self, command: str, timeout: Optional[float] = None) -> str:
+        """Réponse de l'Arduino, vide s'il n'a rien répondu dans `timeout`"""
+        timeout = self.timeout if timeout is None else timeout
+        future = self.submit(command, timeout)
+        try:
+            return future.result(QUEUE_TIMEOUT + timeout + 1)
+        except FutureTimeout:
+            future.cancel()
+            raise SerialError(f"Pas de réponse du thread série pour {command}")
+
+    def _send_command(self, command: str, timeout: Optional[float] = None) -> str:
+        return self._request(command, timeout) or "OK"
 
     def ping(self) -> bool:
         resp = self._send_command("PING")
         return resp.upper() == "OK"
 
     def open_locker(self, locker_id: int):
+        with self._state_lock:
+            self._opened_at[locker_id] = time.monotonic()
         resp = self._send_command(f"OPEN:{locker_id}")
         if "ERR" in resp.upper():
             raise SerialError(resp)
 
-    def verify_closed(self, locker_id: int) -> bool:
+    def verify_closed(self, locker_id: int, max_age: Optional[float] = None) -> bool:
+        """Depuis le cache du poller s'il a moins de `max_age` secondes, sinon READ:<n>"""
+        cached = self.cached_closed(locker_id, self.max_age if max_age is None else max_age)
+        if cached is not None:
+            return cached
+        return self._read_one(locker_id)
+
+    def _read_one(self, locker_id: int) -> bool:
         resp = self._send_command(f"READ:{locker_id}")
         # Expecting response like "CLOSED" or "OPEN"
         return resp.upper() == "CLOSED"
 
+    def read_all(self) -> int:
+        """
+        Lire tous les capteurs en une commande: READALL -> STATE:<hex>,
+        bit n-1 à 1 si la porte de la box n est fermée. Met le cache à
+        jour et retourne le masque. Firmware sans READALL (réponse ERR ou
+        UNKNOWN): un READ par box. Pas de réponse ou réponse illisible:
+        SerialError, READALL réessayé au passage suivant.
+        """
+        sent = time.monotonic()
+        if self._readall and not self.simulated:
+            resp = self._request("READALL")
+            if not resp:
+                # Réponse perdue: on réessaie au prochain passage, sans abandonner READALL
+                raise SerialError("Pas de réponse de l'Arduino à READALL")
+            if resp.upper().startswith("STATE:"):
+                try:
+                    mask = int(resp[6:], 16)
+                except ValueError:
+                    raise SerialError(f"Réponse READALL invalide: {resp}")
+                self._store(mask, sent)
+                return mask
+            if not resp.upper().startswith(READALL_UNSUPPORTED):
+                raise SerialError(f"Réponse READALL invalide: {resp}")
+            LOG.warning("READALL not supported by the Arduino (%s); reading boxes one by one", resp)
+            self._readall = False
+        mask = 0
+        for box in range(1, BOX_COUNT + 1):
+            if self._read_one(box):
+                mask |= 1 << (box - 1)
+        self._store(mask, sent)
+        return mask
+
+    def cached_closed(self, locker_id: int, max_age: float) -> Optional[bool]:
+        """État en cache de la porte, ou None s'il est trop vieux ou antérieur au dernier OPEN"""
+        with self._state_lock:
+            if self._snapshot is None:
+                return None
+            mask, taken_at = self._snapshot
+            if time.monotonic() - taken_at > max_age or taken_at <= self._opened_at.get(locker_id, 0):
+                return None
+        return bool(mask >> (locker_id - 1) & 1)
+
+    def door_states(self, max_age: Optional[float] = None) -> dict:
+        """{boxes: [{boxId, closed}], age: s, cached: bool}, lu sur le port si le cache est trop vieux"""
+        max_age = self.max_age if max_age is None else max_age
+        with self._state_lock:
+            snapshot = self._snapshot
+        cached = snapshot is not None and time.monotonic() - snapshot[1] <= max_age
+        if not cached:
+            self.read_all()
+            with self._state_lock:
+                snapshot = self._snapshot
+        mask, taken_at = snapshot
+        return {
+            "boxes": [{"boxId": box, "closed": bool(mask >> (box - 1) & 1)} for box in range(1, BOX_COUNT + 1)],
+            "age": round(time.monotonic() - taken_at, 3),
+            "cached": cached,
+        }
+
+    def start_poller(self, interval: float = POLL_INTERVAL):
+        """Thread qui garde l'état de toutes les portes en cache (un READALL par intervalle)"""
+        if self.simulated:
+            LOG.info("Serial simulation; door state poller not started")
+            return
+        if self._poller is None:
+            self._poller = threading.Thread(target=self._poll, args=(interval,), name="door-poller", daemon=True)
+            self._poller.start()
+
+    def _poll(self, interval: float):
+        while not self._closed.is_set():
+            if self.state == "ready":
+                try:
+                    self.read_all()
+                except SerialError as exc:
+                    LOG.warning("Door state poll failed: %s", exc)
+            time.sleep(interval)
+
+    def _store(self, mask: int, taken_at: float):
+        with self._state_lock:
+            if self._snapshot is not None and taken_at <= self._snapshot[1]:
+                return
+            self._snapshot = (mask, taken_at)
+        with self._listeners_lock:
+            listeners = list(self._state_listeners)
+        for callback in listeners:
+            try:
+                callback(mask, taken_at)
+            except Exception:
+                LOG.exception("Door state listener failed")
+
+    def _run(self):
+        failures = 0
+        while not self._closed.is_set():
+            if not self.simulated and self._serial is None:
+                if self._connect():
+                    failures = 0
+                else:
+                    failures += 1
+                    pause = random.uniform(0.5, 1.0) * min(RECONNECT_MAX, RECONNECT_MIN * 2 ** (failures - 1))
+                    self._reject_until(time.monotonic() + pause)
+                    continue
+            try:
+                command, timeout, queued_until, future = self._queue.get(timeout=IDLE_POLL)
+            except queue.Empty:
+                try:
+                    self._drain()
+                    if not self.simulated and time.monotonic() - self._last_io > HEARTBEAT:
+                        if self._transact("PING", self.timeout).upper() != "OK":
+                            # Rouvrir le port remet aussi l'Arduino à zéro (DTR)
+                            self._disconnect("no answer to heartbeat PING")
+                except SerialError as exc:
+                    self._disconnect(str(exc))
+                except (serial.SerialException, OSError) as exc:
+                    self._disconnect(str(exc))
+                continue
+            if not future.set_running_or_notify_cancel():
+                continue  # Abandonnée par l'appelant
+            if time.monotonic() > queued_until:
+                future.set_exception(SerialError(f"Commande {command} restée trop longtemps en file"))
+                continue
+            self.commands += 1
+            started = time.monotonic()
+            try:
+                response = self._transact(command, timeout)
+            except SerialError as exc:
+                self.errors += 1
+                future.set_exception(exc)
+            except Exception as exc:
+                # Port perdu en pleine commande: on le rouvrira au prochain tour
+                self.errors += 1
+                self._disconnect(str(exc))
+                future.set_exception(SerialError(f"Arduino déconnecté: {exc}"))
+            else:
+                if response or self.simulated:
+                    self._rtt.append((time.monotonic() - started) * 1000)
+                else:
+                    self.timeouts += 1
+                future.set_result(response)
+
+    def _transact(self, command: str, timeout: float) -> str:
+        """Envoyer une commande et lire sa réponse (thread I/O uniquement)"""
+        if self.simulated:
+            LOG.info("Simulated serial command: %s", command)
+            return "OK"
+        if self._desynced and not self._handshake(self.timeout):
+            raise SerialError(f"Arduino désynchronisé, pas de réponse au PING ({command} non envoyée)")
+        # Lignes arrivées entre deux commandes (événements, réponse tardive)
+        self._drain()
+        self._serial.write((command + "\n").encode("utf-8"))
+        self._serial.flush()
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            line = self._readline()
+            if line is None:
+                continue
+            if line.startswith(EVENT_PREFIX):
+                self._dispatch(line)
+                continue
+            LOG.debug("Serial response: %s", line)
+            return line
+        LOG.warning("No serial response to %s within %.1fs", command, timeout)
+        self._desynced = True
+        return ""
+
+    def _drain(self):
+        if self._serial is None:
+            return
+        while self._serial.in_waiting:
+            line = self._readline()
+            if line is not None:
+                self._dispatch(line)
+
+    def _readline(self) -> Optional[str]:
+        """Une ligne complète non vide, ou None après READ_SLICE sans ligne complète"""
+        data = self._serial.readline()
+        if not data.endswith(b"\n"):
+            self._partial += data  # Fin de ligne pas encore reçue
+            return None
+        data, self._partial = self._partial + data, b""
+        self._last_io = time.monotonic()
+        return data.decode("utf-8", errors="replace").strip() or None
+
+    def _dispatch(self, line: str):
+        with self._listeners_lock:
+            listeners = list(self._listeners)
+        if not listeners:
+            LOG.debug("Unsolicited serial line: %s", line)
+        for callback in listeners:
+            try:
+                callback(line)
+            except Exception:
+                LOG.exception("Serial listener failed on %r", line)
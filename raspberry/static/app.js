@@ -133,23 +133,7 @@ async function closeDeposit() {
     showLoading(false);
     
     if (resp.ok) {
-      // Le serveur génère et retourne le mot de passe
-      if (data.password) {
-        document.getElementById("deposit-password").textContent = data.password;
-        document.getElementById("deposit-password-display").classList.remove("hidden");
-        document.getElementById("deposit-close").classList.add("hidden");
-        showToast("Dépôt réussi", "success");
-        
-        // Retourner automatiquement après affichage du mot de passe
-        setTimeout(() => {
-          goHome();
-        }, 8000);
-      } else {
-        showToast("Dépôt terminé", "success");
-        setTimeout(() => {
-          goHome();
-        }, 3000);
-      }
+      depositClosed(data);
     } else {
       showToast(data.message || "Erreur", "error");
     }
@@ -159,6 +143,27 @@ async function closeDeposit() {
   }
 }
 
+function depositClosed(data) {
+  depositState = null;
+  // Le serveur génère et retourne le mot de passe
+  if (data.password) {
+    document.getElementById("deposit-password").textContent = data.password;
+    document.getElementById("deposit-password-display").classList.remove("hidden");
+    document.getElementById("deposit-close").classList.add("hidden");
+    showToast("Dépôt réussi", "success");
+    
+    // Retourner automatiquement après affichage du mot de passe
+    setTimeout(() => {
+      goHome();
+    }, 8000);
+  } else {
+    showToast("Dépôt terminé", "success");
+    setTimeout(() => {
+      goHome();
+    }, 3000);
+  }
+}
+
 async function openWithdraw() {
   const password = document.getElementById("withdraw-password").value.trim();
   
@@ -224,12 +229,7 @@ async function closeWithdraw() {
     showLoading(false);
     
     if (resp.ok) {
-      showToast("Retrait terminé", "success");
-      document.getElementById("withdraw-close").classList.add("hidden");
-      
-      setTimeout(() => {
-        goHome();
-      }, 3000);
+      withdrawClosed();
     } else {
       showToast(data.message || "Erreur", "error");
     }
@@ -239,6 +239,44 @@ async function closeWithdraw() {
   }
 }
 
+function withdrawClosed() {
+  withdrawState = null;
+  showToast("Retrait terminé", "success");
+  document.getElementById("withdraw-close").classList.add("hidden");
+  
+  setTimeout(() => {
+    goHome();
+  }, 3000);
+}
+
+// Fermetures détectées sur le capteur, poussées par le kiosque (plus besoin de Confirmer)
+function listenDoors() {
+  const source = new EventSource("/api/events");
+
+  source.addEventListener("closed", (e) => {
+    const data = JSON.parse(e.data);
+    const ok = data.status >= 200 && data.status < 300;
+    if (data.action === "deposit" && depositState && depositState.boxId === data.boxId) {
+      ok ? depositClosed(data) : showToast(data.message || "Erreur", "error");
+    } else if (data.action === "withdraw" && withdrawState && withdrawState.boxId === data.boxId) {
+      ok ? withdrawClosed() : showToast(data.message || "Erreur", "error");
+    }
+  });
+
+  source.addEventListener("alarm", (e) => {
+    const data = JSON.parse(e.data);
+    showToast(`Fermez la porte de la box ${data.boxId}`, "warning");
+  });
+
+  // Dépôt ou fermeture refusé par le serveur: la box doit être vérifiée sur place
+  source.addEventListener("rejected", (e) => {
+    const data = JSON.parse(e.data);
+    showToast(`Box ${data.boxId}: opération non enregistrée, contactez l'exploitant`, "error");
+  });
+}
+
+listenDoors();
+
 // Keyboard shortcuts
 document.addEventListener("keydown", (e) => {
   if (e.key === "Escape") {
@@ -248,3 +286,17 @@ document.addEventListener("keydown", (e) => {
     }
   }
 });
+
+// Coquille en cache (templates/sw.js): l'écran s'affiche au boot avant Flask
+if ("serviceWorker" in navigator) {
+  const hadController = Boolean(navigator.serviceWorker.controller);
+  navigator.serviceWorker.addEventListener("controllerchange", () => {
+    // Nouvelle version installée: recharger si aucun dépôt ni retrait en cours
+    if (hadController && !depositState && !withdrawState) {
+      location.reload();
+    }
+  });
+  window.addEventListener("load", () => {
+    navigator.serviceWorker.register("/sw.js").catch(() => {});
+  });
+}
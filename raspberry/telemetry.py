@@ -0,0 +1,110 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+from itertools import islice
+from typing import Callable
+
+
+LOG = logging.getLogger(__name__)
+
+INTERVAL = 10.0  # Secondes entre deux échantillons (et deux envois)
+BUFFER_SAMPLES = 360  # Échantillons gardés sans serveur (1 h à 10 s), les plus anciens perdus ensuite
+BATCH_SAMPLES = 60  # Échantillons par envoi
+MAX_BATCHES = 6  # Envois par intervalle au plus, pour rattraper une coupure sans rafale
+COUNTER_SUFFIX = "_total"
+
+
+class TelemetryAgent:
+    """
+    Agrège la télémétrie du kiosque et l'envoie au serveur: un lot gzip
+    par intervalle (ApiClient.send_telemetry).
+
+    `collect()` retourne {nom: valeur}. Les noms en `_total` sont des
+    compteurs cumulés: l'agent envoie leur variation sur l'intervalle, sous
+    le nom sans le suffixe (serial.timeouts_total -> serial.timeouts). Les
+    autres sont des jauges, envoyées telles quelles (None: pas de mesure).
+
+    Serveur injoignable ou surchargé (5xx): les échantillons restent en
+    mémoire et partent avec le lot suivant. Lot refusé (4xx): abandonné.
+    """
+
+    def __init__(
+        self,
+        api_client,
+        locker_id: int,
+        collect: Callable[[], dict],
+        interval: float = INTERVAL,
+        buffer_size: int = BUFFER_SAMPLES,
+    ):
+        self.api = api_client
+        self.locker_id = locker_id
+        self.collect = collect
+        self.interval = interval
+        self._buffer = deque(maxlen=buffer_size)
+        self._previous = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self.sent = 0
+        self.failures = 0
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="telemetry", daemon=True)
+            self._thread.start()
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._buffer)
+
+    def sample(self) -> dict:
+        """Mesurer maintenant et mettre l'échantillon en attente d'envoi"""
+        metrics = {}
+        for name, value in self.collect().items():
+            if isinstance(value, bool):
+                value = int(value)
+            if name.endswith(COUNTER_SUFFIX) and value is not None:
+                previous = self._previous.get(name, 0)
+                self._previous[name] = value
+                # Compteur remis à zéro (redémarrage d'un composant): tout compte
+                name, value = name[: -len(COUNTER_SUFFIX)], value - previous if value >= previous else value
+            metrics[name] = value
+        sample = {"ts": int(time.time()), "metrics": metrics}
+        with self._lock:
+            self._buffer.append(sample)
+        return sample
+
+    def flush(self) -> bool:
+        """Envoyer les échantillons en attente; False si le serveur ne les a pas pris"""
+        for _ in range(MAX_BATCHES):
+            with self._lock:
+                batch = list(islice(self._buffer, BATCH_SAMPLES))
+            if not batch:
+                return True
+            body, status = self.api.send_telemetry(self.locker_id, batch)
+            if status >= 500:
+                self.failures += 1
+                LOG.warning("Telemetry not sent (%s): %s", status, body.get("message"))
+                return False
+            if status != 202:
+                LOG.error("Telemetry batch rejected (%s): %s", status, body.get("message"))
+            else:
+                self.sent += len(batch)
+            with self._lock:
+                # Seul ce thread retire des échantillons: le lot est toujours en tête
+                for _ in batch:
+                    self._buffer.popleft()
+        return True
+
+    def _run(self):
+        # Départ décalé: les kiosques allumés ensemble n'envoient pas à la même seconde
+        time.sleep(random.uniform(0, self.interval))
+        while True:
+            started = time.monotonic()
+            try:
+                self.sample()
+                self.flush()
+            except Exception:
+                LOG.exception("Telemetry collection failed")
+            time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
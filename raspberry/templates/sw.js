@@ -0,0 +1,58 @@
+// Coquille de l'écran (page + static/) servie depuis le cache: l'écran
+// s'affiche au boot avant que Flask réponde. Les appels /api/ passent
+// toujours par le réseau. Version générée par app.py (page + empreintes).
+const VERSION = {{ version|tojson }};
+const SHELL_CACHE = `shell-${VERSION}`;
+const FONTS_CACHE = "fonts";
+const SHELL_URLS = {{ shell|tojson }};
+const FONT_HOSTS = ["fonts.googleapis.com", "fonts.gstatic.com"];
+
+self.addEventListener("install", (event) => {
+  event.waitUntil(
+    caches.open(SHELL_CACHE)
+      .then((cache) => cache.addAll(SHELL_URLS))
+      .then(() => self.skipWaiting())
+  );
+});
+
+self.addEventListener("activate", (event) => {
+  event.waitUntil(
+    caches.keys()
+      .then((keys) => Promise.all(
+        keys.filter((key) => key !== SHELL_CACHE && key !== FONTS_CACHE).map((key) => caches.delete(key))
+      ))
+      .then(() => self.clients.claim())
+  );
+});
+
+async function fromCache(cacheName, request, key = request) {
+  const cache = await caches.open(cacheName);
+  const hit = await cache.match(key);
+  if (hit) return hit;
+  const resp = await fetch(request);
+  // Réponse opaque (polices sans CORS) acceptée: elle ne peut pas être inspectée
+  if (resp.ok || resp.type === "opaque") {
+    cache.put(key, resp.clone());
+  }
+  return resp;
+}
+
+self.addEventListener("fetch", (event) => {
+  const request = event.request;
+  if (request.method !== "GET") return;
+  const url = new URL(request.url);
+
+  if (url.origin === self.location.origin) {
+    if (url.pathname.startsWith("/api/")) return;
+    if (request.mode === "navigate" && url.pathname === "/") {
+      // Page d'accueil: toujours la copie du cache (mise à jour avec le service worker)
+      event.respondWith(fromCache(SHELL_CACHE, request, "/"));
+    } else if (url.pathname.startsWith("/static/")) {
+      event.respondWith(fromCache(SHELL_CACHE, request));
+    }
+    return;
+  }
+  if (FONT_HOSTS.includes(url.hostname)) {
+    event.respondWith(fromCache(FONTS_CACHE, request));
+  }
+});
@@ -0,0 +1,90 @@
+import json
+import socket
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import api_client
+from api_client import MAX_ATTEMPTS, ApiClient
+
+
+class ScriptedHandler(BaseHTTPRequestHandler):
+    """Répond avec les statuts de `server.replies` dans l'ordre, puis 200"""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.lock:
+            self.server.paths.append(self.path)
+            status = self.server.replies.pop(0) if self.server.replies else 200
+        body = json.dumps({"message": str(status)}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ApiClientRetryTest(unittest.TestCase):
+    """Rejeux: actions du kiosque seulement si rien n'a été appliqué, appels idempotents aussi sur 502/504"""
+
+    def setUp(self):
+        self._backoff = api_client.BACKOFF_BASE
+        api_client.BACKOFF_BASE = 0.001
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ScriptedHandler)
+        self.server.replies = []
+        self.server.paths = []
+        self.server.lock = threading.Lock()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = ApiClient(f"http://127.0.0.1:{self.server.server_address[1]}")
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        api_client.BACKOFF_BASE = self._backoff
+
+    def test_503_is_retried_for_kiosk_actions(self):
+        self.server.replies = [503]
+        resp, status = self.client.open_deposit(1, "T1")
+        self.assertEqual(status, 200)
+        self.assertEqual(self.server.paths, ["/api/deposit/open"] * 2)
+        self.assertEqual(self.client.stats()["/api/deposit/open"]["retries"], 1)
+
+    def test_502_is_not_retried_for_kiosk_actions(self):
+        self.server.replies = [502]
+        resp, status = self.client.close_deposit(1, 2, 102, "T1")
+        self.assertEqual(status, 502)
+        self.assertEqual(len(self.server.paths), 1)
+
+    def test_502_and_504_are_retried_for_idempotent_calls(self):
+        self.server.replies = [502, 504]
+        resp, status = self.client.lease_boxes(1, 2)
+        self.assertEqual(status, 200)
+        self.assertEqual(len(self.server.paths), 3)
+
+    def test_attempts_are_capped(self):
+        self.server.replies = [503] * (MAX_ATTEMPTS + 1)
+        resp, status = self.client.open_withdraw(1, "123456")
+        self.assertEqual(status, 503)
+        self.assertEqual(len(self.server.paths), MAX_ATTEMPTS)
+        stats = self.client.stats()["/api/withdraw/open"]
+        self.assertEqual((stats["calls"], stats["retries"], stats["errors"]), (1, MAX_ATTEMPTS - 1, 1))
+
+    def test_unreachable_server_is_retried_then_reported(self):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        client = ApiClient(f"http://127.0.0.1:{port}")
+        try:
+            resp, status = client.close_withdraw(1, 2, 102)
+        finally:
+            client.close()
+        self.assertEqual(status, 503)
+        self.assertEqual(client.stats()["/api/withdraw/close"]["retries"], MAX_ATTEMPTS - 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
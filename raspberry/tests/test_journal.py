@@ -0,0 +1,132 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+import journal as journal_module
+from journal import Journal
+
+
+class FakeServer:
+    """Client API qui note les appels; `replies` donne les réponses dans l'ordre, puis 200"""
+
+    def __init__(self, replies=()):
+        self.replies = list(replies)
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def _reply(self, call):
+        with self.lock:
+            self.calls.append(call)
+            if self.replies:
+                return self.replies.pop(0)
+        return {"message": "OK"}, 200
+
+    def register_deposit(self, locker_id, box_id, closet_id, tracking_code, password=None):
+        return self._reply(("deposit_open", box_id, tracking_code))
+
+    def close_deposit(self, locker_id, box_id, closet_id, tracking_code):
+        return self._reply(("deposit_close", box_id, tracking_code))
+
+    def close_withdraw(self, locker_id, box_id, closet_id):
+        return self._reply(("withdraw_close", box_id, closet_id))
+
+
+def deposit(box_id, tracking_code, **extra):
+    return dict({"lockerId": 1, "boxId": box_id, "closetId": 100 + box_id, "trackingCode": tracking_code}, **extra)
+
+
+class JournalReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "journal.db")
+        self._backoff = journal_module.BACKOFF_BASE
+        journal_module.BACKOFF_BASE = 0.01
+
+    def tearDown(self):
+        journal_module.BACKOFF_BASE = self._backoff
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _drain(self, journal, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while journal.pending_count() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(journal.pending_count(), 0)
+
+    def test_replay_keeps_order_across_failures(self):
+        server = FakeServer([({"message": "down"}, 503), ({"message": "down"}, 503)])
+        journal = Journal(self.path, server)
+        ids = [
+            journal.record("deposit_open", deposit(1, "T1", password="111111")),
+            journal.record("deposit_close", deposit(1, "T1")),
+            journal.record("withdraw_close", deposit(2, "T2")),
+        ]
+        journal.start()
+        self._drain(journal)
+        self.assertEqual(server.calls, [
+            ("deposit_open", 1, "T1"),
+            ("deposit_open", 1, "T1"),
+            ("deposit_open", 1, "T1"),
+            ("deposit_close", 1, "T1"),
+            ("withdraw_close", 2, 102),
+        ])
+        self.assertEqual([journal.get(i)["status"] for i in ids], ["sent"] * 3)
+        self.assertEqual(journal.get(ids[0])["attempts"], 3)
+
+    def test_rejected_entry_raises_alarm_and_does_not_block(self):
+        alarms = []
+        server = FakeServer([({"message": "Aucun bail pour cette box"}, 409), ({"flagged": True}, 202)])
+        journal = Journal(self.path, server, on_alarm=lambda action, payload, resp: alarms.append(action))
+        first = journal.record("deposit_open", deposit(1, "T1", password="111111"))
+        second = journal.record("deposit_open", deposit(2, "T2", password="222222"))
+        third = journal.record("deposit_close", deposit(2, "T2"))
+        journal.start()
+        self._drain(journal)
+        self.assertEqual(journal.get(first)["status"], "rejected")
+        self.assertEqual(journal.get(second)["status"], "sent")
+        self.assertEqual(journal.get(third)["status"], "sent")
+        self.assertEqual(alarms, ["deposit_open", "deposit_open"])
+        self.assertEqual(journal.alarms, 2)
+
+    def test_held_entry_waits_for_commit(self):
+        server = FakeServer()
+        journal = Journal(self.path, server)
+        journal.start()
+        held = journal.record("deposit_open", deposit(1, "T1", password="111111"), held=True)
+        later = journal.record("deposit_close", deposit(2, "T2"))
+        self._drain(journal)
+        self.assertEqual(server.calls, [("deposit_close", 2, "T2")])
+        self.assertEqual(journal.get(held)["status"], "held")
+        journal.commit(held)
+        self._drain(journal)
+        self.assertEqual(server.calls[-1], ("deposit_open", 1, "T1"))
+        self.assertEqual(journal.get(later)["status"], "sent")
+
+    def test_cancelled_entry_is_never_sent(self):
+        server = FakeServer()
+        journal = Journal(self.path, server)
+        journal.reserve_code(1, 101, "111111")
+        held = journal.record("deposit_open", deposit(1, "T1", password="111111"), held=True)
+        journal.cancel(held)
+        journal.start()
+        journal.record("withdraw_close", deposit(2, "T2"))
+        self._drain(journal)
+        self.assertEqual(server.calls, [("withdraw_close", 2, 102)])
+        self.assertIsNone(journal.reserved_code(1, 101))
+        with sqlite3.connect(self.path) as db:
+            self.assertIsNone(db.execute("SELECT 1 FROM journal WHERE id=?", (held,)).fetchone())
+
+    def test_held_entry_is_sent_after_restart(self):
+        Journal(self.path, FakeServer()).record("deposit_open", deposit(1, "T1", password="111111"), held=True)
+        server = FakeServer()
+        journal = Journal(self.path, server)
+        journal.start()
+        self._drain(journal)
+        self.assertEqual(server.calls, [("deposit_open", 1, "T1")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,266 @@
+"""
+Arduino virtuel sur un pseudo-terminal (pty), pour faire tourner le
+kiosque et les benchmarks sans matériel.
+
+    python virtual_arduino.py --link /tmp/ttyVIRT --latency 0.004 --jitter 0.002
+    SERIAL_PORT=/tmp/ttyVIRT python app.py
+
+Protocole: PING, STATUS, OPEN:<n>, READ:<n>, READALL (voir README).
+Chaque box a une porte (ouverte/fermée): OPEN:<n> la déverrouille et
+elle s'ouvre; avec --auto-close, elle se referme seule après ce délai
+(client simulé). Défauts injectables: réponse perdue, octets corrompus,
+ligne coupée en deux, Arduino figé, débranchement (le lien --link pointe
+ensuite vers un nouveau pty, comme une ré-énumération USB).
+"""
+import argparse
+import logging
+import os
+import random
+import select
+import threading
+import time
+import tty
+
+
+LOG = logging.getLogger(__name__)
+
+BOX_COUNT = 16
+RESERVED_BOX = 16
+
+
+class VirtualArduino:
+    def __init__(
+        self,
+        link: str = None,
+        latency: float = 0.002,
+        jitter: float = 0.0,
+        baud: int = 115200,
+        boot: float = 0.0,
+        drop: float = 0.0,
+        garble: float = 0.0,
+        split: float = 0.0,
+        hang: float = 0.0,
+        hang_for: float = 3.0,
+        auto_close: float = None,
+        bounce: int = 0,
+        events: bool = False,
+        seed: int = None,
+    ):
+        self.link = link
+        self.latency = latency
+        self.jitter = jitter
+        self.baud = baud
+        self.boot = boot
+        self.faults = {"drop": drop, "garble": garble, "split": split, "hang": hang}
+        self.hang_for = hang_for
+        self.auto_close = auto_close
+        self.bounce = bounce
+        self.events = events
+        self.random = random.Random(seed)
+        self.doors_open = {box: False for box in range(1, BOX_COUNT + 1)}
+        self.stats = {"commands": 0, "drop": 0, "garble": 0, "split": 0, "hang": 0, "unplug": 0}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._master = None
+        self._session = 0
+        self._stop = threading.Event()
+        self.path = None
+
+    def start(self) -> str:
+        """Créer le pty et lancer le thread; retourne le chemin à passer en SERIAL_PORT"""
+        self._plug()
+        return self.link or self.path
+
+    def stop(self):
+        self._stop.set()
+        self._unplug_fds()
+        if self.link and os.path.islink(self.link):
+            os.remove(self.link)
+
+    def unplug(self, downtime: float = 1.0):
+        """Débrancher: le pty disparaît, un nouveau apparaît après `downtime` (ré-énumération)"""
+        with self._lock:
+            self.stats["unplug"] += 1
+        self._unplug_fds()
+        if self.link and os.path.islink(self.link):
+            os.remove(self.link)
+        threading.Timer(downtime, self._plug).start()
+
+    # Porte manipulée par le client simulé
+    def set_door(self, box: int, is_open: bool):
+        with self._lock:
+            changed = self.doors_open[box] != is_open
+            self.doors_open[box] = is_open
+        if changed and self.events:
+            self._write(f"EVT:DOOR:{box}:{'OPEN' if is_open else 'CLOSED'}")
+
+    def close_door(self, box: int):
+        """Refermer, avec `bounce` rebonds du capteur (ouvert/fermé) avant de se stabiliser"""
+        for _ in range(self.bounce):
+            self.set_door(box, False)
+            time.sleep(0.02)
+            self.set_door(box, True)
+            time.sleep(0.02)
+        self.set_door(box, False)
+
+    def _plug(self):
+        if self._stop.is_set():
+            return
+        self._session += 1
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        self.path = os.ttyname(slave)
+        # Seul le kiosque garde le côté esclave ouvert: quand il ferme le port,
+        # la lecture échoue ici et la réouverture refait le reset (comme DTR)
+        os.close(slave)
+        self._master = master
+        if self.link:
+            if os.path.lexists(self.link):
+                os.remove(self.link)
+            os.symlink(self.path, self.link)
+        threading.Thread(target=self._run, args=(master, self._session), name="virtual-arduino", daemon=True).start()
+        LOG.info("Virtual Arduino on %s", self.link or self.path)
+
+    def _unplug_fds(self):
+        with self._write_lock:
+            master, self._master = self._master, None
+        if master is not None:
+            try:
+                os.close(master)
+            except OSError:
+                pass
+
+    def _run(self, master: int, session: int):
+        buf = b""
+        booted_at = None
+        while not self._stop.is_set() and self._session == session:
+            try:
+                ready, _, _ = select.select([master], [], [], 0.2)
+                if not ready or self._session != session:
+                    continue
+                data = os.read(master, 1024)
+            except (OSError, ValueError):
+                # Port fermé côté kiosque: la prochaine ouverture refait le reset (DTR)
+                booted_at = None
+                time.sleep(0.05)
+                continue
+            now = time.monotonic()
+            if booted_at is None:
+                booted_at = now + self.boot
+            if now < booted_at:
+                continue  # Bootloader: octets perdus
+            buf += data
+            while b"\n" in buf:
+                line, buf = buf.split(b"\n", 1)
+                self._handle(line.decode("utf-8", errors="replace").strip())
+
+    def _handle(self, command: str):
+        if not command:
+            return
+        with self._lock:
+            self.stats["commands"] += 1
+        fault = self._draw_fault()
+        if fault == "hang":
+            time.sleep(self.hang_for)
+            return
+        response = self._respond(command)
+        time.sleep(max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter)))
+        if fault == "drop":
+            return
+        if fault == "garble":
+            raw = bytearray(response.encode())
+            raw[self.random.randrange(len(raw))] ^= 0x5A
+            response = raw.decode("utf-8", errors="replace")
+        if fault == "split":
+            cut = max(1, len(response) // 2)
+            self._write(response[:cut], newline=False)
+            time.sleep(0.06)  # Plus long qu'une tranche de lecture du kiosque
+            self._write(response[cut:])
+            return
+        self._write(response)
+
+    def _draw_fault(self):
+        for name, rate in self.faults.items():
+            if rate and self.random.random() < rate:
+                with self._lock:
+                    self.stats[name] += 1
+                return name
+        return None
+
+    def _respond(self, command: str) -> str:
+        name, _, arg = command.upper().partition(":")
+        if name in ("PING", "STATUS"):
+            return "OK"
+        if name == "READALL":
+            with self._lock:
+                mask = sum(1 << (box - 1) for box, is_open in self.doors_open.items() if not is_open)
+            return f"STATE:{mask:04X}"
+        if name in ("OPEN", "READ"):
+            if not arg.isdigit() or not 1 <= int(arg) <= BOX_COUNT:
+                return "ERR:BAD_BOX"
+            box = int(arg)
+            if name == "READ":
+                with self._lock:
+                    return "OPEN" if self.doors_open[box] else "CLOSED"
+            if box == RESERVED_BOX:
+                return "ERR:RESERVED"
+            self.set_door(box, True)
+            if self.auto_close is not None:
+                threading.Timer(self.auto_close, self.close_door, args=(box,)).start()
+            return "OK"
+        return "ERR:UNKNOWN"
+
+    def _write(self, text: str, newline: bool = True):
+        data = (text + ("\n" if newline else "")).encode("utf-8", errors="replace")
+        # Durée de transmission à la vitesse du port (10 bits par octet)
+        time.sleep(len(data) * 10 / self.baud)
+        with self._write_lock:
+            master = self._master
+            if master is None:
+                return
+            try:
+                os.write(master, data)
+            except OSError:
+                pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--link", default="/tmp/ttyVIRT", help="Lien stable vers le pty (SERIAL_PORT)")
+    parser.add_argument("--latency", type=float, default=0.002, help="Secondes de traitement par commande")
+    parser.add_argument("--jitter", type=float, default=0.0, help="± secondes ajoutées à la latence")
+    parser.add_argument("--baud", type=int, default=115200)
+    parser.add_argument("--boot", type=float, default=1.5, help="Secondes de reset à l'ouverture du port")
+    parser.add_argument("--drop", type=float, default=0.0, help="Probabilité de ne pas répondre")
+    parser.add_argument("--garble", type=float, default=0.0, help="Probabilité de corrompre un octet")
+    parser.add_argument("--split", type=float, default=0.0, help="Probabilité de couper la réponse en deux")
+    parser.add_argument("--hang", type=float, default=0.0, help="Probabilité de se figer --hang-for secondes")
+    parser.add_argument("--hang-for", type=float, default=3.0)
+    parser.add_argument("--unplug-every", type=float, help="Débrancher toutes les N secondes (1 s débranché)")
+    parser.add_argument("--auto-close", type=float, help="Refermer la porte N secondes après OPEN")
+    parser.add_argument("--bounce", type=int, default=0, help="Rebonds du capteur à la fermeture")
+    parser.add_argument("--events", action="store_true", help="Envoyer EVT:DOOR:<n>:OPEN|CLOSED")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    device = VirtualArduino(
+        link=args.link, latency=args.latency, jitter=args.jitter, baud=args.baud, boot=args.boot,
+        drop=args.drop, garble=args.garble, split=args.split, hang=args.hang, hang_for=args.hang_for,
+        auto_close=args.auto_close, bounce=args.bounce, events=args.events, seed=args.seed,
+    )
+    print(device.start(), flush=True)
+    try:
+        while True:
+            time.sleep(args.unplug_every or 3600)
+            if args.unplug_every:
+                LOG.info("Unplugging (stats: %s)", device.stats)
+                device.unplug()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        device.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,469 @@
+import base64
+import heapq
+import itertools
+import json
+from datetime import date, datetime, timedelta, timezone
+from flask import Blueprint, Response, current_app, jsonify, request
+from allocator import get_allocator
+from database import (
+    MOVED_STATUS, get_db, get_pool, get_router, get_shard_dbs, locate_machine, provision_fleet, write_transaction,
+)
+from events import get_broker
+from export import ENCODERS, EXPORT_FORMATS, gzip_stream, iter_orders, merge_chunks
+from provisioning import parse_box_range, parse_manifest
+from rollups import DEFAULT_RANGE_DAYS, MAX_RANGE_DAYS
+from stale import RESET_STATUSES, publish_changes, reset_boxes
+
+
+bp = Blueprint("admin_api", __name__, url_prefix="/api/admin")
+
+ORDERS_PAGE_SIZE = 50
+ORDERS_MAX_PAGE_SIZE = 200
+
+
+def change_version(db) -> int:
+    return db.execute("SELECT version FROM change_counter WHERE id=1").fetchone()["version"]
+
+
+def _conditional(dbs: dict, build):
+    """
+    Réponse JSON avec ETag dérivé des compteurs de modifications des
+    shards lus ({shard: connexion}). Si le client a déjà cette version,
+    304 sans exécuter `build`.
+    """
+    etag = "v" + "-".join(
+        str(change_version(db)) if shard == 0 else f"{shard}.{change_version(db)}"
+        for shard, db in sorted(dbs.items())
+    )
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        resp = jsonify(build())
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+
+def encode_cursor(created_at: str, order_id: int) -> str:
+    raw = json.dumps([created_at, order_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor: str):
+    created_at, order_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    return str(created_at), int(order_id)
+
+
+@bp.route("/machines")
+def machines():
+    """
+    Liste des machines avec le nombre de boxes attribuables par statut
+    (tous les shards); les boxes réservées sont comptées à part.
+    """
+    dbs = get_shard_dbs(current_app)
+    sql = f"""
+        SELECT l.machine_id, l.name, l.location, l.status, b.status AS box_status, COUNT(b.id) AS count,
+               (SELECT count(*) FROM boxes r WHERE r.locker_id = l.id AND r.reserved = 1) AS reserved
+        FROM lockers l
+        LEFT JOIN boxes b ON b.locker_id = l.id AND b.reserved = 0
+        WHERE l.status != '{MOVED_STATUS}'
+        GROUP BY l.id, b.status
+        ORDER BY l.machine_id
+    """
+
+    def build():
+        result = {}
+        rows = heapq.merge(*(db.execute(sql) for db in dbs.values()), key=lambda r: r["machine_id"])
+        for row in rows:
+            machine = result.setdefault(row["machine_id"], {
+                "machineId": row["machine_id"],
+                "name": row["name"],
+                "location": row["location"],
+                "status": row["status"],
+                "boxes": {},
+                "reserved": row["reserved"],
+            })
+            if row["box_status"] is not None:
+                machine["boxes"][row["box_status"]] = row["count"]
+        return {"machines": list(result.values())}
+
+    return _conditional(dbs, build)
+
+
+@bp.route("/machines/<int:machine_id>/boxes")
+def machine_boxes(machine_id):
+    """Grille des boxes d'une machine"""
+    db, locker = locate_machine(current_app, machine_id)
+    if not locker:
+        return jsonify({"message": "Machine non trouvée"}), 404
+
+    def build():
+        boxes = db.execute(
+            "SELECT id, box_number, status, size, reserved FROM boxes WHERE locker_id=? ORDER BY box_number",
+            (locker["id"],),
+        ).fetchall()
+        return {
+            "machineId": locker["machine_id"],
+            "name": locker["name"],
+            "boxes": [
+                {
+                    "id": b["id"],
+                    "number": b["box_number"],
+                    "status": b["status"],
+                    "size": b["size"],
+                    "reserved": bool(b["reserved"]),
+                }
+                for b in boxes
+            ],
+        }
+
+    return _conditional({get_router(current_app).shard_for(machine_id): db}, build)
+
+
+def _report_range(period: str):
+    """
+    Dates ?from=&to= (AAAA-MM-JJ, UTC, bornes incluses) d'un rapport.
+    Par défaut les derniers jours jusqu'à aujourd'hui. ValueError si la
+    période est invalide ou dépasse MAX_RANGE_DAYS.
+    """
+    if period not in MAX_RANGE_DAYS:
+        raise ValueError("period")
+    to = date.fromisoformat(request.args["to"]) if request.args.get("to") else datetime.now(timezone.utc).date()
+    if request.args.get("from"):
+        start = date.fromisoformat(request.args["from"])
+    else:
+        start = to - timedelta(days=DEFAULT_RANGE_DAYS[period] - 1)
+    if start > to or (to - start).days >= MAX_RANGE_DAYS[period]:
+        raise ValueError("range")
+    return start, to
+
+
+def _dwell(count: int, seconds: int):
+    return round(seconds / count) if count else None
+
+
+@bp.route("/machines/<int:machine_id>/rollups")
+def machine_rollups(machine_id):
+    """
+    Activité d'une machine par heure ou par jour (?period=hour|day,
+    from, to), lue uniquement dans order_rollups. Les intervalles sans
+    activité sont absents: l'occupation y est celle de l'intervalle
+    précédent (occupiedAtStart avant le premier).
+    """
+    period = request.args.get("period", "hour")
+    try:
+        start, to = _report_range(period)
+    except ValueError:
+        return jsonify({
+            "message": "Paramètres invalides (period: hour ou day; au plus "
+            f"{MAX_RANGE_DAYS['hour']} jours par heure, {MAX_RANGE_DAYS['day']} par jour)"
+        }), 400
+    db, locker = locate_machine(current_app, machine_id)
+    if not locker:
+        return jsonify({"message": "Machine non trouvée"}), 404
+    # Bornes au format des buckets: 'AAAA-MM-JJ' < 'AAAA-MM-JJ HH:00:00' < lendemain
+    low, high = start.isoformat(), (to + timedelta(days=1)).isoformat()
+
+    def build():
+        before = db.execute(
+            """
+            SELECT occupied_last FROM order_rollups
+            WHERE locker_id=? AND period=? AND bucket < ?
+            ORDER BY bucket DESC
+            LIMIT 1
+            """,
+            (locker["id"], period, low),
+        ).fetchone()
+        rows = db.execute(
+            """
+            SELECT bucket, deposits, withdrawals, cancelled, dwell_count, dwell_seconds, occupied_last, occupied_peak
+            FROM order_rollups
+            WHERE locker_id=? AND period=? AND bucket >= ? AND bucket < ?
+            ORDER BY bucket
+            """,
+            (locker["id"], period, low, high),
+        ).fetchall()
+        buckets = [
+            {
+                "bucket": r["bucket"],
+                "deposits": r["deposits"],
+                "withdrawals": r["withdrawals"],
+                "cancelled": r["cancelled"],
+                "avgDwellSeconds": _dwell(r["dwell_count"], r["dwell_seconds"]),
+                "occupied": r["occupied_last"],
+                "occupiedPeak": r["occupied_peak"],
+            }
+            for r in rows
+        ]
+        busiest = max(rows, key=lambda r: r["deposits"] + r["withdrawals"], default=None)
+        return {
+            "machineId": locker["machine_id"],
+            "period": period,
+            "from": start.isoformat(),
+            "to": to.isoformat(),
+            "occupiedAtStart": before["occupied_last"] if before else 0,
+            "buckets": buckets,
+            "totals": {
+                "deposits": sum(r["deposits"] for r in rows),
+                "withdrawals": sum(r["withdrawals"] for r in rows),
+                "cancelled": sum(r["cancelled"] for r in rows),
+                "avgDwellSeconds": _dwell(sum(r["dwell_count"] for r in rows), sum(r["dwell_seconds"] for r in rows)),
+                "occupiedPeak": max((r["occupied_peak"] for r in rows), default=None),
+            },
+            "peak": {
+                "bucket": busiest["bucket"],
+                "load": busiest["deposits"] + busiest["withdrawals"],
+            } if busiest else None,
+        }
+
+    return _conditional({get_router(current_app).shard_for(machine_id): db}, build)
+
+
+@bp.route("/reports/machines")
+def machines_report():
+    """
+    Synthèse par machine sur ?from=&to= (jours), pour le dimensionnement:
+    activité, séjour moyen, occupation maximale rapportée aux boxes
+    attribuables. Lue dans les agrégats journaliers de chaque shard.
+    """
+    try:
+        start, to = _report_range("day")
+    except ValueError:
+        return jsonify({"message": f"Paramètres invalides (au plus {MAX_RANGE_DAYS['day']} jours)"}), 400
+    dbs = get_shard_dbs(current_app)
+    sql = """
+        SELECT l.machine_id, l.name,
+               (SELECT count(*) FROM boxes b WHERE b.locker_id = l.id AND b.reserved = 0) AS boxes,
+               sum(r.deposits) AS deposits, sum(r.withdrawals) AS withdrawals, sum(r.cancelled) AS cancelled,
+               sum(r.dwell_count) AS dwell_count, sum(r.dwell_seconds) AS dwell_seconds,
+               max(r.occupied_peak) AS occupied_peak
+        FROM lockers l
+        JOIN order_rollups r ON r.locker_id = l.id AND r.period = 'day' AND r.bucket BETWEEN ? AND ?
+        GROUP BY l.id
+        ORDER BY l.machine_id
+    """
+
+    def build():
+        params = (start.isoformat(), to.isoformat())
+        rows = heapq.merge(*(db.execute(sql, params) for db in dbs.values()), key=lambda r: r["machine_id"])
+        return {
+            "from": start.isoformat(),
+            "to": to.isoformat(),
+            "machines": [
+                {
+                    "machineId": r["machine_id"],
+                    "name": r["name"],
+                    "boxes": r["boxes"],
+                    "deposits": r["deposits"],
+                    "withdrawals": r["withdrawals"],
+                    "cancelled": r["cancelled"],
+                    "avgDwellSeconds": _dwell(r["dwell_count"], r["dwell_seconds"]),
+                    "occupiedPeak": r["occupied_peak"],
+                    "peakUtilisation": round(r["occupied_peak"] / r["boxes"], 3) if r["boxes"] else None,
+                }
+                for r in rows
+            ],
+        }
+
+    return _conditional(dbs, build)
+
+
+@bp.route("/machines/provision", methods=["POST"])
+def provision():
+    """
+    Créer ou mettre à jour des machines depuis un manifeste JSON
+    ({"machines": [...]} ou liste) ou CSV (Content-Type: text/csv).
+    Idempotent sur machineId, appliqué en une transaction par shard.
+    """
+    fmt = "csv" if request.mimetype == "text/csv" else "json"
+    try:
+        machines = parse_manifest(request.get_data(as_text=True), fmt)
+    except ValueError as exc:
+        return jsonify({"message": str(exc)}), 400
+
+    result = provision_fleet(current_app, machines)
+    # Tailles et réservations ont pu changer: index rechargés à la demande
+    get_allocator(current_app).invalidate()
+    return jsonify(result)
+
+
+@bp.route("/boxes/reset", methods=["POST"])
+def reset_boxes_bulk():
+    """
+    Reset groupé en une transaction: {"machineId": 1, "boxes": [1, 2] ou "1-5,8"}.
+    Sans "boxes": toutes les boxes de la machine dont le statut est dans
+    "statuses" (défaut: deposit_open, withdraw_open, stuck). Les boxes
+    réservées ne sont jamais touchées.
+    """
+    data = request.get_json(silent=True) or {}
+    try:
+        machine_id = int(data["machineId"])
+        boxes = data.get("boxes")
+        numbers = None
+        if boxes is not None:
+            numbers = [int(n) for n in boxes] if isinstance(boxes, list) else parse_box_range(boxes)
+        statuses = [str(s) for s in data.get("statuses") or RESET_STATUSES]
+    except (KeyError, ValueError, TypeError):
+        return jsonify({"message": "Paramètres invalides"}), 400
+
+    db, locker = locate_machine(current_app, machine_id)
+    if not locker:
+        return jsonify({"message": "Machine non trouvée"}), 404
+    with write_transaction(db):
+        if numbers is not None:
+            rows = db.execute(
+                """
+                SELECT id FROM boxes
+                WHERE locker_id=? AND reserved=0 AND box_number IN (SELECT value FROM json_each(?))
+                """,
+                (locker["id"], json.dumps(numbers)),
+            ).fetchall()
+        else:
+            rows = db.execute(
+                """
+                SELECT id FROM boxes
+                WHERE locker_id=? AND reserved=0 AND status IN (SELECT value FROM json_each(?))
+                """,
+                (locker["id"], json.dumps(statuses)),
+            ).fetchall()
+        changes = reset_boxes(db, [r["id"] for r in rows])
+    if changes:
+        get_allocator(current_app).invalidate(locker["id"])
+        publish_changes(get_broker(current_app), changes)
+    return jsonify({
+        "machineId": machine_id,
+        "reset": sorted(c["boxNumber"] for c in changes),
+        "cancelledOrders": sum(len(c["orders"]) for c in changes),
+    })
+
+
+def _order_filters(args, by_created_at: bool = False):
+    """
+    Conditions SQL sur orders_history des filtres machine, status, type et
+    from / to (dates de création AAAA-MM-JJ, UTC, incluses). Avec
+    `by_created_at`, les colonnes filtrées sont préfixées de '+': l'index
+    created_at reste celui du parcours (export par keyset) même quand un
+    index sur status est plus sélectif. ValueError si un filtre est invalide.
+    """
+    clauses, params = [], []
+    plus = "+" if by_created_at else ""
+    if args.get("status"):
+        clauses.append(f"{plus}status = ?")
+        params.append(args["status"])
+    if args.get("type"):
+        clauses.append(f"{plus}order_type = ?")
+        params.append(args["type"])
+    if args.get("machine"):
+        clauses.append(f"{plus}locker_id = (SELECT id FROM lockers WHERE machine_id = ?)")
+        params.append(int(args["machine"]))
+    if args.get("from"):
+        clauses.append("created_at >= ?")
+        params.append(date.fromisoformat(args["from"]).isoformat())
+    if args.get("to"):
+        clauses.append("created_at < ?")
+        params.append((date.fromisoformat(args["to"]) + timedelta(days=1)).isoformat())
+    return clauses, params
+
+
+def _order_shards(args) -> list:
+    """Shards lus pour les filtres de commandes: celui de la machine filtrée, sinon tous"""
+    router = get_router(current_app)
+    return [router.shard_for(int(args["machine"]))] if args.get("machine") else list(router.shards())
+
+
+def _order_key(row):
+    return row["created_at"], row["id"]
+
+
+@bp.route("/orders")
+def orders():
+    """
+    Historique des commandes (chaud + archive), du plus récent au plus ancien.
+    Pagination par curseur (created_at, id): ?cursor=<nextCursor>&limit=50
+    Filtres: status, type, machine, from, to. Avec plusieurs shards, chaque
+    shard donne sa page et les pages sont fusionnées (ids uniques entre shards).
+    """
+    try:
+        limit = min(int(request.args.get("limit", ORDERS_PAGE_SIZE)), ORDERS_MAX_PAGE_SIZE)
+        cursor = request.args.get("cursor")
+        after = decode_cursor(cursor) if cursor else None
+        clauses, params = _order_filters(request.args)
+    except (ValueError, TypeError):
+        return jsonify({"message": "Paramètres invalides"}), 400
+    if limit < 1:
+        return jsonify({"message": "Paramètres invalides"}), 400
+
+    if after is not None:
+        clauses.append("(created_at, id) < (?, ?)")
+        params.extend(after)
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+    dbs = {shard: get_db(current_app, shard) for shard in _order_shards(request.args)}
+    sql = f"""
+        SELECT o.id, l.machine_id, b.box_number, o.closet_id, o.tracking_code,
+               o.password, o.order_type, o.status, o.created_at, o.updated_at
+        FROM (
+            SELECT * FROM orders_history {where}
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        ) o
+        JOIN lockers l ON o.locker_id = l.id
+        JOIN boxes b ON o.box_id = b.id
+        ORDER BY o.created_at DESC, o.id DESC
+    """
+
+    def build():
+        pages = (db.execute(sql, (*params, limit)) for db in dbs.values())
+        rows = list(itertools.islice(heapq.merge(*pages, key=_order_key, reverse=True), limit))
+        items = [
+            {
+                "id": r["id"],
+                "machineId": r["machine_id"],
+                "boxNumber": r["box_number"],
+                "closetId": r["closet_id"],
+                "trackingCode": r["tracking_code"],
+                "password": r["password"],
+                "type": r["order_type"],
+                "status": r["status"],
+                "createdAt": r["created_at"],
+                "updatedAt": r["updated_at"],
+            }
+            for r in rows
+        ]
+        next_cursor = encode_cursor(rows[-1]["created_at"], rows[-1]["id"]) if len(rows) == limit else None
+        return {"orders": items, "nextCursor": next_cursor}
+
+    return _conditional(dbs, build)
+
+
+@bp.route("/orders/export")
+def orders_export():
+    """
+    Export de l'historique des commandes (chaud + archive), du plus ancien
+    au plus récent: ?format=csv|ndjson&gzip=1 et les filtres de /orders.
+    Les lignes sont lues par lots et envoyées au fil de l'eau: la mémoire
+    ne dépend pas de la taille de l'export. Les shards sont lus tour à
+    tour, lot par lot, et fusionnés dans l'ordre chronologique.
+    """
+    fmt = request.args.get("format", "csv")
+    try:
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(fmt)
+        clauses, params = _order_filters(request.args, by_created_at=True)
+    except (ValueError, TypeError):
+        return jsonify({"message": "Paramètres invalides (format: csv ou ndjson)"}), 400
+
+    streams = [iter_orders(get_pool(current_app, shard), clauses, params) for shard in _order_shards(request.args)]
+    body = ENCODERS[fmt](streams[0] if len(streams) == 1 else merge_chunks(streams, _order_key))
+    filename = f"orders-{datetime.now(timezone.utc):%Y%m%d-%H%M%S}.{fmt}"
+    mimetype = EXPORT_FORMATS[fmt]
+    if request.args.get("gzip") == "1":
+        body, filename, mimetype = gzip_stream(body), filename + ".gz", "application/gzip"
+    return Response(
+        body,
+        mimetype=mimetype,
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "Cache-Control": "no-store",
+            "X-Accel-Buffering": "no",
+        },
+    )
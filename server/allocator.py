@@ -0,0 +1,183 @@
+import threading
+import time
+
+
+SIZE_CLASSES = ("S", "M", "L")  # Du plus petit au plus grand
+RELOAD_INTERVAL = 1.0  # Secondes entre deux lectures de la version des boxes d'une machine
+
+
+def _lowest_bit(mask: int) -> int:
+    return (mask & -mask).bit_length() - 1
+
+
+class LockerIndex:
+    """
+    Boxes libres d'une machine: un bitmap par classe de taille
+    (bit n = box n disponible).
+    """
+
+    def __init__(self, version: int = None, cursor: int = 0):
+        self.free = {size: 0 for size in SIZE_CLASSES}
+        self.box_ids = {}
+        self.sizes = {}
+        self.cursor = cursor  # Dernière box attribuée (round-robin)
+        self.version = version  # lockers.box_version au chargement
+        self.checked_at = time.monotonic()
+
+    def add(self, box_id: int, box_number: int, size: str, available: bool):
+        self.box_ids[box_number] = box_id
+        self.sizes[box_number] = size
+        if available:
+            self.free[size] |= 1 << box_number
+
+    def take(self, box_number: int):
+        self.free[self.sizes[box_number]] &= ~(1 << box_number)
+        self.cursor = box_number
+
+    def release(self, box_number: int):
+        size = self.sizes.get(box_number)
+        if size is not None:
+            self.free[size] |= 1 << box_number
+
+    def mask(self, sizes) -> int:
+        m = 0
+        for size in sizes:
+            m |= self.free[size]
+        return m
+
+
+def lowest_first(index: LockerIndex, sizes):
+    """Plus petit numéro de box libre (comportement historique)"""
+    m = index.mask(sizes)
+    return _lowest_bit(m) if m else None
+
+
+def round_robin(index: LockerIndex, sizes):
+    """Première box libre après la dernière attribuée: répartit l'usure des relais"""
+    m = index.mask(sizes)
+    if not m:
+        return None
+    after = m & ~((1 << (index.cursor + 1)) - 1)
+    return _lowest_bit(after or m)
+
+
+def best_fit(index: LockerIndex, sizes):
+    """Plus petite classe de taille suffisante, puis plus petit numéro"""
+    for size in sizes:
+        m = index.free[size]
+        if m:
+            return _lowest_bit(m)
+    return None
+
+
+POLICIES = {
+    "lowest": lowest_first,
+    "round_robin": round_robin,
+    "best_fit": best_fit,
+}
+
+
+def _box_version(db, locker_id: int) -> int:
+    row = db.execute("SELECT box_version FROM lockers WHERE id=?", (locker_id,)).fetchone()
+    return row[0] if row else None
+
+
+def sizes_fitting(size: str):
+    """Classes de taille pouvant accueillir un colis de taille `size`"""
+    return SIZE_CLASSES[SIZE_CLASSES.index(size):]
+
+
+class BoxAllocator:
+    """
+    Index en mémoire des boxes libres, par machine, écrit en direct dans SQLite.
+
+    L'attribution choisit la box dans le bitmap puis la réserve avec un
+    UPDATE conditionnel sur status='available': si un autre processus l'a
+    prise entre-temps, la box est retirée de l'index et on passe à la
+    suivante. Quand l'index d'une machine est vide, il est rechargé depuis
+    la base avant de conclure qu'aucune box n'est libre.
+
+    Chaque worker gunicorn a son propre index: une box libérée ou
+    redimensionnée par un autre processus (autre worker, manage.py
+    box-size) n'y apparaît pas d'elle-même. Au plus une fois par
+    `reload_interval` et par machine, la version des boxes de la machine
+    (lockers.box_version, tenue par triggers) est relue et l'index
+    rechargé si elle a bougé. Elle ne change que pour une box redevenue
+    libre, une taille ou une réserve modifiée: les attributions, les
+    écritures sur les autres machines et les autres tables ne provoquent
+    aucun rechargement.
+    """
+
+    def __init__(self, policy: str = "lowest", reload_interval: float = RELOAD_INTERVAL):
+        if policy not in POLICIES:
+            raise ValueError(f"Politique d'attribution inconnue: {policy}")
+        self.policy_name = policy
+        self._policy = POLICIES[policy]
+        self.reload_interval = reload_interval
+        self._lockers = {}
+        self._lock = threading.Lock()
+
+    def _fresh(self, db, locker_id: int):
+        """Index de la machine, rechargé si ses boxes ont changé depuis (version relue au plus une fois par intervalle)"""
+        index = self._lockers.get(locker_id)
+        if index is None or time.monotonic() - index.checked_at < self.reload_interval:
+            return index
+        if _box_version(db, locker_id) != index.version:
+            return self._load(db, locker_id, index.cursor)
+        index.checked_at = time.monotonic()
+        return index
+
+    def _load(self, db, locker_id: int, cursor: int = 0) -> LockerIndex:
+        index = LockerIndex(_box_version(db, locker_id), cursor)
+        rows = db.execute(
+            "SELECT id, box_number, size, status FROM boxes WHERE locker_id=? AND reserved=0",
+            (locker_id,),
+        ).fetchall()
+        for row in rows:
+            index.add(row["id"], row["box_number"], row["size"], row["status"] == "available")
+        self._lockers[locker_id] = index
+        return index
+
+    def claim(self, db, locker_id: int, size: str = SIZE_CLASSES[0], status: str = "deposit_open"):
+        """
+        Réserver une box (passée à `status`) pour un colis de taille `size`.
+        À appeler dans une transaction d'écriture. Retourne un dict
+        {id, box_number, size} ou None si aucune box ne convient.
+        """
+        sizes = sizes_fitting(size)
+        with self._lock:
+            index = self._fresh(db, locker_id)
+            for attempt in range(2):
+                if index is None or attempt:
+                    index = self._load(db, locker_id, index.cursor if index else 0)
+                number = self._policy(index, sizes)
+                while number is not None:
+                    index.take(number)
+                    box_id = index.box_ids[number]
+                    cur = db.execute(
+                        "UPDATE boxes SET status=? WHERE id=? AND status='available'",
+                        (status, box_id),
+                    )
+                    if cur.rowcount == 1:
+                        return {"id": box_id, "box_number": number, "size": index.sizes[number]}
+                    number = self._policy(index, sizes)
+        return None
+
+    def release(self, locker_id: int, box_number: int):
+        """La box est de nouveau disponible (transaction déjà validée)"""
+        with self._lock:
+            index = self._lockers.get(locker_id)
+            if index is not None:
+                index.release(box_number)
+
+    def invalidate(self, locker_id: int = None):
+        """Oublier l'index d'une machine (ou de toutes): rechargé à la prochaine attribution"""
+        with self._lock:
+            if locker_id is None:
+                self._lockers.clear()
+            else:
+                self._lockers.pop(locker_id, None)
+
+
+def get_allocator(app) -> BoxAllocator:
+    return app.extensions["smartlock_allocator"]
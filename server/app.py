@@ -1,6 +1,14 @@
 from flask import Flask
 from routes import bp as routes_bp
-from database import init_db
+from admin_api import bp as admin_api_bp
+from events import MAX_CLIENTS as SSE_MAX_CLIENTS, EventBroker, bp as events_bp, events_path
+from database import connect, get_router, init_db, shard_of_id
+from allocator import BoxAllocator
+from codes import CodePool
+from leases import LeaseReaper
+from stale import STALE_AFTER, StaleReaper, publish_changes
+from telemetry import TelemetryWriter, bp as telemetry_bp
+import metrics
 import os
 
 
@@ -8,12 +16,71 @@ def create_app():
     app = Flask(__name__)
     app.config["DATABASE_PATH"] = os.environ.get("SMART_LOCK_DB", os.path.join(os.path.dirname(__file__), "smartlock.db"))
 
+    # Répartition des machines entre SMART_LOCK_SHARDS bases SQLite (shard 0:
+    # SMART_LOCK_DB, puis smartlock-1.db, ...), un verrou d'écriture chacune
+    app.config["DATABASE_SHARDS"] = max(1, int(os.environ.get("SMART_LOCK_SHARDS", "1")))
+
+    # Politique d'attribution des boxes: lowest, round_robin ou best_fit
+    app.config["BOX_ALLOCATION_POLICY"] = os.environ.get("SMART_LOCK_ALLOC_POLICY", "lowest")
+
+    # Métriques Prometheus sur /metrics (SMART_LOCK_METRICS=0 pour désactiver).
+    # Avant init_db: les connexions du pool sont alors instrumentées
+    app.config["METRICS_ENABLED"] = os.environ.get("SMART_LOCK_METRICS", "1") != "0"
+    if app.config["METRICS_ENABLED"]:
+        metrics.init_app(app)
     init_db(app)
+    paths = get_router(app).paths
+    app.extensions["smartlock_allocator"] = BoxAllocator(app.config["BOX_ALLOCATION_POLICY"])
+
+    # Réserves de codes uniques, rechargées par un thread de fond démarré au
+    # premier tirage (dans chaque worker, pas dans le processus qui précharge)
+    app.extensions["smartlock_codes"] = CodePool(lambda shard: connect(paths[shard]), shard_of_id)
+    # Événements SSE: journal partagé par les workers, SMART_LOCK_SSE_CLIENTS flux par worker
+    app.config["SSE_MAX_CLIENTS"] = int(os.environ.get("SMART_LOCK_SSE_CLIENTS", SSE_MAX_CLIENTS))
+    app.extensions["smartlock_events"] = EventBroker(
+        events_path(app.config["DATABASE_PATH"]), max_clients=app.config["SSE_MAX_CLIENTS"]
+    )
+
+    # Reprise des baux de boxes expirés: un thread par shard et par processus, lancé à la première requête
+    app.extensions["smartlock_leases"] = [
+        LeaseReaper(lambda path=path: connect(path), app.extensions["smartlock_allocator"].invalidate)
+        for path in paths
+    ]
+    for reaper in app.extensions["smartlock_leases"]:
+        app.before_request(reaper.start)
+
+    # Ouvertures sans fermeture confirmée (kiosque planté ou hors ligne):
+    # traitées après SMART_LOCK_STALE_AFTER secondes (0 pour désactiver)
+    app.config["STALE_AFTER"] = int(os.environ.get("SMART_LOCK_STALE_AFTER", STALE_AFTER))
+    if app.config["STALE_AFTER"] > 0:
+        def stale_changes(changes):
+            for locker_id in {c["lockerId"] for c in changes}:
+                app.extensions["smartlock_allocator"].invalidate(locker_id)
+            publish_changes(app.extensions["smartlock_events"], changes)
+            for change in changes:
+                metrics.inc(app, "smartlock_stale_boxes_total", (("status", change["status"]),))
+
+        app.extensions["smartlock_stale"] = [
+            StaleReaper(lambda path=path: connect(path), stale_changes, app.config["STALE_AFTER"])
+            for path in paths
+        ]
+        for stale in app.extensions["smartlock_stale"]:
+            app.before_request(stale.start)
+
+    # Télémétrie des kiosques: écrite par lots, hors des requêtes, dans le shard de chaque machine
+    app.extensions["smartlock_telemetry"] = [
+        TelemetryWriter(lambda path=path: connect(path), app.extensions.get("smartlock_metrics"))
+        for path in paths
+    ]
     app.register_blueprint(routes_bp)
+    app.register_blueprint(admin_api_bp)
+    app.register_blueprint(events_bp)
+    app.register_blueprint(telemetry_bp)
     return app
 
 
 if __name__ == "__main__":
+    # Serveur de développement; en production: gunicorn -c gunicorn.conf.py wsgi:app
     app = create_app()
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    app.run(host="0.0.0.0", port=5000, debug=os.environ.get("SMART_LOCK_DEBUG") == "1")
 
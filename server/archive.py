@@ -0,0 +1,52 @@
+import time
+
+from database import write_transaction
+
+
+TERMINAL_STATUSES = ("withdrawn", "cancelled")
+ORDER_COLUMNS = (
+    "id, locker_id, box_id, closet_id, tracking_code, password, "
+    "order_type, status, created_at, updated_at, closed_at"
+)
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_PAUSE = 0.05  # Secondes entre deux lots: laisse passer les requêtes kiosque
+
+
+def archive_orders(db, older_than_days: int, batch_size: int = ARCHIVE_BATCH_SIZE, pause: float = ARCHIVE_PAUSE):
+    """
+    Déplacer vers orders_archive les commandes terminées (retirées ou
+    annulées) depuis plus de `older_than_days` jours.
+
+    Chaque lot est une transaction courte; le verrou d'écriture est relâché
+    entre deux lots. Retourne le nombre de commandes archivées.
+    """
+    placeholders = ", ".join("?" for _ in TERMINAL_STATUSES)
+    cutoff = f"-{int(older_than_days)} days"
+    total = 0
+    while True:
+        with write_transaction(db):
+            ids = [
+                row["id"]
+                for row in db.execute(
+                    f"""
+                    SELECT id FROM orders
+                    WHERE status IN ({placeholders}) AND updated_at < datetime('now', ?)
+                    LIMIT ?
+                    """,
+                    (*TERMINAL_STATUSES, cutoff, batch_size),
+                )
+            ]
+            if ids:
+                id_list = ", ".join("?" for _ in ids)
+                db.execute(
+                    f"""
+                    INSERT INTO orders_archive ({ORDER_COLUMNS})
+                    SELECT {ORDER_COLUMNS} FROM orders WHERE id IN ({id_list})
+                    """,
+                    ids,
+                )
+                db.execute(f"DELETE FROM orders WHERE id IN ({id_list})", ids)
+        total += len(ids)
+        if len(ids) < batch_size:
+            return total
+        time.sleep(pause)
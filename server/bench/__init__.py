@@ -0,0 +1,10 @@
+"""
+Générateur de charge et mesure de latence de l'API kiosque.
+
+    cd server
+    python -m bench --machines 50 --concurrency 8 --duration 10
+    python -m bench --url http://localhost:5000 --mix cycle=6,deposit=2,withdraw=2,dashboard=1
+
+Le rapport JSON (débit, p50/p95/p99 par endpoint) est écrit sur la sortie
+standard ou dans --out, pour comparer des exécutions entre commits.
+"""
@@ -0,0 +1,75 @@
+import argparse
+import json
+import sys
+
+from bench.driver import Driver, git_revision, parse_mix
+from bench.targets import HttpTarget, InProcessTarget
+
+
+def provision_fleet(target, first_machine_id: int, machines: int, boxes: int):
+    """Créer la flotte simulée via l'API de provisioning (idempotent)"""
+    manifest = {
+        "machines": [
+            {"machineId": first_machine_id + i, "name": f"Bench {i}", "boxCount": boxes}
+            for i in range(machines)
+        ]
+    }
+    status, data = target.request("POST", "/api/admin/machines/provision", manifest)
+    if status != 200:
+        raise SystemExit(f"Provisioning impossible ({status}): {data}")
+    return [first_machine_id + i for i in range(machines)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Benchmark de l'API Smart Locker")
+    parser.add_argument("--url", help="Serveur à tester en HTTP (défaut: application en mémoire)")
+    parser.add_argument("--db", help="Base SQLite du mode en mémoire (défaut: fichier temporaire)")
+    parser.add_argument("--machines", type=int, default=20)
+    parser.add_argument("--boxes", type=int, default=16)
+    parser.add_argument("--first-machine-id", type=int, default=100000,
+                        help="Les machines simulées sont numérotées à partir de cet ID")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10.0, help="Secondes de mesure")
+    parser.add_argument("--warmup", type=float, default=1.0, help="Secondes de chauffe non mesurées")
+    parser.add_argument("--mix", default="cycle=1", help="Poids des scénarios, ex: cycle=6,deposit=2,withdraw=2")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--out", help="Fichier JSON du rapport (défaut: sortie standard)")
+    args = parser.parse_args(argv)
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    target = HttpTarget(args.url) if args.url else InProcessTarget(args.db)
+    try:
+        machine_ids = provision_fleet(target, args.first_machine_id, args.machines, args.boxes)
+        if args.warmup > 0:
+            Driver(target, machine_ids, mix, args.seed).run(args.concurrency, args.warmup)
+        result = Driver(target, machine_ids, mix, args.seed).run(args.concurrency, args.duration)
+    finally:
+        target.close()
+
+    report = {
+        "revision": git_revision(),
+        "target": args.url or target.name,
+        "config": {
+            "machines": args.machines,
+            "boxes": args.boxes,
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "mix": mix,
+        },
+        **result,
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,143 @@
+"""
+Coût d'une attribution de box: politiques de l'allocateur contre la requête SQL d'origine.
+
+    python -m bench.allocator --machines 1000 --occupied 10 --cycles 20000
+
+Sur une base temporaire neuve, chaque cycle réserve une box d'une machine
+tirée au hasard puis la libère. "sql" est l'ancienne attribution (UPDATE
+sur la première box libre trouvée par SELECT ... ORDER BY box_number
+LIMIT 1), les autres passent par BoxAllocator avec la politique donnée.
+Les cycles sont regroupés par transactions de --batch (1: un commit par
+cycle, coût d'écriture compris).
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from allocator import POLICIES, SIZE_CLASSES, BoxAllocator
+from app import create_app
+from bench.driver import git_revision
+from database import get_db, write_transaction
+from provisioning import normalize_machine, provision_machines
+
+SQL_CLAIM = """
+    UPDATE boxes SET status='deposit_open'
+    WHERE id = (
+        SELECT id FROM boxes
+        WHERE locker_id=? AND status='available' AND reserved=0
+        ORDER BY box_number
+        LIMIT 1
+    )
+    RETURNING id, box_number
+"""
+
+
+def build_fleet(db, machines: int, boxes: int, occupied: int, rng) -> list:
+    """Machines 1..machines avec `occupied` boxes occupées chacune; retourne les IDs des lockers"""
+    with write_transaction(db):
+        provision_machines(db, [
+            normalize_machine({"machineId": 1 + i, "name": f"Bench {i}", "boxCount": boxes})
+            for i in range(machines)
+        ])
+        lockers = [row["id"] for row in db.execute("SELECT id FROM lockers ORDER BY id")]
+        for locker_id in lockers:
+            numbers = [
+                row["box_number"]
+                for row in db.execute("SELECT box_number FROM boxes WHERE locker_id=? AND reserved=0", (locker_id,))
+            ]
+            for number in rng.sample(numbers, min(occupied, len(numbers))):
+                db.execute(
+                    "UPDATE boxes SET status='occupied' WHERE locker_id=? AND box_number=?", (locker_id, number)
+                )
+    return lockers
+
+
+def sql_cycle(db, allocator, locker_id: int):
+    row = db.execute(SQL_CLAIM, (locker_id,)).fetchone()
+    if row is not None:
+        db.execute("UPDATE boxes SET status='available' WHERE id=?", (row["id"],))
+
+
+def allocator_cycle(db, allocator, locker_id: int):
+    box = allocator.claim(db, locker_id, SIZE_CLASSES[0])
+    if box is not None:
+        db.execute("UPDATE boxes SET status='available' WHERE id=?", (box["id"],))
+        allocator.release(locker_id, box["box_number"])
+
+
+def run(db, cycle, allocator, lockers, cycles: int, batch: int, seed) -> float:
+    """Secondes pour `cycles` cycles réserver + libérer"""
+    rng = random.Random(seed)
+    targets = [rng.choice(lockers) for _ in range(cycles)]
+    start = time.perf_counter()
+    for first in range(0, cycles, batch):
+        with write_transaction(db):
+            for locker_id in targets[first:first + batch]:
+                cycle(db, allocator, locker_id)
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.allocator", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--policies", default=",".join(["sql", *POLICIES]), help="sql et/ou politiques de l'allocateur")
+    parser.add_argument("--machines", type=int, default=1000)
+    parser.add_argument("--boxes", type=int, default=16)
+    parser.add_argument("--occupied", type=int, default=10, help="Boxes occupées par machine")
+    parser.add_argument("--cycles", type=int, default=20000)
+    parser.add_argument("--batch", type=int, default=1000, help="Cycles par transaction")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="Fichier JSON du rapport (défaut: sortie standard)")
+    args = parser.parse_args(argv)
+
+    names = args.policies.split(",")
+    unknown = [name for name in names if name != "sql" and name not in POLICIES]
+    if unknown:
+        parser.error(f"Politique inconnue: {', '.join(unknown)}")
+
+    with tempfile.TemporaryDirectory(prefix="smartlock-alloc-") as tmpdir:
+        os.environ["SMART_LOCK_DB"] = os.path.join(tmpdir, "bench.db")
+        os.environ["SMART_LOCK_METRICS"] = "0"  # Connexions non instrumentées: seul le coût SQL est mesuré
+        app = create_app()
+        with app.app_context():
+            db = get_db(app)
+            lockers = build_fleet(db, args.machines, args.boxes, args.occupied, random.Random(args.seed))
+            runs = []
+            for name in names:
+                allocator = None if name == "sql" else BoxAllocator(name)
+                cycle = sql_cycle if name == "sql" else allocator_cycle
+                # Chauffe: index de chaque machine chargé, pages SQLite en cache
+                run(db, cycle, allocator, lockers, len(lockers), args.batch, args.seed + 1)
+                elapsed = run(db, cycle, allocator, lockers, args.cycles, args.batch, args.seed)
+                result = {
+                    "policy": name,
+                    "cycles_per_s": round(args.cycles / elapsed),
+                    "us_per_cycle": round(elapsed / args.cycles * 1e6, 2),
+                }
+                print(f"{name}: {result['cycles_per_s']} cycles/s, {result['us_per_cycle']} us/cycle", file=sys.stderr)
+                runs.append(result)
+
+    report = {
+        "revision": git_revision(),
+        "config": {
+            "machines": args.machines,
+            "boxes": args.boxes,
+            "occupied": args.occupied,
+            "cycles": args.cycles,
+            "batch": args.batch,
+        },
+        "runs": runs,
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import math
+import random
+import subprocess
+import threading
+import time
+from collections import defaultdict
+
+
+SCENARIOS = ("cycle", "deposit", "withdraw", "bad_withdraw", "dashboard", "telemetry")
+# Métriques d'un lot de télémétrie, comme celles d'un kiosque (raspberry/app.py)
+TELEMETRY_METRICS = (
+    "serial.ready", "serial.commands", "serial.timeouts", "serial.errors", "serial.reconnects",
+    "serial.rtt_p50_ms", "serial.rtt_p95_ms", "journal.pending", "leases.available", "doors.watched",
+    "doors.open", "doors.closed_mask",
+) + tuple(
+    f"api.{path}.{kind}"
+    for path in ("deposit_open", "deposit_close", "withdraw_open", "withdraw_close", "telemetry")
+    for kind in ("calls", "errors", "retries", "p95_ms")
+)
+DEFAULT_MIX = {"cycle": 1}
+
+
+def parse_mix(text: str) -> dict:
+    """'cycle=6,deposit=2' -> {"cycle": 6, "deposit": 2}"""
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in SCENARIOS:
+            raise ValueError(f"Scénario inconnu: {name} (choix: {', '.join(SCENARIOS)})")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def percentile(sorted_values, p: float) -> float:
+    """Percentile par rang le plus proche"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class Stats:
+    def __init__(self):
+        self._latencies = defaultdict(list)
+        self._statuses = defaultdict(lambda: defaultdict(int))
+        self._lock = threading.Lock()
+
+    def record(self, endpoint: str, status: int, seconds: float):
+        with self._lock:
+            self._latencies[endpoint].append(seconds)
+            self._statuses[endpoint][status] += 1
+
+    def total(self) -> int:
+        return sum(len(v) for v in self._latencies.values())
+
+    def report(self) -> dict:
+        endpoints = {}
+        for endpoint, values in sorted(self._latencies.items()):
+            ms = sorted(v * 1000 for v in values)
+            statuses = dict(self._statuses[endpoint])
+            endpoints[endpoint] = {
+                "count": len(ms),
+                "errors": sum(n for status, n in statuses.items() if status >= 500 or status == 0),
+                "status": {str(k): v for k, v in sorted(statuses.items())},
+                "mean_ms": round(sum(ms) / len(ms), 3),
+                "p50_ms": round(percentile(ms, 50), 3),
+                "p95_ms": round(percentile(ms, 95), 3),
+                "p99_ms": round(percentile(ms, 99), 3),
+                "max_ms": round(ms[-1], 3),
+            }
+        return endpoints
+
+
+class Driver:
+    """
+    Exécute des scénarios kiosque en parallèle contre une cible
+    (InProcessTarget ou HttpTarget) et mesure chaque appel.
+    """
+
+    def __init__(self, target, machine_ids, mix=None, seed: int = None):
+        self.target = target
+        self.machine_ids = list(machine_ids)
+        self.mix = mix or DEFAULT_MIX
+        self.stats = Stats()
+        self._rng = random.Random(seed)
+        self._pending = []  # Colis déposés en attente de retrait: (machine_id, password)
+        self._pending_lock = threading.Lock()
+        self._scenarios, self._weights = zip(*self.mix.items())
+
+    def call(self, method: str, path: str, body=None):
+        start = time.perf_counter()
+        try:
+            status, data = self.target.request(method, path, body)
+        except Exception:
+            status, data = 0, None
+        self.stats.record(f"{method} {path.split('?')[0]}", status, time.perf_counter() - start)
+        return status, data or {}
+
+    def deposit(self, rng, machine_id: int):
+        tracking = f"B{rng.randrange(10**9)}"
+        status, opened = self.call("POST", "/api/deposit/open", {"lockerId": machine_id, "trackingCode": tracking})
+        if status != 200:
+            return None
+        status, closed = self.call("POST", "/api/deposit/close", {
+            "lockerId": machine_id,
+            "boxId": opened["boxId"],
+            "closetId": opened["closetId"],
+            "trackingCode": tracking,
+        })
+        return closed.get("password") if status == 200 else None
+
+    def withdraw(self, machine_id: int, password: str):
+        status, opened = self.call("POST", "/api/withdraw/open", {"lockerId": machine_id, "password": password})
+        if status != 200:
+            return
+        self.call("POST", "/api/withdraw/close", {
+            "lockerId": machine_id,
+            "boxId": opened["boxId"],
+            "closetId": opened["closetId"],
+        })
+
+    def run_scenario(self, rng, name: str):
+        machine_id = rng.choice(self.machine_ids)
+        if name == "cycle":
+            password = self.deposit(rng, machine_id)
+            if password:
+                self.withdraw(machine_id, password)
+        elif name == "deposit":
+            password = self.deposit(rng, machine_id)
+            if password:
+                with self._pending_lock:
+                    self._pending.append((machine_id, password))
+        elif name == "withdraw":
+            with self._pending_lock:
+                parcel = self._pending.pop(rng.randrange(len(self._pending))) if self._pending else None
+            if parcel:
+                self.withdraw(*parcel)
+            else:
+                self.run_scenario(rng, "deposit")
+        elif name == "bad_withdraw":
+            self.call("POST", "/api/withdraw/open", {"lockerId": machine_id, "password": "000000"})
+        elif name == "dashboard":
+            self.call("GET", f"/api/admin/orders?machine={machine_id}&limit=20")
+        elif name == "telemetry":
+            metrics = {metric: round(rng.random() * 100, 1) for metric in TELEMETRY_METRICS}
+            self.call("POST", "/api/telemetry", {
+                "machineId": machine_id,
+                "samples": [{"ts": int(time.time()), "metrics": metrics}],
+            })
+
+    def run(self, concurrency: int, duration: float) -> dict:
+        deadline = time.perf_counter() + duration
+
+        def worker(seed):
+            rng = random.Random(seed)
+            while time.perf_counter() < deadline:
+                self.run_scenario(rng, rng.choices(self._scenarios, self._weights)[0])
+
+        threads = [
+            threading.Thread(target=worker, args=(self._rng.randrange(2**32),), daemon=True)
+            for _ in range(concurrency)
+        ]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        total = self.stats.total()
+        return {
+            "duration_s": round(elapsed, 3),
+            "requests": total,
+            "throughput_rps": round(total / elapsed, 1) if elapsed else 0.0,
+            "endpoints": self.stats.report(),
+        }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
@@ -0,0 +1,80 @@
+import http.client
+import json
+import os
+import tempfile
+import threading
+from urllib.parse import urlsplit
+
+
+class InProcessTarget:
+    """Application créée sur une base temporaire, appelée via le test client Flask"""
+
+    name = "in-process"
+
+    def __init__(self, db_path: str = None):
+        from app import create_app
+
+        if db_path is None:
+            self._tmpdir = tempfile.TemporaryDirectory(prefix="smartlock-bench-")
+            db_path = os.path.join(self._tmpdir.name, "bench.db")
+        os.environ["SMART_LOCK_DB"] = db_path
+        self.app = create_app()
+        self._local = threading.local()
+
+    def request(self, method: str, path: str, body=None):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        resp = client.open(path, method=method, json=body)
+        return resp.status_code, resp.get_json(silent=True)
+
+    def close(self):
+        tmpdir = getattr(self, "_tmpdir", None)
+        if tmpdir is not None:
+            tmpdir.cleanup()
+
+
+class HttpTarget:
+    """Serveur distant, une connexion keep-alive par thread"""
+
+    name = "http"
+
+    def __init__(self, base_url: str, timeout: float = 10.0):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.https = parts.scheme == "https"
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            conn = self._local.conn = cls(self.host, self.port, timeout=self.timeout)
+        return conn
+
+    def request(self, method: str, path: str, body=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        headers = {"Content-Type": "application/json"} if data is not None else {}
+        for attempt in range(2):
+            conn = self._connection()
+            try:
+                conn.request(method, path, body=data, headers=headers)
+                resp = conn.getresponse()
+                payload = resp.read()
+                break
+            except (http.client.HTTPException, OSError):
+                # Connexion keep-alive fermée par le serveur: une nouvelle tentative
+                conn.close()
+                self._local.conn = None
+                if attempt:
+                    raise
+        try:
+            parsed = json.loads(payload) if payload else None
+        except ValueError:
+            parsed = None
+        return resp.status, parsed
+
+    def close(self):
+        pass
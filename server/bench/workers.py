@@ -0,0 +1,138 @@
+"""
+Débit en fonction du nombre de workers gunicorn.
+
+    python -m bench.workers --workers 1,2,4 --concurrency 16 --duration 10
+
+Pour chaque valeur, un serveur gunicorn (gunicorn.conf.py) est lancé sur une
+base temporaire neuve puis mesuré en HTTP avec le même scénario.
+"""
+import argparse
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench.__main__ import provision_fleet
+from bench.driver import Driver, git_revision, parse_mix
+from bench.targets import HttpTarget
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STARTUP_TIMEOUT = 30.0
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(target: HttpTarget, server: subprocess.Popen):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"gunicorn s'est arrêté (code {server.returncode})")
+        try:
+            target.request("GET", "/api/admin/machines")
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit("gunicorn n'a pas démarré à temps")
+
+
+def measure(workers: int, threads: int, args, mix) -> dict:
+    port = free_port()
+    with tempfile.TemporaryDirectory(prefix="smartlock-workers-") as tmpdir:
+        env = dict(
+            os.environ,
+            SMART_LOCK_DB=os.path.join(tmpdir, "bench.db"),
+            SMART_LOCK_BIND=f"127.0.0.1:{port}",
+            SMART_LOCK_WORKERS=str(workers),
+            SMART_LOCK_THREADS=str(threads),
+        )
+        server = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "wsgi:app"],
+            cwd=SERVER_DIR,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            target = HttpTarget(f"http://127.0.0.1:{port}")
+            wait_ready(target, server)
+            machine_ids = provision_fleet(target, args.first_machine_id, args.machines, args.boxes)
+            if args.warmup > 0:
+                Driver(target, machine_ids, mix, args.seed).run(args.concurrency, args.warmup)
+            result = Driver(target, machine_ids, mix, args.seed).run(args.concurrency, args.duration)
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait(timeout=60)
+
+    errors = sum(e["errors"] for e in result["endpoints"].values())
+    p95 = max(e["p95_ms"] for e in result["endpoints"].values())
+    return {
+        "workers": workers,
+        "threads": threads,
+        "throughput_rps": result["throughput_rps"],
+        "worst_p95_ms": p95,
+        "errors": errors,
+        "endpoints": result["endpoints"],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m bench.workers", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--workers", default="1,2,4", help="Nombres de workers à comparer")
+    parser.add_argument("--threads", type=int, default=8, help="Threads par worker")
+    parser.add_argument("--machines", type=int, default=20)
+    parser.add_argument("--boxes", type=int, default=16)
+    parser.add_argument("--first-machine-id", type=int, default=100000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument("--mix", default="cycle=1")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--out", help="Fichier JSON du rapport (défaut: sortie standard)")
+    args = parser.parse_args(argv)
+
+    try:
+        mix = parse_mix(args.mix)
+        counts = [int(n) for n in args.workers.split(",")]
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    runs = []
+    for workers in counts:
+        run = measure(workers, args.threads, args, mix)
+        print(
+            f"workers={workers} threads={args.threads}: {run['throughput_rps']} req/s, "
+            f"p95 max {run['worst_p95_ms']} ms, {run['errors']} erreurs",
+            file=sys.stderr,
+        )
+        runs.append(run)
+
+    report = {
+        "revision": git_revision(),
+        "cpus": os.cpu_count(),
+        "config": {
+            "machines": args.machines,
+            "boxes": args.boxes,
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "mix": mix,
+        },
+        "runs": runs,
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
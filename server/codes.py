@@ -0,0 +1,130 @@
+import logging
+import random
+import os
+import secrets
+import threading
+from collections import deque
+
+
+LOG = logging.getLogger(__name__)
+
+
+# Une commande est active tant que le colis ou la box n'est pas libéré;
+# l'expression doit rester identique à celle des index partiels
+# (database._ACTIVE_ORDER_SQL_V8: la changer demande une nouvelle migration).
+# 'leased': box prêtée à un kiosque, codes déjà réservés (leases.py)
+ACTIVE_ORDER_SQL = "status IN ('leased', 'awaiting_close', 'closed', 'withdraw_in_progress')"
+
+POOL_TARGET = 32  # Codes précalculés par machine
+POOL_LOW_WATERMARK = 8  # En dessous, la recharge en arrière-plan est demandée
+
+
+def random_password() -> str:
+    return "".join(secrets.choice("0123456789") for _ in range(6))
+
+
+def random_closet_id() -> int:
+    return random.randint(1000, 9999)
+
+
+# type de code -> (générateur, colonne de orders)
+CODE_KINDS = {
+    "password": (random_password, "password"),
+    "closet": (random_closet_id, "closet_id"),
+}
+
+
+class CodePool:
+    """
+    Réserves par machine de mots de passe et closet IDs absents des commandes
+    actives. Les codes sont tirés dans la réserve sans requête; un thread
+    de fond la recharge quand elle passe sous POOL_LOW_WATERMARK.
+
+    La réserve peut être légèrement périmée (autre processus, code tiré
+    pendant une recharge): l'unicité finale est garantie par les index
+    uniques partiels, l'appelant réessaie sur IntegrityError.
+    `connect_db(shard)` ouvre la base d'un shard, `shard_of(locker_id)`
+    donne le shard d'une machine.
+    """
+
+    def __init__(
+        self,
+        connect_db,
+        shard_of=lambda locker_id: 0,
+        target: int = POOL_TARGET,
+        low_watermark: int = POOL_LOW_WATERMARK,
+    ):
+        self._connect_db = connect_db
+        self._shard_of = shard_of
+        self.target = target
+        self.low_watermark = low_watermark
+        self._pools = {}
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._start_lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        """
+        Démarrer le thread de recharge du processus courant. Appelé au
+        premier tirage: après un fork (workers gunicorn préchargés), le
+        thread du parent n'existe pas dans l'enfant.
+        """
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                threading.Thread(target=self._run, name="code-pool", daemon=True).start()
+                self._pid = os.getpid()
+
+    def take(self, kind: str, locker_id: int):
+        self.start()
+        generate = CODE_KINDS[kind][0]
+        key = (kind, locker_id)
+        with self._lock:
+            pool = self._pools.setdefault(key, deque())
+            code = pool.popleft() if pool else None
+            if len(pool) < self.low_watermark and key not in self._pending:
+                self._pending.add(key)
+                self._wakeup.set()
+        # Réserve vide (premier appel, recharge en retard): tirage direct
+        return code if code is not None else generate()
+
+    def refill(self, db, kind: str, locker_id: int):
+        generate, column = CODE_KINDS[kind]
+        used = {
+            row[0]
+            for row in db.execute(
+                f"SELECT {column} FROM orders WHERE locker_id=? AND {ACTIVE_ORDER_SQL} AND {column} IS NOT NULL",
+                (locker_id,),
+            )
+        }
+        with self._lock:
+            pool = self._pools.setdefault((kind, locker_id), deque())
+            seen = used.union(pool)
+            while len(pool) < self.target:
+                code = generate()
+                if code not in seen:
+                    seen.add(code)
+                    pool.append(code)
+
+    def _run(self):
+        dbs = {}
+        while True:
+            self._wakeup.wait()
+            with self._lock:
+                self._wakeup.clear()
+                pending, self._pending = self._pending, set()
+            for kind, locker_id in pending:
+                try:
+                    shard = self._shard_of(locker_id)
+                    if shard not in dbs:
+                        dbs[shard] = self._connect_db(shard)
+                    self.refill(dbs[shard], kind, locker_id)
+                except Exception as exc:  # pragma: no cover
+                    LOG.error("Code pool refill failed for locker %s: %s", locker_id, exc)
+
+
+def get_code_pool(app) -> CodePool:
+    return app.extensions["smartlock_codes"]
@@ -1,33 +1,299 @@
+import os
+import queue
 import sqlite3
-from flask import g
+import threading
+import time
+from contextlib import contextmanager
+from flask import current_app, g
+from codes import random_closet_id, random_password
+from metrics import InstrumentedConnection
+from provisioning import normalize_machine, provision_machines
+
+try:
+    import fcntl
+except ImportError:  # Windows: serveur de développement, un seul processus
+    fcntl = None
 
 
 BOX_COUNT = 16  # Nombre de compartiments par machine
+BUSY_TIMEOUT_MS = 5000  # Attente max sur le verrou d'écriture SQLite
+POOL_SIZE = 8  # Connexions gardées ouvertes entre deux requêtes
+# Identifiants AUTOINCREMENT (lockers, boxes, orders) du shard k à partir de
+# k * SHARD_ID_SPAN: uniques dans toute la flotte, le shard se lit dans l'id
+SHARD_ID_SPAN = 1 << 40
+SHARDED_ID_TABLES = ("lockers", "boxes", "orders")
+MAP_RELOAD_INTERVAL = 1.0  # Relecture de shard_map au plus une fois par seconde et par processus
+MOVED_STATUS = "moved"  # Locker laissé dans l'ancien shard après un déplacement
+MOVED_ERROR = "machine moved"  # Message des triggers de garde (migration 11)
 
 
-def get_db(app):
-    if "db" not in g:
-        g.db = sqlite3.connect(app.config["DATABASE_PATH"])
-        g.db.row_factory = sqlite3.Row
-    return g.db
+def connect(path: str):
+    db = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+    db.row_factory = sqlite3.Row
+    db.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    # WAL: les lectures ne bloquent plus l'écrivain (et inversement).
+    # Le mode est enregistré dans le fichier: on ne le change que s'il le
+    # faut, la bascule demande un verrou exclusif sur la base.
+    if db.execute("PRAGMA journal_mode").fetchone()[0] != "wal":
+        db.execute("PRAGMA journal_mode = WAL")
+    db.execute("PRAGMA synchronous = NORMAL")
+    return db
 
 
-def init_db(app):
-    with app.app_context():
-        db = get_db(app)
+class ConnectionPool:
+    """
+    Connexions SQLite réutilisées d'une requête à l'autre.
+    Au-delà de `size` connexions simultanées, on en ouvre de nouvelles qui
+    sont fermées à la restitution.
+    """
+
+    def __init__(self, path: str, size: int = POOL_SIZE, registry=None):
+        self.path = path
+        self.registry = registry
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            db = connect(self.path)
+            # Mesure des requêtes SQL quand les métriques sont activées
+            return InstrumentedConnection(db, self.registry) if self.registry is not None else db
+
+    def release(self, db):
+        # Ne jamais rendre une connexion avec une transaction en cours
+        if db.in_transaction:
+            db.rollback()
+        try:
+            self._idle.put_nowait(db)
+        except queue.Full:
+            db.close()
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def shard_paths(path: str, count: int) -> list:
+    """Fichiers des shards: la base historique est le shard 0, puis smartlock-1.db, ..."""
+    root, ext = os.path.splitext(path)
+    return [path] + [f"{root}-{k}{ext}" for k in range(1, count)]
+
+
+def shard_of_id(row_id: int) -> int:
+    """Shard d'un locker, d'une box ou d'une commande (voir SHARD_ID_SPAN)"""
+    return row_id // SHARD_ID_SPAN
+
 
-        # Créer les tables si absentes
-        create_tables(db)
+class MachineMoved(Exception):
+    """Machine en cours de déplacement vers un autre shard: réessayer"""
 
-        # Si l'ancienne base (sans machine_id / boxes) existe, on reconstruit proprement
-        if not column_exists(db, "lockers", "machine_id") or not table_exists(db, "boxes"):
-            rebuild_db(db)
-        else:
-            seed_data(db)
 
+class ShardRouter:
+    """
+    Répartition des machines entre N bases SQLite, chacune avec son verrou
+    d'écriture. La table shard_map du shard 0 fixe le shard de chaque
+    machine provisionnée; une machine absente de la carte va au shard
+    machine_id % N. La carte est gardée en mémoire et relue quand une
+    machine n'est pas là où elle l'indique (déplacée par
+    `manage.py shard-move`). Avec un seul shard, la carte n'est pas lue.
+    """
+
+    def __init__(self, paths, pool_size: int = POOL_SIZE, registry=None):
+        self.paths = list(paths)
+        self.pools = [ConnectionPool(path, pool_size, registry) for path in self.paths]
+        self._map = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def count(self) -> int:
+        return len(self.paths)
+
+    def shards(self):
+        return range(len(self.paths))
+
+    def reload(self, force: bool = False) -> bool:
+        """Relire shard_map (au plus une fois par MAP_RELOAD_INTERVAL, sauf `force`); True si relue"""
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._map is not None and now - self._loaded_at < MAP_RELOAD_INTERVAL:
+                return False
+            db = self.pools[0].acquire()
+            try:
+                self._map = {row[0]: row[1] for row in db.execute("SELECT machine_id, shard FROM shard_map")}
+            finally:
+                self.pools[0].release(db)
+            self._loaded_at = now
+            return True
+
+    def shard_for(self, machine_id: int) -> int:
+        if len(self.paths) == 1:
+            return 0
+        if self._map is None:
+            self.reload(force=True)
+        shard = self._map.get(machine_id)
+        return machine_id % len(self.paths) if shard is None else shard
+
+    def close(self):
+        for pool in self.pools:
+            pool.close()
+
+
+def get_router(app) -> ShardRouter:
+    router = app.extensions.get("smartlock_db")
+    if router is None:
+        router = ShardRouter(
+            shard_paths(app.config["DATABASE_PATH"], app.config.get("DATABASE_SHARDS", 1)),
+            app.config.get("DATABASE_POOL_SIZE", POOL_SIZE),
+            app.extensions.get("smartlock_metrics"),
+        )
+        app.extensions["smartlock_db"] = router
+    return router
+
+
+def get_pool(app, shard: int = 0) -> ConnectionPool:
+    return get_router(app).pools[shard]
+
+
+def get_db(app, shard: int = 0):
+    """Connexion de la requête en cours sur un shard (une par shard, rendue par close_db)"""
+    dbs = g.setdefault("dbs", {})
+    if shard not in dbs:
+        dbs[shard] = get_pool(app, shard).acquire()
+    return dbs[shard]
+
+
+def get_shard_dbs(app) -> dict:
+    """{shard: connexion} de tous les shards, pour les lectures de toute la flotte"""
+    return {shard: get_db(app, shard) for shard in get_router(app).shards()}
+
+
+def locate_machine(app, machine_id: int):
+    """
+    (connexion du shard de la machine, ligne lockers ou None). Machine
+    absente ou déplacée: la carte est relue et la recherche refaite une
+    fois; encore marquée déplacée, MachineMoved (déplacement en cours).
+    """
+    router = get_router(app)
+    for attempt in range(2):
+        db = get_db(app, router.shard_for(machine_id))
+        locker = db.execute(
+            "SELECT id, machine_id, name, status FROM lockers WHERE machine_id=?",
+            (machine_id,),
+        ).fetchone()
+        if locker is not None and locker["status"] != MOVED_STATUS:
+            return db, locker
+        if attempt or router.count == 1 or not router.reload():
+            break
+    if locker is not None:
+        raise MachineMoved(machine_id)
+    return db, None
+
+
+def is_moved_error(exc: Exception) -> bool:
+    """Écriture refusée par les triggers de garde: la machine a changé de shard"""
+    return isinstance(exc, sqlite3.IntegrityError) and MOVED_ERROR in str(exc)
+
+
+def provision_fleet(app, machines):
+    """
+    provision_machines réparti par shard: chaque machine est d'abord fixée
+    dans shard_map (carte existante ou hachage), puis créée dans son shard.
+    Une transaction par shard: le manifeste n'est atomique que par shard.
+    """
+    router = get_router(app)
+    by_shard = {}
+    for machine in machines:
+        by_shard.setdefault(router.shard_for(machine["machine_id"]), []).append(machine)
+    home = get_db(app, 0)
+    with write_transaction(home):
+        home.executemany(
+            "INSERT OR IGNORE INTO shard_map (machine_id, shard) VALUES (?, ?)",
+            [(m["machine_id"], shard) for shard, group in by_shard.items() for m in group],
+        )
+    result = {"machines": 0, "boxes": 0}
+    for shard, group in sorted(by_shard.items()):
+        db = get_db(app, shard)
+        with write_transaction(db):
+            counts = provision_machines(db, group)
+        result = {key: result[key] + counts[key] for key in result}
+    return result
+
+
+@contextmanager
+def write_transaction(db):
+    """
+    Transaction BEGIN IMMEDIATE: le verrou d'écriture est pris avant les
+    lectures, deux requêtes concurrentes ne peuvent donc pas lire le même
+    état puis l'écraser l'une après l'autre.
+    """
+    if db.in_transaction:
+        db.commit()
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield db
+    except Exception:
+        db.rollback()
+        raise
+    else:
         db.commit()
 
 
+@contextmanager
+def init_lock(path: str):
+    """
+    Verrou fichier exclusif à côté de la base: plusieurs processus qui
+    démarrent en même temps appliquent les migrations l'un après l'autre.
+    """
+    if fcntl is None or path == ":memory:":
+        yield
+        return
+    with open(f"{path}.init.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def init_db(app):
+    router = get_router(app)
+    for shard, path in enumerate(router.paths):
+        with init_lock(path):
+            db = router.pools[shard].acquire()
+            try:
+                # Appliquer les migrations manquantes puis créer les données par défaut
+                migrate(db)
+                if shard == 0:
+                    seed_data(db)
+                else:
+                    reserve_id_range(db, shard)
+                db.commit()
+                if shard == 0:
+                    mapped = db.execute("SELECT max(shard) FROM shard_map").fetchone()[0]
+            finally:
+                router.pools[shard].release(db)
+    if mapped is not None and mapped >= router.count:
+        raise RuntimeError(f"shard_map utilise le shard {mapped}: au moins {mapped + 1} shards requis")
+    # Aucune connexion ne doit survivre à un fork (workers gunicorn préchargés)
+    router.close()
+
+
+def reserve_id_range(db, shard: int):
+    """Faire commencer les identifiants AUTOINCREMENT du shard à shard * SHARD_ID_SPAN"""
+    base = shard * SHARD_ID_SPAN
+    for table in SHARDED_ID_TABLES:
+        db.execute(
+            "INSERT INTO sqlite_sequence (name, seq) SELECT ?, ? WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name=?)",
+            (table, base, table),
+        )
+        db.execute("UPDATE sqlite_sequence SET seq=? WHERE name=? AND seq < ?", (base, table, base))
+
+
 def table_exists(db, table_name: str) -> bool:
     row = db.execute(
         "SELECT name FROM sqlite_master WHERE type='table' AND name=?",
@@ -41,12 +307,373 @@ def column_exists(db, table_name: str, column_name: str) -> bool:
     return any(r["name"] == column_name for r in rows)
 
 
-def rebuild_db(db):
-    db.execute("DROP TABLE IF EXISTS orders")
-    db.execute("DROP TABLE IF EXISTS boxes")
-    db.execute("DROP TABLE IF EXISTS lockers")
+def schema_version(db) -> int:
+    return db.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(db, target: int = None):
+    """
+    Appliquer les migrations dont le numéro dépasse PRAGMA user_version.
+    Chaque migration tourne dans sa propre transaction avec la mise à jour
+    de user_version: une migration interrompue est rejouée entièrement.
+    """
+    if target is None:
+        target = MIGRATIONS[-1][0]
+    current = schema_version(db)
+    db.commit()
+    for version, migration in MIGRATIONS:
+        if version <= current or version > target:
+            continue
+        db.execute("BEGIN")
+        try:
+            migration(db)
+            db.execute(f"PRAGMA user_version = {version}")
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+    return schema_version(db)
+
+
+def _migration_1_initial(db):
+    # Ancien schéma (lockers sans machine_id, pas de boxes): on met les
+    # tables de côté au lieu de les supprimer, pour ne perdre aucune donnée
+    if table_exists(db, "lockers") and not column_exists(db, "lockers", "machine_id"):
+        for table in ("orders", "boxes", "lockers"):
+            if table_exists(db, table):
+                db.execute(f"ALTER TABLE {table} RENAME TO legacy_{table}")
     create_tables(db)
-    seed_data(db)
+
+
+def _migration_2_order_indexes(db):
+    # close_deposit / close_withdraw: box_id + closet_id (+ tracking_code),
+    # tri par created_at; status et tracking_code inclus pour éviter la table
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_orders_box_closet
+        ON orders (box_id, closet_id, order_type, created_at, status, tracking_code)
+        """
+    )
+    # open_withdraw: locker_id + password, tri par created_at
+    db.execute(
+        """
+        CREATE INDEX IF NOT EXISTS idx_orders_locker_password
+        ON orders (locker_id, password, order_type, created_at, status, closet_id, box_id)
+        """
+    )
+    # Dashboard: dernières commandes
+    db.execute("CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders (created_at)")
+    # _find_available_box: première box libre d'une machine
+    db.execute("CREATE INDEX IF NOT EXISTS idx_boxes_locker_status ON boxes (locker_id, status, box_number)")
+
+
+def _migration_3_box_sizes(db):
+    # Classe de taille de chaque box (S, M, L), utilisée par l'allocateur
+    if not column_exists(db, "boxes", "size"):
+        db.execute("ALTER TABLE boxes ADD COLUMN size TEXT NOT NULL DEFAULT 'M'")
+
+
+# Expression de ACTIVE_ORDER_SQL à la publication de la migration 4
+_ACTIVE_ORDER_SQL_V4 = "status IN ('awaiting_close', 'closed', 'withdraw_in_progress')"
+
+
+def _migration_4_unique_active_codes(db):
+    # Les codes déjà en double parmi les commandes actives sont réattribués,
+    # sauf sur la commande la plus récente (celle que l'ancien ORDER BY
+    # created_at DESC trouvait): les anciennes étaient déjà inaccessibles.
+    for column, generate in (("password", random_password), ("closet_id", random_closet_id)):
+        rows = db.execute(
+            f"""
+            SELECT id, locker_id, {column} AS code FROM orders
+            WHERE {_ACTIVE_ORDER_SQL_V4} AND {column} IS NOT NULL
+            ORDER BY created_at DESC, id DESC
+            """
+        ).fetchall()
+        used = set()
+        for row in rows:
+            key = (row["locker_id"], row["code"])
+            if key not in used:
+                used.add(key)
+                continue
+            code = generate()
+            while (row["locker_id"], code) in used:
+                code = generate()
+            used.add((row["locker_id"], code))
+            db.execute(f"UPDATE orders SET {column}=? WHERE id=?", (code, row["id"]))
+
+    db.execute(
+        f"""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_active_password
+        ON orders (locker_id, password) WHERE {_ACTIVE_ORDER_SQL_V4}
+        """
+    )
+    db.execute(
+        f"""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_active_closet
+        ON orders (locker_id, closet_id) WHERE {_ACTIVE_ORDER_SQL_V4}
+        """
+    )
+    # Remplacé par idx_orders_active_password pour open_withdraw
+    db.execute("DROP INDEX IF EXISTS idx_orders_locker_password")
+
+
+def _migration_5_orders_archive(db):
+    # Commandes terminées déplacées hors de la table chaude (archive.py)
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS orders_archive (
+            id INTEGER PRIMARY KEY,
+            locker_id INTEGER NOT NULL,
+            box_id INTEGER NOT NULL,
+            closet_id INTEGER NOT NULL,
+            tracking_code TEXT,
+            password TEXT,
+            order_type TEXT NOT NULL,
+            status TEXT NOT NULL,
+            created_at DATETIME,
+            updated_at DATETIME,
+            archived_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS idx_orders_archive_created_at ON orders_archive (created_at)")
+    # Historique complet (chaud + archive) pour les lectures admin
+    db.execute(
+        """
+        CREATE VIEW IF NOT EXISTS orders_history AS
+        SELECT id, locker_id, box_id, closet_id, tracking_code, password,
+               order_type, status, created_at, updated_at
+        FROM orders
+        UNION ALL
+        SELECT id, locker_id, box_id, closet_id, tracking_code, password,
+               order_type, status, created_at, updated_at
+        FROM orders_archive
+        """
+    )
+    # Sélection des commandes à archiver (et des états bloqués)
+    db.execute("CREATE INDEX IF NOT EXISTS idx_orders_status_updated ON orders (status, updated_at)")
+
+
+def _migration_6_change_counter(db):
+    # Compteur incrémenté à chaque écriture sur les tables du dashboard:
+    # sert d'ETag aux endpoints /api/admin (réponses 304 sans requête lourde)
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS change_counter (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+        """
+    )
+    db.execute("INSERT OR IGNORE INTO change_counter (id, version) VALUES (1, 0)")
+    for table in ("lockers", "boxes", "orders"):
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            db.execute(
+                f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_version
+                AFTER {event} ON {table}
+                BEGIN
+                    UPDATE change_counter SET version = version + 1 WHERE id = 1;
+                END
+                """
+            )
+
+
+def _migration_7_reserved_boxes(db):
+    # Boxes réservées par machine (jamais attribuées); jusqu'ici la box 16
+    if not column_exists(db, "boxes", "reserved"):
+        db.execute("ALTER TABLE boxes ADD COLUMN reserved INTEGER NOT NULL DEFAULT 0")
+    db.execute("UPDATE boxes SET reserved=1 WHERE box_number > 15")
+
+
+# Expression de ACTIVE_ORDER_SQL à la publication de la migration 8
+_ACTIVE_ORDER_SQL_V8 = "status IN ('leased', 'awaiting_close', 'closed', 'withdraw_in_progress')"
+
+
+def _migration_8_box_leases(db):
+    # Boxes prêtées aux kiosques (leases.py): la commande 'leased' porte les
+    # codes réservés, box_leases son échéance
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS box_leases (
+            order_id INTEGER PRIMARY KEY,
+            locker_id INTEGER NOT NULL,
+            expires_at DATETIME NOT NULL,
+            FOREIGN KEY(order_id) REFERENCES orders(id)
+        )
+        """
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS idx_box_leases_locker ON box_leases (locker_id)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_box_leases_expires_at ON box_leases (expires_at)")
+    # Les codes des commandes 'leased' comptent parmi les codes actifs
+    for name, column in (("idx_orders_active_password", "password"), ("idx_orders_active_closet", "closet_id")):
+        db.execute(f"DROP INDEX IF EXISTS {name}")
+        db.execute(f"CREATE UNIQUE INDEX {name} ON orders (locker_id, {column}) WHERE {_ACTIVE_ORDER_SQL_V8}")
+
+
+def _migration_9_telemetry(db):
+    # Télémétrie des kiosques (telemetry.py): une ligne par (machine,
+    # métrique, seconde), noms de métriques stockés une seule fois
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS telemetry_metrics (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        )
+        """
+    )
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS telemetry_samples (
+            locker_id INTEGER NOT NULL,
+            metric_id INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            value REAL NOT NULL,
+            PRIMARY KEY (locker_id, metric_id, ts)
+        ) WITHOUT ROWID
+        """
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS idx_telemetry_samples_ts ON telemetry_samples (ts)")
+
+
+def _migration_10_order_rollups(db):
+    # Heure de fermeture du dépôt (durée de séjour jusqu'au retrait)
+    for table in ("orders", "orders_archive"):
+        if not column_exists(db, table, "closed_at"):
+            db.execute(f"ALTER TABLE {table} ADD COLUMN closed_at DATETIME")
+    db.execute("DROP VIEW IF EXISTS orders_history")
+    db.execute(
+        """
+        CREATE VIEW orders_history AS
+        SELECT id, locker_id, box_id, closet_id, tracking_code, password,
+               order_type, status, created_at, updated_at, closed_at
+        FROM orders
+        UNION ALL
+        SELECT id, locker_id, box_id, closet_id, tracking_code, password,
+               order_type, status, created_at, updated_at, closed_at
+        FROM orders_archive
+        """
+    )
+    # Agrégats par machine et par heure / jour (rollups.py), tenus à jour
+    # par les routes: les rapports ne lisent jamais la table orders
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS order_rollups (
+            locker_id INTEGER NOT NULL,
+            period TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            deposits INTEGER NOT NULL DEFAULT 0,
+            withdrawals INTEGER NOT NULL DEFAULT 0,
+            cancelled INTEGER NOT NULL DEFAULT 0,
+            dwell_count INTEGER NOT NULL DEFAULT 0,
+            dwell_seconds INTEGER NOT NULL DEFAULT 0,
+            occupied_last INTEGER NOT NULL DEFAULT 0,
+            occupied_peak INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (locker_id, period, bucket)
+        ) WITHOUT ROWID
+        """
+    )
+
+
+def _migration_11_shards(db):
+    # Shard de chaque machine (lue dans le shard 0 seulement, voir
+    # ShardRouter): les machines existantes restent dans la base historique
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS shard_map (
+            machine_id INTEGER PRIMARY KEY,
+            shard INTEGER NOT NULL
+        )
+        """
+    )
+    db.execute("INSERT OR IGNORE INTO shard_map (machine_id, shard) SELECT machine_id, 0 FROM lockers")
+    # Une machine déplacée laisse un locker 'moved' dans l'ancien shard: une
+    # requête partie avant le déplacement ne peut plus y écrire
+    for table in ("boxes", "orders"):
+        for event in ("INSERT", "UPDATE"):
+            db.execute(
+                f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_{event.lower()}_moved
+                BEFORE {event} ON {table}
+                WHEN (SELECT status FROM lockers WHERE id = NEW.locker_id) = '{MOVED_STATUS}'
+                BEGIN
+                    SELECT RAISE(ABORT, '{MOVED_ERROR}');
+                END
+                """
+            )
+    # Copie de l'archive d'une machine lors d'un déplacement (shards.py)
+    db.execute("CREATE INDEX IF NOT EXISTS idx_orders_archive_locker ON orders_archive (locker_id)")
+
+
+def _migration_12_expired_leases(db):
+    # Trace des baux repris par leases.reclaim_expired: un dépôt enregistré
+    # ensuite par le kiosque n'est accepté que s'il correspond à un bail
+    # réellement accordé (box, closet ID, empreinte des codes)
+    db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS expired_leases (
+            order_id INTEGER PRIMARY KEY,
+            locker_id INTEGER NOT NULL,
+            box_number INTEGER NOT NULL,
+            closet_id INTEGER NOT NULL,
+            codes_hash TEXT NOT NULL,
+            expired_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS idx_expired_leases_locker ON expired_leases (locker_id, closet_id)")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_expired_leases_expired_at ON expired_leases (expired_at)")
+
+
+def _migration_13_box_version(db):
+    # Version des boxes de chaque machine pour l'index de l'allocateur
+    # (allocator.py): incrémentée seulement par ce que l'index ne voit pas
+    # lui-même, box redevenue libre, taille ou réserve changée, box ajoutée
+    # ou supprimée. Une attribution par un autre worker ne la change pas:
+    # l'UPDATE conditionnel de claim() l'écarte.
+    if not column_exists(db, "lockers", "box_version"):
+        db.execute("ALTER TABLE lockers ADD COLUMN box_version INTEGER NOT NULL DEFAULT 0")
+    bump = "UPDATE lockers SET box_version = box_version + 1 WHERE id = {row}.locker_id;"
+    db.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_boxes_update_box_version
+        AFTER UPDATE ON boxes
+        WHEN (NEW.status = 'available' AND OLD.status != 'available')
+          OR NEW.size IS NOT OLD.size OR NEW.reserved != OLD.reserved
+        BEGIN
+            {bump.format(row="NEW")}
+        END
+        """
+    )
+    for event, row in (("INSERT", "NEW"), ("DELETE", "OLD")):
+        db.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS trg_boxes_{event.lower()}_box_version
+            AFTER {event} ON boxes
+            BEGIN
+                {bump.format(row=row)}
+            END
+            """
+        )
+
+
+# (version, fonction) — ne jamais modifier une migration déjà publiée,
+# en ajouter une nouvelle à la fin
+MIGRATIONS = [
+    (1, _migration_1_initial),
+    (2, _migration_2_order_indexes),
+    (3, _migration_3_box_sizes),
+    (4, _migration_4_unique_active_codes),
+    (5, _migration_5_orders_archive),
+    (6, _migration_6_change_counter),
+    (7, _migration_7_reserved_boxes),
+    (8, _migration_8_box_leases),
+    (9, _migration_9_telemetry),
+    (10, _migration_10_order_rollups),
+    (11, _migration_11_shards),
+    (12, _migration_12_expired_leases),
+    (13, _migration_13_box_version),
+]
 
 
 def create_tables(db):
@@ -100,23 +727,20 @@ def create_tables(db):
 
 
 def seed_data(db):
-    # Créer la machine par défaut (ID=1)
+    # Créer la machine par défaut (ID=1) avec ses 16 boxes, box 16 réservée,
+    # dans le shard 0 (sauf si elle a été déplacée)
     existing_locker = db.execute("SELECT COUNT(*) as count FROM lockers WHERE machine_id=1").fetchone()["count"]
     if existing_locker == 0:
-        db.execute(
-            "INSERT INTO lockers (machine_id, name, location, status) VALUES (?, ?, ?, ?)",
-            (1, "Locker Principal", "Emplacement 1", "active")
-        )
-        locker_id = db.execute("SELECT id FROM lockers WHERE machine_id=1").fetchone()["id"]
-        
-        # Créer les 16 boxes pour cette machine
-        db.executemany(
-            "INSERT INTO boxes (locker_id, box_number, status) VALUES (?, ?, ?)",
-            [(locker_id, i, "available") for i in range(1, BOX_COUNT + 1)]
-        )
+        provision_machines(db, [normalize_machine({
+            "machineId": 1,
+            "name": "Locker Principal",
+            "location": "Emplacement 1",
+            "boxCount": BOX_COUNT,
+        })])
+        db.execute("INSERT OR IGNORE INTO shard_map (machine_id, shard) VALUES (1, 0)")
 
 
 def close_db(e=None):
-    db = g.pop("db", None)
-    if db is not None:
-        db.close()
+    dbs = g.pop("dbs", None)
+    for shard, db in (dbs or {}).items():
+        get_pool(current_app, shard).release(db)
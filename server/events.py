@@ -0,0 +1,244 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import deque
+from flask import Blueprint, Response, current_app, request
+
+from database import connect, write_transaction
+
+
+bp = Blueprint("events", __name__)
+
+LOG = logging.getLogger(__name__)
+
+HISTORY_SIZE = 1000  # Événements gardés pour la reprise via Last-Event-ID
+SUBSCRIBER_BUFFER = 100  # Au-delà, l'abonné trop lent est déconnecté
+KEEPALIVE_SECONDS = 15
+POLL_INTERVAL = 0.25  # Secondes entre deux lectures du journal d'événements par worker
+PRUNE_INTERVAL = 60  # Secondes entre deux purges du journal
+MAX_CLIENTS = 2  # Flux SSE par worker (chacun occupe un thread gthread)
+RETRY_AFTER = 5  # Secondes avant qu'un dashboard refusé ne se reconnecte
+
+
+def events_path(db_path: str) -> str:
+    """Journal d'événements partagé par les workers, à côté de la base du shard 0"""
+    return ":memory:" if db_path == ":memory:" else f"{os.path.splitext(db_path)[0]}-events.db"
+
+
+class EventBroker:
+    """
+    Diffusion des changements d'état vers les dashboards (SSE), pour tous
+    les workers.
+
+    Un événement publié est ajouté au journal SQLite `path` (fichier à
+    part: pas de verrou pris sur la base des commandes). Chaque worker lit
+    la suite du journal toutes les POLL_INTERVAL secondes (tout de suite
+    après une publication locale) et copie les événements dans la file
+    bornée de chacun de ses abonnés: une requête par worker, aucune par
+    dashboard. Un abonné dont la file déborde est déconnecté; le
+    navigateur se reconnecte avec Last-Event-ID et rejoue l'historique.
+
+    Les identifiants sont ceux du journal, préfixés par son époque: un
+    dashboard peut reprendre sur n'importe quel worker. Journal recréé
+    (époque inconnue) ou Last-Event-ID trop ancien: événement "reset", le
+    client recharge l'état complet.
+
+    Créé avant le fork (preload_app), le broker ouvre sa connexion et
+    lance son thread de lecture dans chaque worker, à sa première
+    utilisation. `max_clients` borne les flux SSE ouverts par worker.
+    """
+
+    def __init__(
+        self, path: str, history_size: int = HISTORY_SIZE, buffer_size: int = SUBSCRIBER_BUFFER,
+        max_clients: int = MAX_CLIENTS, poll_interval: float = POLL_INTERVAL,
+    ):
+        self.path = path
+        self.history_size = history_size
+        self.buffer_size = buffer_size
+        self.max_clients = max_clients
+        self.poll_interval = poll_interval
+        self._start_lock = threading.Lock()
+        self._pid = None
+
+    def _start(self):
+        db = connect(self.path)
+        with write_transaction(db):
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    event TEXT NOT NULL,
+                    data TEXT NOT NULL
+                )
+                """
+            )
+            db.execute("CREATE TABLE IF NOT EXISTS epoch (id INTEGER PRIMARY KEY CHECK (id = 1), value TEXT NOT NULL)")
+            db.execute("INSERT OR IGNORE INTO epoch (id, value) VALUES (1, ?)", (f"{os.getpid()}-{time.time_ns()}",))
+        self.epoch = db.execute("SELECT value FROM epoch").fetchone()[0]
+        recent = db.execute(
+            "SELECT id, event, data FROM events ORDER BY id DESC LIMIT ?", (self.history_size,)
+        ).fetchall()
+        self._history = deque((tuple(row) for row in reversed(recent)), maxlen=self.history_size)
+        self._seq = recent[0][0] if recent else db.execute(
+            "SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name='events'), 0)"
+        ).fetchone()[0]
+        self._db = db
+        self._db_lock = threading.Lock()
+        self._subscribers = set()
+        self._clients = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        threading.Thread(target=self._run, name="events-tail", daemon=True).start()
+
+    def _check_pid(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self._start()
+                self._pid = os.getpid()
+
+    def publish(self, event: str, data: dict):
+        self._check_pid()
+        try:
+            with self._db_lock, write_transaction(self._db):
+                self._db.execute("INSERT INTO events (event, data) VALUES (?, ?)", (event, json.dumps(data)))
+        except sqlite3.Error as exc:
+            # Écriture déjà validée: l'événement perdu est rattrapé par le polling des dashboards
+            LOG.error("Event %s not published: %s", event, exc)
+            return
+        self._wakeup.set()
+
+    def poll(self):
+        """Distribuer aux abonnés du worker les événements publiés depuis la dernière lecture"""
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT id, event, data FROM events WHERE id > ? ORDER BY id", (self._seq,)
+            ).fetchall()
+        if not rows:
+            return
+        with self._lock:
+            for row in rows:
+                item = tuple(row)
+                self._seq = item[0]
+                self._history.append(item)
+                for sub in list(self._subscribers):
+                    try:
+                        sub.put_nowait(item)
+                    except queue.Full:
+                        self._subscribers.discard(sub)
+                        sub.overflowed = True
+
+    def _prune(self):
+        with self._db_lock, write_transaction(self._db):
+            self._db.execute(
+                "DELETE FROM events WHERE id <= (SELECT max(id) FROM events) - ?", (self.history_size,)
+            )
+
+    def _run(self):
+        pruned = time.monotonic()
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            try:
+                self.poll()
+                if time.monotonic() - pruned > PRUNE_INTERVAL:
+                    pruned = time.monotonic()
+                    self._prune()
+            except sqlite3.Error as exc:  # pragma: no cover
+                LOG.error("Event log read failed: %s", exc)
+
+    def subscribe(self, last_event_id: str = None):
+        """
+        Retourner (file, événements à rejouer), ou None si le worker a déjà
+        `max_clients` flux ouverts. Les événements à rejouer sont None si la
+        reprise est impossible (autre époque ou trop ancien).
+        """
+        self._check_pid()
+        self.poll()  # Un Last-Event-ID d'un autre worker peut être en avance sur ce worker
+        sub = queue.Queue(maxsize=self.buffer_size)
+        sub.overflowed = False
+        sub.active = True
+        with self._lock:
+            if self._clients >= self.max_clients:
+                return None
+            self._clients += 1
+            replay = []
+            if last_event_id:
+                replay = self._replay_after(last_event_id)
+            self._subscribers.add(sub)
+        return sub, replay
+
+    def unsubscribe(self, sub):
+        """Libérer la place de l'abonné (plusieurs appels possibles)"""
+        with self._lock:
+            if sub.active:
+                sub.active = False
+                self._subscribers.discard(sub)
+                self._clients -= 1
+
+    def _replay_after(self, last_event_id: str):
+        epoch, _, seq = last_event_id.partition(":")
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        last = int(seq)
+        oldest = self._history[0][0] if self._history else self._seq + 1
+        if last > self._seq or last < oldest - 1:
+            return None
+        return [item for item in self._history if item[0] > last]
+
+    def format(self, item) -> str:
+        seq, event, data = item
+        return f"id: {self.epoch}:{seq}\nevent: {event}\ndata: {data}\n\n"
+
+
+def get_broker(app) -> EventBroker:
+    return app.extensions["smartlock_events"]
+
+
+def publish(event: str, data: dict):
+    get_broker(current_app).publish(event, data)
+
+
+@bp.route("/api/events")
+def stream():
+    broker = get_broker(current_app)
+    subscription = broker.subscribe(request.headers.get("Last-Event-ID") or request.args.get("lastEventId"))
+    if subscription is None:
+        # Tous les flux du worker sont pris: les threads restants servent les kiosques
+        return Response(
+            "Trop de flux ouverts sur ce worker\n", status=503,
+            mimetype="text/plain", headers={"Retry-After": str(RETRY_AFTER)},
+        )
+    sub, replay = subscription
+
+    def generate():
+        try:
+            yield "retry: 3000\n\n"
+            if replay is None:
+                yield "event: reset\ndata: {}\n\n"
+            else:
+                for item in replay:
+                    yield broker.format(item)
+            while not sub.overflowed:
+                try:
+                    item = sub.get(timeout=KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield broker.format(item)
+        finally:
+            broker.unsubscribe(sub)
+
+    response = Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # Client parti avant le premier envoi: le générateur n'a jamais démarré
+    response.call_on_close(lambda: broker.unsubscribe(sub))
+    return response
@@ -0,0 +1,46 @@
+"""
+Configuration gunicorn du serveur Smart Locker.
+
+L'application est préchargée dans le maître (migrations appliquées une
+seule fois, sous verrou fichier) puis les workers sont forkés. Chaque
+worker a ses propres connexions SQLite, son allocateur et sa réserve de
+codes; les événements SSE et les métriques sont partagés par fichier.
+
+Rechargement sans couper les requêtes en cours:
+    kill -HUP <pid maître>    nouveaux workers, configuration relue
+    kill -USR2 <pid maître>   nouveau maître avec le nouveau code, puis
+    kill -QUIT <ancien maître> une fois les nouveaux workers prêts
+Les workers arrêtés terminent leurs requêtes pendant graceful_timeout.
+"""
+import multiprocessing
+import os
+import tempfile
+
+bind = os.environ.get("SMART_LOCK_BIND", "0.0.0.0:5000")
+
+# /metrics additionne les instantanés des workers écrits dans ce dossier
+# (metrics.SharedMetrics); un nouveau dossier à chaque démarrage à froid
+if "SMART_LOCK_METRICS_DIR" not in os.environ:
+    os.environ["SMART_LOCK_METRICS_DIR"] = tempfile.mkdtemp(prefix="smartlock-metrics-")
+
+# SQLite n'a qu'un écrivain à la fois: au-delà de quelques processus les
+# écritures attendent le verrou (voir python -m bench.workers)
+workers = int(os.environ.get("SMART_LOCK_WORKERS", min(4, multiprocessing.cpu_count() * 2)))
+
+# Threads: un client SSE (/api/events) occupe un thread tant qu'il est
+# connecté, au plus SMART_LOCK_SSE_CLIENTS par worker (events.MAX_CLIENTS)
+worker_class = "gthread"
+threads = int(os.environ.get("SMART_LOCK_THREADS", 8))
+
+preload_app = True
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = os.environ.get("SMART_LOCK_ACCESS_LOG")
+
+
+def worker_exit(server, worker):
+    import metrics
+
+    metrics.flush_shared()
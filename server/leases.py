@@ -0,0 +1,182 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from database import write_transaction
+
+
+LOG = logging.getLogger(__name__)
+
+LEASE_TTL = 300  # Secondes de validité d'un bail, renouvelé par le kiosque
+LEASE_GRACE = 60  # Délai après échéance avant de reprendre la box
+LEASE_BOXES = 2  # Boxes prêtées par défaut à chaque machine
+LEASE_MAX_BOXES = 4
+REAPER_INTERVAL = 30  # Secondes entre deux passages du thread de reprise
+EXPIRED_RETENTION_DAYS = 7  # Durée pendant laquelle un kiosque hors ligne peut encore enregistrer un bail repris
+
+
+def current_leases(db, locker_id: int):
+    return db.execute(
+        """
+        SELECT o.id AS order_id, o.closet_id, o.password, b.box_number, b.size,
+               CAST(strftime('%s', l.expires_at) - strftime('%s', 'now') AS INTEGER) AS expires_in
+        FROM box_leases l
+        JOIN orders o ON o.id = l.order_id
+        JOIN boxes b ON b.id = o.box_id
+        WHERE l.locker_id=? AND o.status='leased'
+        ORDER BY l.order_id
+        """,
+        (locker_id,),
+    ).fetchall()
+
+
+def grant_leases(db, allocator, write_with_code, locker_id: int, count: int = LEASE_BOXES, ttl: int = LEASE_TTL):
+    """
+    Renouveler les baux de la machine et la compléter jusqu'à `count`
+    boxes. Chaque box prêtée passe au statut 'leased' avec une commande
+    'leased' qui réserve son closet ID et son mot de passe: le kiosque
+    peut ouvrir la porte et afficher le code sans attendre le serveur.
+    `write_with_code(kind, sql, params)`: voir routes._write_with_code.
+    À appeler dans une transaction d'écriture. Retourne les baux en cours.
+    """
+    expires = f"+{int(ttl)} seconds"
+    db.execute(
+        """
+        UPDATE box_leases SET expires_at=datetime('now', ?)
+        WHERE locker_id=? AND order_id IN (SELECT id FROM orders WHERE status='leased')
+        """,
+        (expires, locker_id),
+    )
+    missing = count - len(current_leases(db, locker_id))
+    for _ in range(missing):
+        box = allocator.claim(db, locker_id, status="leased")
+        if box is None:
+            break
+        _, cur = write_with_code(
+            "closet",
+            """
+            INSERT INTO orders (locker_id, box_id, closet_id, order_type, status)
+            VALUES (?, ?, ?, 'deposit', 'leased')
+            RETURNING id
+            """,
+            lambda code: (locker_id, box["id"], code),
+        )
+        order_id = cur.fetchone()["id"]
+        write_with_code("password", "UPDATE orders SET password=? WHERE id=?", lambda code: (code, order_id))
+        db.execute(
+            "INSERT INTO box_leases (order_id, locker_id, expires_at) VALUES (?, ?, datetime('now', ?))",
+            (order_id, locker_id, expires),
+        )
+    return current_leases(db, locker_id)
+
+
+def codes_hash(closet_id: int, password: str) -> str:
+    return hashlib.sha256(f"{int(closet_id)}:{password}".encode()).hexdigest()
+
+
+def find_expired(db, locker_id: int, box_number: int, closet_id: int, password: str):
+    """Trace du bail repris correspondant exactement à ces codes, ou None"""
+    return db.execute(
+        """
+        SELECT order_id, box_number, closet_id FROM expired_leases
+        WHERE locker_id=? AND closet_id=? AND box_number=? AND codes_hash=?
+        """,
+        (locker_id, closet_id, box_number, codes_hash(closet_id, password or "")),
+    ).fetchone()
+
+
+def reclaim_expired(db, grace: int = LEASE_GRACE):
+    """
+    Reprendre les boxes dont le bail a expiré depuis plus de `grace`
+    secondes. À appeler dans une transaction d'écriture. Retourne les IDs
+    des machines concernées. Chaque bail repris laisse une trace
+    (expired_leases) pendant EXPIRED_RETENTION_DAYS: seul un dépôt du
+    kiosque qui lui correspond peut ensuite reprendre la box
+    (routes._register_leased_deposit).
+    """
+    db.execute(
+        "DELETE FROM expired_leases WHERE expired_at < datetime('now', ?)",
+        (f"-{EXPIRED_RETENTION_DAYS} days",),
+    )
+    cutoff = f"-{int(grace)} seconds"
+    expired = db.execute(
+        """
+        SELECT l.order_id, l.locker_id, o.box_id, o.status, o.closet_id, o.password, b.box_number
+        FROM box_leases l
+        JOIN orders o ON o.id = l.order_id
+        JOIN boxes b ON b.id = o.box_id
+        WHERE l.expires_at < datetime('now', ?)
+        """,
+        (cutoff,),
+    ).fetchall()
+    if not expired:
+        return set()
+    leased = [r for r in expired if r["status"] == "leased"]
+    db.executemany(
+        """
+        INSERT OR REPLACE INTO expired_leases (order_id, locker_id, box_number, closet_id, codes_hash)
+        VALUES (?, ?, ?, ?, ?)
+        """,
+        [
+            (r["order_id"], r["locker_id"], r["box_number"], r["closet_id"], codes_hash(r["closet_id"], r["password"]))
+            for r in leased
+        ],
+    )
+    db.execute(
+        "UPDATE boxes SET status='available' WHERE status='leased' AND id IN (SELECT value FROM json_each(?))",
+        (json.dumps([r["box_id"] for r in leased]),),
+    )
+    db.execute(
+        "DELETE FROM orders WHERE status='leased' AND id IN (SELECT value FROM json_each(?))",
+        (json.dumps([r["order_id"] for r in leased]),),
+    )
+    db.execute(
+        "DELETE FROM box_leases WHERE order_id IN (SELECT value FROM json_each(?))",
+        (json.dumps([r["order_id"] for r in expired]),),
+    )
+    if leased:
+        LOG.info("Reclaimed %s expired box leases", len(leased))
+    return {r["locker_id"] for r in leased}
+
+
+class LeaseReaper:
+    """
+    Thread qui reprend les boxes des baux expirés (kiosque éteint ou hors
+    ligne). Démarré à la première requête de chaque processus; plusieurs
+    workers peuvent tourner en même temps, la reprise est idempotente.
+    """
+
+    def __init__(self, connect_db, on_reclaim, interval: float = REAPER_INTERVAL):
+        self._connect_db = connect_db
+        self._on_reclaim = on_reclaim
+        self.interval = interval
+        self._start_lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                threading.Thread(target=self._run, name="lease-reaper", daemon=True).start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        db = self._connect_db()
+        while True:
+            time.sleep(self.interval)
+            try:
+                with write_transaction(db):
+                    lockers = reclaim_expired(db)
+                for locker_id in lockers:
+                    self._on_reclaim(locker_id)
+            except Exception as exc:  # pragma: no cover
+                LOG.error("Lease reclaim failed: %s", exc)
+
+
+def get_reaper(app, shard: int = 0) -> LeaseReaper:
+    return app.extensions["smartlock_leases"][shard]
+
@@ -0,0 +1,360 @@
+"""
+Outils d'administration du serveur.
+
+    python manage.py migrate            # appliquer les migrations en attente
+    python manage.py explain            # plans de requête avant/après index
+    python manage.py box-size 1 1-5 L   # classe de taille des boxes 1 à 5 de la machine 1
+    python manage.py archive --days 90  # archiver les commandes terminées depuis 90 jours
+    python manage.py provision fleet.csv  # créer/mettre à jour des machines (CSV ou JSON)
+    python manage.py telemetry-prune --days 14  # supprimer la télémétrie de plus de 14 jours
+    python manage.py reap-stale --after 900  # traiter les ouvertures sans fermeture depuis 15 min
+    python manage.py rollups-backfill   # recalculer les agrégats de rapport depuis l'historique
+    python manage.py shards             # machines par shard (SMART_LOCK_SHARDS)
+    python manage.py shard-move 42 2    # déplacer la machine 42 dans le shard 2, serveur en marche
+    python manage.py shard-rebalance --dry-run  # égaliser le nombre de machines par shard
+
+Les commandes qui parcourent la base (archive, telemetry-prune, reap-stale,
+rollups-backfill) traitent chaque shard à tour de rôle.
+"""
+import argparse
+import os
+import sys
+import time
+
+from allocator import SIZE_CLASSES
+from app import create_app
+from archive import ARCHIVE_BATCH_SIZE, archive_orders
+from codes import ACTIVE_ORDER_SQL
+from telemetry import PRUNE_BATCH_SIZE, prune_telemetry
+from rollups import BACKFILL_PAUSE, backfill_rollups
+from stale import DOOR_STATE_MAX_AGE, IN_FLIGHT, STALE_AFTER, reap_stale
+from provisioning import CSV_COLUMNS, parse_box_range, parse_manifest
+from database import (
+    MIGRATIONS, connect, get_db, get_router, locate_machine, migrate, provision_fleet, schema_version,
+    write_transaction,
+)
+from shards import MOVE_CHUNK, move_machine, plan_rebalance, shard_stats
+
+
+# Requêtes critiques des routes kiosque (mêmes formes que dans routes.py)
+HOT_QUERIES = {
+    "close_deposit": (
+        """
+        SELECT id, status FROM orders
+        WHERE box_id=? AND closet_id=? AND tracking_code=? AND order_type='deposit'
+        ORDER BY created_at DESC
+        LIMIT 1
+        """,
+        (1, 1000, "X"),
+    ),
+    "open_withdraw": (
+        f"""
+        SELECT o.id, o.closet_id, o.status, b.id as box_id, b.box_number, b.status as box_status
+        FROM orders o
+        JOIN boxes b ON o.box_id = b.id
+        WHERE o.locker_id=? AND o.password=? AND o.{ACTIVE_ORDER_SQL} AND o.order_type='deposit'
+        """,
+        (1, "000000"),
+    ),
+    "close_withdraw": (
+        """
+        SELECT id, status, created_at, closed_at FROM orders
+        WHERE box_id=? AND closet_id=? AND order_type='deposit'
+        ORDER BY created_at DESC
+        LIMIT 1
+        """,
+        (1, 1000),
+    ),
+    "register_leased_deposit": (
+        f"""
+        SELECT o.id, o.status, o.tracking_code, o.password, b.id AS box_id, b.size
+        FROM orders o JOIN boxes b ON o.box_id = b.id
+        WHERE o.locker_id=? AND o.closet_id=? AND o.{ACTIVE_ORDER_SQL}
+          AND b.box_number=? AND o.order_type='deposit'
+        """,
+        (1, 1000, 1),
+    ),
+    "current_leases": (
+        """
+        SELECT o.id AS order_id, o.closet_id, o.password, b.box_number, b.size
+        FROM box_leases l
+        JOIN orders o ON o.id = l.order_id
+        JOIN boxes b ON b.id = o.box_id
+        WHERE l.locker_id=? AND o.status='leased'
+        ORDER BY l.order_id
+        """,
+        (1,),
+    ),
+    "reclaim_expired_leases": (
+        """
+        SELECT l.order_id, l.locker_id, o.box_id, o.status FROM box_leases l
+        JOIN orders o ON o.id = l.order_id
+        WHERE l.expires_at < datetime('now', ?)
+        """,
+        ("-60 seconds",),
+    ),
+    "machine_telemetry": (
+        """
+        SELECT m.name, s.ts, s.value
+        FROM telemetry_samples s
+        JOIN telemetry_metrics m ON m.id = s.metric_id
+        WHERE s.locker_id=? AND s.ts >= ?
+        ORDER BY s.metric_id, s.ts
+        LIMIT ?
+        """,
+        (1, 0, 5000),
+    ),
+    "stale_openings": (
+        "SELECT id FROM orders WHERE status IN (?, ?) AND updated_at < datetime('now', ?)",
+        (*IN_FLIGHT, "-900 seconds"),
+    ),
+    "door_state": (
+        """
+        SELECT s.value FROM telemetry_samples s
+        WHERE s.locker_id=? AND s.metric_id=(SELECT id FROM telemetry_metrics WHERE name='doors.closed_mask')
+          AND s.ts >= ?
+        ORDER BY s.ts DESC
+        LIMIT 1
+        """,
+        (1, 0),
+    ),
+    "occupied_boxes": (
+        "SELECT count(*) FROM boxes WHERE locker_id=? AND status IN ('occupied', 'withdraw_open')",
+        (1,),
+    ),
+    "machine_rollups": (
+        """
+        SELECT bucket, deposits, withdrawals, cancelled, dwell_count, dwell_seconds, occupied_last, occupied_peak
+        FROM order_rollups
+        WHERE locker_id=? AND period=? AND bucket >= ? AND bucket < ?
+        ORDER BY bucket
+        """,
+        (1, "hour", "2026-01-01", "2026-01-08"),
+    ),
+    "shard_move_orders": (
+        """
+        SELECT id FROM orders
+        WHERE box_id IN (SELECT id FROM boxes WHERE locker_id=?) AND locker_id=?
+        """,
+        (1, 1),
+    ),
+    "shard_move_archive": (
+        "SELECT id FROM orders_archive WHERE locker_id=?",
+        (1,),
+    ),
+    "allocator_load": (
+        "SELECT id, box_number, size, status FROM boxes WHERE locker_id=? AND reserved=0",
+        (1,),
+    ),
+}
+
+
+def _plan(db, sql: str, params=()):
+    rows = db.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall()
+    return [r["detail"] for r in rows]
+
+
+def _plan_is_indexed(plan) -> bool:
+    """Un plan est acceptable s'il ne parcourt ni ne trie une table entière"""
+    for detail in plan:
+        if detail.startswith("SCAN ") and "USING" not in detail:
+            return False
+        if "TEMP B-TREE" in detail:
+            return False
+    return True
+
+
+def cmd_migrate(args):
+    app = create_app()
+    with app.app_context():
+        for shard in get_router(app).shards():
+            print(f"Shard {shard}: schéma en version {schema_version(get_db(app, shard))}")
+
+
+def cmd_explain(args):
+    # Base vide en mémoire: schéma courant sans index secondaires, puis complet
+    before = connect(":memory:")
+    migrate(before)
+    for row in before.execute("SELECT name FROM sqlite_master WHERE type='index' AND name LIKE 'idx_%'").fetchall():
+        before.execute(f"DROP INDEX {row['name']}")
+    after = connect(":memory:")
+    migrate(after)
+
+    failed = False
+    for name, (sql, params) in HOT_QUERIES.items():
+        plan_before = _plan(before, sql, params)
+        plan_after = _plan(after, sql, params)
+        ok = _plan_is_indexed(plan_after)
+        failed = failed or not ok
+        print(f"== {name} [{'OK' if ok else 'SCAN'}]")
+        print("  avant: " + " | ".join(plan_before))
+        print("  après: " + " | ".join(plan_after))
+    print(f"Schéma v{MIGRATIONS[-1][0]}")
+    return 1 if failed else 0
+
+
+def cmd_box_size(args):
+    app = create_app()
+    with app.app_context():
+        db, locker = locate_machine(app, args.machine_id)
+        if not locker:
+            print(f"Machine {args.machine_id} non trouvée")
+            return 1
+        with write_transaction(db):
+            cur = db.executemany(
+                "UPDATE boxes SET size=? WHERE locker_id=? AND box_number=?",
+                [(args.size, locker["id"], n) for n in parse_box_range(args.boxes)],
+            )
+        print(f"{cur.rowcount} box(es) en taille {args.size} (prise en compte par le serveur dans la seconde)")
+
+
+def cmd_archive(args):
+    app = create_app()
+    with app.app_context():
+        count = sum(
+            archive_orders(get_db(app, shard), args.days, batch_size=args.batch_size)
+            for shard in get_router(app).shards()
+        )
+    print(f"{count} commande(s) archivée(s)")
+
+
+def cmd_telemetry_prune(args):
+    app = create_app()
+    with app.app_context():
+        count = sum(
+            prune_telemetry(get_db(app, shard), args.days, batch_size=args.batch_size)
+            for shard in get_router(app).shards()
+        )
+    print(f"{count} échantillon(s) de télémétrie supprimé(s)")
+
+
+def cmd_reap_stale(args):
+    app = create_app()
+    with app.app_context():
+        start = time.perf_counter()
+        counts = {"reverted": 0, "flagged": 0}
+        for shard in get_router(app).shards():
+            _, shard_counts = reap_stale(get_db(app, shard), args.after, args.door_max_age)
+            counts = {key: counts[key] + shard_counts[key] for key in counts}
+        elapsed = time.perf_counter() - start
+    print(
+        f"{counts['reverted']} retrait(s) annulé(s), "
+        f"{counts['flagged']} box(es) marquée(s) stuck en {elapsed:.3f} s"
+    )
+
+
+def cmd_rollups_backfill(args):
+    app = create_app()
+    with app.app_context():
+        start = time.perf_counter()
+        count = 0
+        for shard, path in enumerate(get_router(app).paths):
+            reader = connect(path)
+            count += backfill_rollups(get_db(app, shard), reader, pause=args.pause)
+            reader.close()
+        elapsed = time.perf_counter() - start
+    print(f"Agrégats recalculés pour {count} machine(s) en {elapsed:.1f} s")
+
+
+def cmd_provision(args):
+    fmt = args.format or ("csv" if os.path.splitext(args.manifest)[1].lower() == ".csv" else "json")
+    with open(args.manifest, encoding="utf-8") as f:
+        machines = parse_manifest(f.read(), fmt)
+    app = create_app()
+    with app.app_context():
+        start = time.perf_counter()
+        result = provision_fleet(app, machines)
+        elapsed = time.perf_counter() - start
+    print(f"{result['machines']} machine(s), {result['boxes']} box(es) en {elapsed:.3f} s")
+
+
+def cmd_shards(args):
+    app = create_app()
+    for stats in shard_stats(get_router(app)):
+        print(f"Shard {stats['shard']}: {stats['machines']} machine(s), {stats['mapped']} dans shard_map ({stats['path']})")
+
+
+def cmd_shard_move(args):
+    app = create_app()
+    try:
+        result = move_machine(get_router(app), args.machine_id, args.shard, chunk=args.chunk)
+    except (LookupError, ValueError) as exc:
+        print(exc)
+        return 1
+    if not result["moved"]:
+        print(f"Machine {args.machine_id} déjà dans le shard {args.shard}")
+        return 0
+    print(
+        f"Machine {args.machine_id}: shard {result['source']} -> {result['target']} "
+        f"(shard source verrouillé {result['lockedSeconds'] * 1000:.1f} ms, "
+        f"{result['telemetrySamples']} échantillon(s) de télémétrie)"
+    )
+
+
+def cmd_shard_rebalance(args):
+    app = create_app()
+    router = get_router(app)
+    moves = plan_rebalance(router)
+    for machine_id, source, target in moves:
+        print(f"Machine {machine_id}: shard {source} -> {target}")
+        if not args.dry_run:
+            move_machine(router, machine_id, target, chunk=args.chunk)
+    print(f"{len(moves)} déplacement(s){' prévus' if args.dry_run else ''}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Administration Smart Locker")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    sub.add_parser("migrate", help="Appliquer les migrations").set_defaults(func=cmd_migrate)
+    sub.add_parser("explain", help="Vérifier les plans des requêtes kiosque").set_defaults(func=cmd_explain)
+
+    p = sub.add_parser("box-size", help="Définir la classe de taille de boxes")
+    p.add_argument("machine_id", type=int)
+    p.add_argument("boxes", help="Numéros de box, ex: 1-5,8")
+    p.add_argument("size", choices=SIZE_CLASSES)
+    p.set_defaults(func=cmd_box_size)
+
+    p = sub.add_parser("archive", help="Archiver les commandes terminées")
+    p.add_argument("--days", type=int, default=90, help="Âge minimum depuis la dernière mise à jour")
+    p.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE)
+    p.set_defaults(func=cmd_archive)
+
+    p = sub.add_parser("provision", help="Créer ou mettre à jour des machines depuis un manifeste")
+    p.add_argument("manifest", help="Fichier CSV (colonnes: " + ", ".join(CSV_COLUMNS) + ") ou JSON")
+    p.add_argument("--format", choices=("csv", "json"))
+    p.set_defaults(func=cmd_provision)
+
+    p = sub.add_parser("telemetry-prune", help="Supprimer la télémétrie ancienne")
+    p.add_argument("--days", type=int, default=14)
+    p.add_argument("--batch-size", type=int, default=PRUNE_BATCH_SIZE)
+    p.set_defaults(func=cmd_telemetry_prune)
+
+    p = sub.add_parser("reap-stale", help="Traiter les ouvertures restées sans fermeture")
+    p.add_argument("--after", type=int, default=STALE_AFTER, help="Secondes sans fermeture confirmée")
+    p.add_argument("--door-max-age", type=int, default=DOOR_STATE_MAX_AGE, help="Âge max de l'état des portes (s)")
+    p.set_defaults(func=cmd_reap_stale)
+
+    p = sub.add_parser("rollups-backfill", help="Recalculer les agrégats de rapport depuis l'historique")
+    p.add_argument("--pause", type=float, default=BACKFILL_PAUSE, help="Pause entre deux machines (s)")
+    p.set_defaults(func=cmd_rollups_backfill)
+
+    sub.add_parser("shards", help="Machines par shard").set_defaults(func=cmd_shards)
+
+    p = sub.add_parser("shard-move", help="Déplacer une machine dans un autre shard")
+    p.add_argument("machine_id", type=int)
+    p.add_argument("shard", type=int)
+    p.add_argument("--chunk", type=int, default=MOVE_CHUNK, help="Lignes par transaction après la copie")
+    p.set_defaults(func=cmd_shard_move)
+
+    p = sub.add_parser("shard-rebalance", help="Égaliser le nombre de machines par shard")
+    p.add_argument("--dry-run", action="store_true", help="Afficher les déplacements sans les faire")
+    p.add_argument("--chunk", type=int, default=MOVE_CHUNK)
+    p.set_defaults(func=cmd_shard_rebalance)
+
+    args = parser.parse_args(argv)
+    return args.func(args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,357 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+from flask import Blueprint, Response, current_app, g, request
+
+
+bp = Blueprint("metrics", __name__)
+
+LOG = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1, 0.5, 1.0)
+MAX_QUERY_LABELS = 500  # Taille max du cache SQL -> étiquette, par connexion
+FLUSH_INTERVAL = 5.0  # Secondes entre deux instantanés d'un worker dans SMART_LOCK_METRICS_DIR
+
+_SQL_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE|JOIN)\s+(\w+)", re.IGNORECASE)
+
+
+def query_label(sql: str) -> str:
+    """'SELECT ... FROM orders o JOIN boxes b ...' -> 'select orders'"""
+    words = sql.split(None, 1)
+    if not words:
+        return "empty"
+    op = words[0].lower()
+    match = _SQL_TABLE.search(sql)
+    return f"{op} {match.group(1)}" if match else op
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Registry:
+    """
+    Compteurs et histogrammes en mémoire, exposés au format texte
+    Prometheus. Un seul verrou, pris quelques microsecondes par mesure.
+    Les valeurs sont propres au processus: avec plusieurs workers, voir
+    SharedMetrics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+
+    def describe(self, name: str, kind: str, text: str):
+        self._help[name] = (kind, text)
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1):
+        with self._lock:
+            key = (name, labels)
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, labels: tuple, value: float, buckets=LATENCY_BUCKETS):
+        with self._lock:
+            key = (name, labels)
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = Histogram(buckets)
+            hist.observe(value)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def snapshot(self) -> dict:
+        """Valeurs courantes, sérialisables en JSON"""
+        with self._lock:
+            return {
+                "counters": [[name, labels, value] for (name, labels), value in self._counters.items()],
+                "histograms": [
+                    [name, labels, hist.buckets, list(hist.counts), hist.sum]
+                    for (name, labels), hist in self._histograms.items()
+                ],
+            }
+
+    def render(self, snapshots=None) -> str:
+        """Texte Prometheus de la somme des `snapshots` (défaut: ce processus)"""
+        if snapshots is None:
+            snapshots = [self.snapshot()]
+        counters, histograms = {}, {}
+        for snap in snapshots:
+            for name, labels, value in snap["counters"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, buckets, counts, total in snap["histograms"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                merged = histograms.get(key)
+                if merged is None:
+                    histograms[key] = (tuple(buckets), list(counts), total)
+                else:
+                    histograms[key] = (merged[0], [a + b for a, b in zip(merged[1], counts)], merged[2] + total)
+        lines = []
+        described = set()
+
+        def header(name):
+            if name not in described and name in self._help:
+                kind, text = self._help[name]
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+                described.add(name)
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name)
+            lines.append(f"{name}{_labels(labels)} {value:g}")
+        for (name, labels), (buckets, counts, total) in sorted(histograms.items()):
+            header(name)
+            cumulative = 0
+            for bound, count in zip(buckets, counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', f'{bound:g}'),))} {cumulative}")
+            cumulative += counts[-1]
+            lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+class SharedMetrics:
+    """
+    Métriques de tous les workers gunicorn: chaque worker écrit
+    l'instantané de son registre dans `directory` (un fichier par pid,
+    toutes les `interval` secondes et à sa sortie), /metrics en fait la
+    somme. Les fichiers des workers arrêtés restent: les compteurs ne
+    reculent jamais, quel que soit le worker qui répond.
+    """
+
+    def __init__(self, registry: Registry, directory: str, interval: float = FLUSH_INTERVAL):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self._start_lock = threading.Lock()
+        self._pid = None
+        os.makedirs(directory, exist_ok=True)
+        _SHARED.append(self)
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                # Valeurs héritées du processus qui a préchargé l'application: déjà comptées par lui
+                self.registry.reset()
+                threading.Thread(target=self._run, name="metrics-flush", daemon=True).start()
+                self._pid = os.getpid()
+
+    def flush(self):
+        if self._pid != os.getpid():
+            return  # Processus qui n'a servi aucune requête
+        path = os.path.join(self.directory, f"worker-{self._pid}.json")
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.registry.snapshot(), f)
+        os.replace(tmp, path)
+
+    def collect(self) -> list:
+        """Instantanés de tous les workers, celui du processus courant à jour"""
+        self.flush()
+        snapshots = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), encoding="utf-8") as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError) as exc:
+                LOG.warning("Skipping metrics snapshot %s: %s", name, exc)
+        return snapshots
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except OSError as exc:  # pragma: no cover
+                LOG.error("Metrics flush failed: %s", exc)
+
+
+_SHARED = []
+
+
+def flush_shared():
+    """Dernier instantané des métriques du worker (hook gunicorn worker_exit)"""
+    for shared in _SHARED:
+        try:
+            shared.flush()
+        except OSError as exc:
+            LOG.error("Metrics flush failed: %s", exc)
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    inner = ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in labels)
+    return "{" + inner + "}"
+
+
+def new_registry() -> Registry:
+    registry = Registry()
+    registry.describe("smartlock_http_request_duration_seconds", "histogram", "Durée des requêtes HTTP par endpoint")
+    registry.describe("smartlock_http_responses_total", "counter", "Réponses HTTP par endpoint et statut")
+    registry.describe("smartlock_sqlite_query_duration_seconds", "histogram", "Durée d'exécution des requêtes SQL")
+    registry.describe("smartlock_sqlite_rows_total", "counter", "Lignes lues ou modifiées par requête SQL")
+    registry.describe("smartlock_sqlite_lock_wait_seconds", "histogram", "Attente du verrou d'écriture (BEGIN IMMEDIATE)")
+    registry.describe("smartlock_sqlite_busy_total", "counter", "Erreurs 'database is locked' après le busy timeout")
+    registry.describe("smartlock_code_retries_total", "counter", "Codes retirés après collision sur un index unique")
+    registry.describe("smartlock_telemetry_rows_total", "counter", "Échantillons de télémétrie écrits en base")
+    registry.describe("smartlock_telemetry_rejected_total", "counter", "Échantillons de télémétrie refusés ou perdus, par raison")
+    registry.describe("smartlock_stale_boxes_total", "counter", "Boxes traitées par le reaper d'ouvertures, par nouveau statut")
+    return registry
+
+
+def get_registry(app) -> Registry:
+    return app.extensions["smartlock_metrics"]
+
+
+def inc(app, name: str, labels: tuple = ()):
+    """Incrémenter un compteur, sans effet si les métriques sont désactivées"""
+    registry = app.extensions.get("smartlock_metrics")
+    if registry is not None:
+        registry.inc(name, labels)
+
+
+class InstrumentedCursor:
+    """Compte les lignes lues au fil des fetch"""
+
+    def __init__(self, cursor, registry: Registry, labels: tuple):
+        self._cursor = cursor
+        self._registry = registry
+        self._labels = labels
+
+    def _count(self, n: int):
+        if n:
+            self._registry.inc("smartlock_sqlite_rows_total", self._labels, n)
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        self._count(row is not None)
+        return row
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._count(len(rows))
+        return rows
+
+    def fetchmany(self, size=None):
+        rows = self._cursor.fetchmany(size) if size is not None else self._cursor.fetchmany()
+        self._count(len(rows))
+        return rows
+
+    def __iter__(self):
+        n = 0
+        try:
+            for row in self._cursor:
+                n += 1
+                yield row
+        finally:
+            self._count(n)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class InstrumentedConnection:
+    """
+    Enveloppe d'une connexion sqlite3: durée et lignes par requête (étiquette
+    'opération table'), attente du verrou d'écriture et erreurs busy.
+    """
+
+    def __init__(self, conn, registry: Registry):
+        self._conn = conn
+        self._registry = registry
+        self._labels_cache = {}
+
+    def _labels(self, sql: str) -> tuple:
+        labels = self._labels_cache.get(sql)
+        if labels is None:
+            labels = (("query", query_label(sql)),)
+            if len(self._labels_cache) < MAX_QUERY_LABELS:
+                self._labels_cache[sql] = labels
+        return labels
+
+    def _run(self, method, sql, params):
+        labels = self._labels(sql)
+        start = time.perf_counter()
+        try:
+            cursor = method(sql, params)
+        except sqlite3.OperationalError as exc:
+            if "locked" in str(exc) or "busy" in str(exc):
+                self._registry.inc("smartlock_sqlite_busy_total", labels)
+            raise
+        elapsed = time.perf_counter() - start
+        if labels[0][1] == "begin":
+            self._registry.observe("smartlock_sqlite_lock_wait_seconds", (), elapsed, QUERY_BUCKETS)
+        else:
+            self._registry.observe("smartlock_sqlite_query_duration_seconds", labels, elapsed, QUERY_BUCKETS)
+        if cursor.rowcount > 0:
+            self._registry.inc("smartlock_sqlite_rows_total", labels, cursor.rowcount)
+        return InstrumentedCursor(cursor, self._registry, labels)
+
+    def execute(self, sql, params=()):
+        return self._run(self._conn.execute, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self._run(self._conn.executemany, sql, seq_of_params)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def init_app(app):
+    """
+    Activer le middleware de mesure des requêtes et l'endpoint /metrics.
+    Avec SMART_LOCK_METRICS_DIR (posé par gunicorn.conf.py), /metrics
+    agrège les workers.
+    """
+    registry = app.extensions.setdefault("smartlock_metrics", new_registry())
+    directory = os.environ.get("SMART_LOCK_METRICS_DIR")
+    if directory:
+        shared = app.extensions["smartlock_metrics_shared"] = SharedMetrics(registry, directory)
+        app.before_request(shared.start)
+
+    @app.before_request
+    def _start_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        started = g.pop("request_started", None)
+        if started is not None:
+            labels = (("endpoint", request.endpoint or "unmatched"), ("method", request.method))
+            registry.observe("smartlock_http_request_duration_seconds", labels, time.perf_counter() - started)
+            registry.inc("smartlock_http_responses_total", labels + (("status", str(response.status_code)),))
+        return response
+
+    app.register_blueprint(bp)
+
+
+@bp.route("/metrics")
+def metrics():
+    shared = current_app.extensions.get("smartlock_metrics_shared")
+    snapshots = shared.collect() if shared is not None else None
+    return Response(get_registry(current_app).render(snapshots), mimetype="text/plain; version=0.0.4")
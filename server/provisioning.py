@@ -0,0 +1,136 @@
+import csv
+import io
+import json
+
+from allocator import SIZE_CLASSES
+
+
+DEFAULT_BOX_COUNT = 16
+DEFAULT_RESERVED_BOXES = (16,)  # Quand le manifeste n'en précise pas et que la box existe
+CSV_COLUMNS = ("machine_id", "name", "location", "box_count", "reserved_boxes", "small_boxes", "large_boxes")
+
+
+def parse_box_range(text: str):
+    """'1-5,8' -> [1, 2, 3, 4, 5, 8] (séparateur ',' ou ';')"""
+    numbers = []
+    for part in str(text or "").replace(";", ",").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-", 1)
+            numbers.extend(range(int(first), int(last) + 1))
+        else:
+            numbers.append(int(part))
+    return numbers
+
+
+def _as_list(value):
+    if isinstance(value, (list, tuple)):
+        return [int(v) for v in value]
+    return parse_box_range(value)
+
+
+def normalize_machine(entry: dict) -> dict:
+    """
+    Valider une entrée de manifeste (clés JSON camelCase ou colonnes CSV)
+    et retourner {machine_id, name, location, status, box_count, reserved, sizes}.
+    """
+    if not isinstance(entry, dict):
+        raise ValueError(f"Entrée invalide {entry!r}")
+
+    def get(*keys, default=None):
+        for key in keys:
+            if entry.get(key) not in (None, ""):
+                return entry[key]
+        return default
+
+    try:
+        machine_id = int(get("machineId", "machine_id"))
+        box_count = int(get("boxCount", "box_count", default=DEFAULT_BOX_COUNT))
+        default_reserved = [n for n in DEFAULT_RESERVED_BOXES if n <= box_count]
+        reserved = set(_as_list(get("reservedBoxes", "reserved_boxes", default=default_reserved)))
+        sizes = {}
+        for size, keys in (("S", ("small_boxes",)), ("L", ("large_boxes",))):
+            for n in _as_list(get(*keys, default="")):
+                sizes[n] = size
+        for size, boxes in (get("boxSizes", default={}) or {}).items():
+            if size not in SIZE_CLASSES:
+                raise ValueError(f"taille inconnue {size}")
+            for n in _as_list(boxes):
+                sizes[n] = size
+    except (AttributeError, TypeError, ValueError) as exc:
+        raise ValueError(f"Entrée invalide {entry!r}: {exc}")
+
+    if machine_id < 1 or box_count < 1:
+        raise ValueError(f"Entrée invalide {entry!r}: machineId et boxCount doivent être positifs")
+    out_of_range = [n for n in reserved.union(sizes) if not 1 <= n <= box_count]
+    if out_of_range:
+        raise ValueError(f"Machine {machine_id}: boxes hors plage {sorted(out_of_range)}")
+
+    return {
+        "machine_id": machine_id,
+        "name": get("name", default=f"Locker {machine_id}"),
+        "location": get("location"),
+        "status": get("status", default="active"),
+        "box_count": box_count,
+        "reserved": reserved,
+        "sizes": sizes,
+    }
+
+
+def parse_manifest(text: str, fmt: str = "json"):
+    """Lire un manifeste JSON (liste ou {"machines": [...]}) ou CSV"""
+    if fmt == "csv":
+        entries = list(csv.DictReader(io.StringIO(text)))
+    else:
+        data = json.loads(text)
+        entries = data.get("machines", []) if isinstance(data, dict) else data
+    machines = [normalize_machine(e) for e in entries]
+    ids = [m["machine_id"] for m in machines]
+    if len(ids) != len(set(ids)):
+        raise ValueError("machineId en double dans le manifeste")
+    return machines
+
+
+def provision_machines(db, machines):
+    """
+    Créer ou mettre à jour des machines et leurs boxes (idempotent sur
+    machine_id). À appeler dans une transaction: tout le manifeste est
+    appliqué d'un coup. Le statut des boxes existantes est conservé; les
+    boxes au-delà de box_count ne sont jamais supprimées.
+    Retourne {"machines": n, "boxes": n}.
+    """
+    if not machines:
+        return {"machines": 0, "boxes": 0}
+
+    db.executemany(
+        """
+        INSERT INTO lockers (machine_id, name, location, status) VALUES (?, ?, ?, ?)
+        ON CONFLICT(machine_id) DO UPDATE SET
+            name=excluded.name, location=excluded.location, status=excluded.status
+        """,
+        [(m["machine_id"], m["name"], m["location"], m["status"]) for m in machines],
+    )
+    locker_ids = {
+        row["machine_id"]: row["id"]
+        for row in db.execute(
+            "SELECT id, machine_id FROM lockers WHERE machine_id IN (SELECT value FROM json_each(?))",
+            (json.dumps([m["machine_id"] for m in machines]),),
+        )
+    }
+
+    boxes = [
+        (locker_ids[m["machine_id"]], n, m["sizes"].get(n, "M"), int(n in m["reserved"]))
+        for m in machines
+        for n in range(1, m["box_count"] + 1)
+    ]
+    db.executemany(
+        """
+        INSERT INTO boxes (locker_id, box_number, size, reserved, status) VALUES (?, ?, ?, ?, 'available')
+        ON CONFLICT(locker_id, box_number) DO UPDATE SET
+            size=excluded.size, reserved=excluded.reserved
+        """,
+        boxes,
+    )
+    return {"machines": len(machines), "boxes": len(boxes)}
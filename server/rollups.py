@@ -0,0 +1,197 @@
+import time
+
+from database import write_transaction
+
+
+# Granularités: (période, format strftime du début de l'intervalle, en UTC comme CURRENT_TIMESTAMP)
+PERIODS = (("hour", "%Y-%m-%d %H:00:00"), ("day", "%Y-%m-%d"))
+# Boxes qui contiennent un colis
+OCCUPIED_STATUSES = ("occupied", "withdraw_open")
+MAX_RANGE_DAYS = {"hour": 31, "day": 731}  # Lignes lues par machine au plus: 744 ou 731
+DEFAULT_RANGE_DAYS = {"hour": 7, "day": 90}
+BACKFILL_PAUSE = 0.02  # Secondes entre deux machines: laisse passer les requêtes kiosque
+
+_OCCUPIED_SQL = "SELECT count(*) FROM boxes WHERE locker_id=? AND status IN ({})".format(
+    ", ".join(f"'{s}'" for s in OCCUPIED_STATUSES)
+)
+
+
+def record(
+    db,
+    locker_id: int,
+    deposits: int = 0,
+    withdrawals: int = 0,
+    cancelled: int = 0,
+    released: int = 0,
+    dwell_from: str = None,
+):
+    """
+    Compter un changement d'état dans les agrégats horaire et journalier de
+    la machine. À appeler dans la transaction d'écriture du changement,
+    après la mise à jour des boxes (l'occupation y est relevée).
+    `released`: boxes occupées vidées par un reset; `dwell_from`: fermeture
+    du dépôt, pour un retrait (durée de séjour).
+    """
+    occupied = db.execute(_OCCUPIED_SQL, (locker_id,)).fetchone()[0]
+    # Le pic compte aussi l'occupation juste avant un retrait ou un reset
+    peak = occupied + withdrawals + released
+    dwell_count = 1 if dwell_from else 0
+    db.executemany(
+        """
+        INSERT INTO order_rollups (
+            locker_id, period, bucket, deposits, withdrawals, cancelled,
+            dwell_count, dwell_seconds, occupied_last, occupied_peak
+        )
+        VALUES (?, ?, strftime(?, 'now'), ?, ?, ?, ?,
+                COALESCE(CAST(strftime('%s', 'now') - strftime('%s', ?) AS INTEGER), 0), ?, ?)
+        ON CONFLICT (locker_id, period, bucket) DO UPDATE SET
+            deposits = deposits + excluded.deposits,
+            withdrawals = withdrawals + excluded.withdrawals,
+            cancelled = cancelled + excluded.cancelled,
+            dwell_count = dwell_count + excluded.dwell_count,
+            dwell_seconds = dwell_seconds + excluded.dwell_seconds,
+            occupied_last = excluded.occupied_last,
+            occupied_peak = max(occupied_peak, excluded.occupied_peak)
+        """,
+        [
+            (locker_id, period, fmt, deposits, withdrawals, cancelled, dwell_count, dwell_from, occupied, peak)
+            for period, fmt in PERIODS
+        ],
+    )
+
+
+# Historique des commandes d'une machine en événements, par date:
+# 1 dépôt fermé, 2 retrait, 3 annulation (après fermeture si closed_at connu)
+_EVENTS_SQL = """
+    SELECT locker_id, COALESCE(closed_at, created_at) AS ts, 1 AS kind, 0 AS dwell
+    FROM orders_history
+    WHERE locker_id = :locker AND order_type='deposit'
+      AND (closed_at IS NOT NULL OR status IN ('closed', 'withdraw_in_progress', 'withdrawn'))
+    UNION ALL
+    SELECT locker_id, updated_at, 2, CAST(strftime('%s', updated_at) - strftime('%s', COALESCE(closed_at, created_at)) AS INTEGER)
+    FROM orders_history
+    WHERE locker_id = :locker AND order_type='deposit' AND status='withdrawn'
+    UNION ALL
+    SELECT locker_id, updated_at, 3, closed_at IS NOT NULL
+    FROM orders_history
+    WHERE locker_id = :locker AND order_type='deposit' AND status='cancelled'
+    ORDER BY 2, 3
+"""
+
+
+def _hourly_rows(events, until: str):
+    """
+    Agrégats horaires d'une machine à partir de ses événements triés.
+    Les dates sont à la seconde: le pic d'occupation est relevé après tous
+    les événements d'une même seconde, dont l'ordre réel est inconnu.
+    """
+    rows, occupied, row, last_ts = {}, 0, None, None
+    for _, ts, kind, extra in events:
+        if ts >= until:
+            break
+        if ts != last_ts and row is not None:
+            row[6] = max(row[6], occupied)
+        last_ts = ts
+        bucket = ts[:13] + ":00:00"
+        row = rows.get(bucket)
+        if row is None:
+            row = rows[bucket] = [0, 0, 0, 0, 0, occupied, occupied]
+        if kind == 1:
+            row[0] += 1
+            occupied += 1
+        elif kind == 2:
+            row[1] += 1
+            row[3] += 1
+            row[4] += max(0, extra or 0)
+            occupied -= 1
+        else:
+            row[2] += 1
+            occupied -= 1 if extra else 0
+        occupied = max(0, occupied)
+        row[5] = occupied
+    if row is not None:
+        row[6] = max(row[6], occupied)
+    return rows
+
+
+def _write_locker(db, locker_id: int, rows: dict, until: str):
+    db.execute("DELETE FROM order_rollups WHERE locker_id=? AND period='hour' AND bucket < ?", (locker_id, until))
+    db.executemany(
+        """
+        INSERT INTO order_rollups (
+            locker_id, period, bucket, deposits, withdrawals, cancelled,
+            dwell_count, dwell_seconds, occupied_last, occupied_peak
+        )
+        VALUES (?, 'hour', ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        [(locker_id, bucket, *row) for bucket, row in rows.items()],
+    )
+    # Jours recalculés depuis les heures, y compris l'heure en cours tenue par les routes
+    db.execute("DELETE FROM order_rollups WHERE locker_id=? AND period='day'", (locker_id,))
+    db.execute(
+        """
+        INSERT INTO order_rollups (
+            locker_id, period, bucket, deposits, withdrawals, cancelled,
+            dwell_count, dwell_seconds, occupied_last, occupied_peak
+        )
+        SELECT h.locker_id, 'day', substr(h.bucket, 1, 10), sum(h.deposits), sum(h.withdrawals), sum(h.cancelled),
+               sum(h.dwell_count), sum(h.dwell_seconds),
+               (SELECT l.occupied_last FROM order_rollups l
+                WHERE l.locker_id = h.locker_id AND l.period = 'hour' AND l.bucket < date(substr(h.bucket, 1, 10), '+1 day')
+                ORDER BY l.bucket DESC LIMIT 1),
+               max(h.occupied_peak)
+        FROM order_rollups h
+        WHERE h.locker_id=? AND h.period='hour'
+        GROUP BY substr(h.bucket, 1, 10)
+        """,
+        (locker_id,),
+    )
+    # order_rollups n'a pas de trigger sur change_counter: invalider les ETag admin
+    db.execute("UPDATE change_counter SET version = version + 1 WHERE id = 1")
+
+
+_CURRENT_HOUR_SQL = "SELECT strftime('%Y-%m-%d %H:00:00', 'now')"
+
+
+def _read_locker(reader, locker_id: int):
+    """(heure en cours, événements de la machine) lus dans un même instantané"""
+    reader.execute("BEGIN")
+    try:
+        until = reader.execute(_CURRENT_HOUR_SQL).fetchone()[0]
+        events = reader.execute(_EVENTS_SQL, {"locker": locker_id}).fetchall()
+    finally:
+        reader.rollback()
+    return until, events
+
+
+def backfill_rollups(db, reader, pause: float = BACKFILL_PAUSE) -> int:
+    """
+    Recalculer les agrégats depuis tout l'historique (orders + archive),
+    pour les heures terminées; l'heure en cours reste tenue par les routes.
+    `reader` est une seconde connexion: chaque machine y est lue dans un
+    instantané court, heure limite comprise, sans prendre le verrou
+    d'écriture, puis réécrite dans une transaction courte. Si l'heure a
+    changé entre la lecture et l'écriture, la machine est relue. Les jours
+    sont recalculés dans cette transaction depuis les heures, y compris
+    celles tenues par les routes.
+    Approximations pour les commandes d'avant closed_at: fermeture du dépôt
+    = création, annulations sans effet sur l'occupation.
+    Retourne le nombre de machines traitées.
+    """
+    lockers = [row[0] for row in reader.execute("SELECT id FROM lockers ORDER BY id")]
+    done = 0
+    for locker_id in lockers:
+        while True:
+            until, events = _read_locker(reader, locker_id)
+            if not events:
+                break
+            rows = _hourly_rows(events, until)
+            with write_transaction(db):
+                written = db.execute(_CURRENT_HOUR_SQL).fetchone()[0] == until
+                if written:
+                    _write_locker(db, locker_id, rows, until)
+            if written:
+                done += 1
+                time.sleep(pause)
+                break
+    return done
@@ -1,151 +1,366 @@
-import random
-import string
+import sqlite3
 from flask import Blueprint, current_app, jsonify, render_template, request, redirect, url_for
-from database import get_db, close_db
+from database import MachineMoved, close_db, get_db, get_router, is_moved_error, locate_machine, shard_of_id, write_transaction
+from allocator import SIZE_CLASSES, get_allocator
+from codes import ACTIVE_ORDER_SQL, get_code_pool
+from leases import LEASE_BOXES, LEASE_MAX_BOXES, LEASE_TTL, find_expired, grant_leases
+from events import get_broker, publish
+from stale import publish_changes, reset_boxes
+import metrics
+import rollups
 
 
 bp = Blueprint("routes", __name__)
 
+CODE_ATTEMPTS = 5  # Tirages avant d'abandonner sur collision de code
+MOVED_RETRY_AFTER = 1  # Secondes avant de réessayer une machine en cours de changement de shard
+
 
 @bp.teardown_app_request
 def teardown(exception):
     close_db()
 
 
-def _get_db():
-    return get_db(current_app)
-
-
-def _box_allowed(box_number: int) -> bool:
-    """Box 16 est réservée"""
-    return 1 <= box_number <= 15
-
-
-def _generate_closet_id():
-    return random.randint(1000, 9999)
+def _get_locker(machine_id: int):
+    """(connexion du shard de la machine, locker ou None)"""
+    return locate_machine(current_app, machine_id)
 
 
-def _generate_password():
-    return "".join(random.choices(string.digits, k=6))
+class CodeCollision(Exception):
+    pass
 
 
-def _get_locker_by_machine_id(db, machine_id: int):
-    """Récupérer le locker par son ID machine"""
-    return db.execute(
-        "SELECT id, machine_id, name, status FROM lockers WHERE machine_id=?",
-        (machine_id,)
-    ).fetchone()
-
-
-def _find_available_box(db, locker_id: int):
-    """Trouver une box disponible (exclut box 16)"""
-    box = db.execute(
-        """
-        SELECT id, box_number FROM boxes 
-        WHERE locker_id=? AND status='available' AND box_number <= 15
-        ORDER BY box_number
-        LIMIT 1
-        """,
-        (locker_id,)
-    ).fetchone()
-    return box
+def _write_with_code(db, kind: str, locker_id: int, sql: str, params):
+    """
+    Exécuter `sql` avec un code unique (`params(code)`) tiré de la réserve
+    de la machine. Les index uniques partiels rejettent un code déjà actif:
+    on retire un autre code. Retourne (code, curseur).
+    """
+    pool = get_code_pool(current_app)
+    for _ in range(CODE_ATTEMPTS):
+        code = pool.take(kind, locker_id)
+        try:
+            return code, db.execute(sql, params(code))
+        except sqlite3.IntegrityError as exc:
+            if is_moved_error(exc):
+                raise
+            metrics.inc(current_app, "smartlock_code_retries_total", (("kind", kind),))
+            continue
+    raise CodeCollision(kind)
+
+
+@bp.errorhandler(CodeCollision)
+def code_collision(exc):
+    return jsonify({"message": "Impossible de générer un code unique, réessayez"}), 503
+
+
+@bp.app_errorhandler(MachineMoved)
+@bp.app_errorhandler(sqlite3.IntegrityError)
+def machine_moved(exc):
+    """Machine passée dans un autre shard pendant la requête: carte relue, le client réessaie"""
+    if not isinstance(exc, MachineMoved) and not is_moved_error(exc):
+        raise exc
+    get_router(current_app).reload()
+    resp = jsonify({"message": "Machine en cours de déplacement, réessayez"})
+    resp.headers["Retry-After"] = str(MOVED_RETRY_AFTER)
+    return resp, 503
+
+
+def _publish_transition(machine_id: int, box_id: int, box_number: int, box_status: str, previous: str, order=None):
+    """Diffuser aux dashboards (SSE) un changement validé de box et de commande"""
+    publish("box", {
+        "machineId": machine_id,
+        "boxId": box_id,
+        "boxNumber": box_number,
+        "status": box_status,
+        "previousStatus": previous,
+    })
+    if order is not None:
+        publish("order", dict(order, machineId=machine_id, boxNumber=box_number))
 
 
 @bp.route("/")
 def index():
-    db = _get_db()
-    
-    # Récupérer toutes les boxes avec leur statut
-    boxes = db.execute(
-        """
-        SELECT b.id, b.box_number, b.status, l.machine_id, l.name as locker_name
-        FROM boxes b
-        JOIN lockers l ON b.locker_id = l.id
-        ORDER BY l.machine_id, b.box_number
-        """
-    ).fetchall()
-    
-    # Récupérer les dernières commandes
-    orders = db.execute(
-        """
-        SELECT o.id, l.machine_id, b.box_number, o.closet_id, o.tracking_code, 
-               o.password, o.order_type, o.status, o.created_at
-        FROM orders o
-        JOIN lockers l ON o.locker_id = l.id
-        JOIN boxes b ON o.box_id = b.id
-        ORDER BY o.created_at DESC 
-        LIMIT 20
-        """
-    ).fetchall()
-    
-    return render_template("index.html", boxes=boxes, orders=orders)
+    # Le dashboard charge ses données via /api/admin (admin_api.py)
+    return render_template("index.html")
 
 
 @bp.route("/boxes/<int:box_id>/reset", methods=["POST"])
 def reset_box(box_id):
-    db = _get_db()
-    db.execute("UPDATE boxes SET status='available' WHERE id=?", (box_id,))
-    db.execute("UPDATE orders SET status='cancelled' WHERE box_id=? AND status NOT IN ('closed', 'withdrawn')", (box_id,))
-    db.commit()
+    shard = shard_of_id(box_id)
+    if shard >= get_router(current_app).count:
+        return redirect(url_for("routes.index"))
+    db = get_db(current_app, shard)
+    with write_transaction(db):
+        changes = reset_boxes(db, [box_id])
+    for change in changes:
+        get_allocator(current_app).invalidate(change["lockerId"])
+    publish_changes(get_broker(current_app), changes)
     return redirect(url_for("routes.index"))
 
 
 @bp.route("/api/deposit/open", methods=["POST"])
 def open_deposit():
     """
-    Dépôt: Le client envoie tracking_code + machine_id.
-    Le serveur trouve une box disponible et la retourne.
+    Dépôt: Le client envoie tracking_code + machine_id (+ size optionnel).
+    Le serveur trouve une box disponible et la retourne, avec le mot de
+    passe réservé pour ce colis: le kiosque peut l'afficher à la fermeture
+    même si la confirmation au serveur est différée.
+    Avec boxId + closetId: enregistrement d'un dépôt sur une box prêtée
+    (voir /api/leases), la porte est déjà ouverte.
     """
     payload = request.get_json(force=True)
     machine_id = int(payload.get("lockerId", 0))  # ID de la machine
     tracking_code = payload.get("trackingCode")
+    size = payload.get("size") or SIZE_CLASSES[0]  # Par défaut: n'importe quelle box
 
     if not machine_id:
         return jsonify({"message": "lockerId requis"}), 400
     if not tracking_code:
         return jsonify({"message": "trackingCode requis"}), 400
+    if size not in SIZE_CLASSES:
+        return jsonify({"message": "size invalide (S, M ou L)"}), 400
 
-    db = _get_db()
-    
     # Récupérer la machine
-    locker = _get_locker_by_machine_id(db, machine_id)
+    db, locker = _get_locker(machine_id)
     if not locker:
         return jsonify({"message": "Machine non trouvée"}), 404
+    if payload.get("boxId"):
+        # Porte déjà ouverte par le kiosque sur une box prêtée: bail accordé
+        # avant (vérifié sur ses codes), enregistré même si la machine a été
+        # désactivée depuis
+        try:
+            box_number, closet_id = int(payload["boxId"]), int(payload["closetId"])
+        except (KeyError, TypeError, ValueError):
+            return jsonify({"message": "boxId ou closetId invalide"}), 400
+        if not payload.get("password"):
+            return jsonify({"message": "password requis avec boxId"}), 400
+        return _register_leased_deposit(
+            db, locker, machine_id, tracking_code, box_number, closet_id, str(payload["password"])
+        )
+
     if locker["status"] != "active":
         return jsonify({"message": "Machine non disponible"}), 409
 
-    # Trouver une box disponible
-    box = _find_available_box(db, locker["id"])
-    if not box:
-        return jsonify({"message": "Aucune box disponible"}), 409
+    allocator = get_allocator(current_app)
+    try:
+        with write_transaction(db):
+            # Trouver et réserver une box disponible
+            box = allocator.claim(db, locker["id"], size)
+            if not box:
+                return jsonify({"message": "Aucune box disponible"}), 409
+
+            # Créer la commande avec un closet ID unique parmi les commandes actives
+            closet_id, cur = _write_with_code(
+                db, "closet", locker["id"],
+                """
+                INSERT INTO orders (locker_id, box_id, closet_id, tracking_code, order_type, status) 
+                VALUES (?, ?, ?, ?, 'deposit', 'awaiting_close')
+                RETURNING id, created_at
+                """,
+                lambda code: (locker["id"], box["id"], code, tracking_code),
+            )
+            order = cur.fetchone()
+            password, _ = _write_with_code(
+                db, "password", locker["id"],
+                "UPDATE orders SET password=? WHERE id=?",
+                lambda code: (code, order["id"]),
+            )
+    except Exception:
+        # Transaction annulée: la box réservée en mémoire est de nouveau libre en base
+        allocator.invalidate(locker["id"])
+        raise
+
+    _publish_transition(machine_id, box["id"], box["box_number"], "deposit_open", "available", {
+        "id": order["id"],
+        "closetId": closet_id,
+        "trackingCode": tracking_code,
+        "type": "deposit",
+        "status": "awaiting_close",
+        "createdAt": order["created_at"],
+    })
 
-    closet_id = _generate_closet_id()
-    
-    # Marquer la box comme occupée
-    db.execute("UPDATE boxes SET status='deposit_open' WHERE id=?", (box["id"],))
-    
-    # Créer la commande
-    db.execute(
-        """
-        INSERT INTO orders (locker_id, box_id, closet_id, tracking_code, order_type, status) 
-        VALUES (?, ?, ?, ?, 'deposit', 'awaiting_close')
-        """,
-        (locker["id"], box["id"], closet_id, tracking_code),
-    )
-    db.commit()
-    
     return jsonify({
-        "boxId": box["box_number"],  # Retourne le numéro de box (1-15)
+        "boxId": box["box_number"],  # Retourne le numéro de box (hors boxes réservées)
         "closetId": closet_id,
+        "orderId": order["id"],
+        "password": password,
+        "size": box["size"],
         "message": f"Box {box['box_number']} assignée, déposez votre colis"
     })
 
 
+def _register_leased_deposit(
+    db, locker, machine_id: int, tracking_code: str, box_number: int, closet_id: int, password: str
+):
+    """
+    Enregistrer un dépôt commencé par le kiosque sur une box prêtée
+    (leases.py): la commande 'leased' devient 'awaiting_close'.
+    Rejouer un enregistrement déjà fait retourne le même résultat.
+    Box, closet ID et mot de passe doivent être ceux d'un bail accordé.
+
+    Bail déjà repris (kiosque hors ligne plus de LEASE_GRACE après
+    l'échéance): la porte a été ouverte et le mot de passe affiché, le
+    colis est sans doute dedans. La box est reprise avec les codes du
+    kiosque si elle est toujours libre; sinon elle appartient à une autre
+    commande et n'est pas touchée: 202 avec `flagged`, à vérifier par un
+    opérateur.
+    """
+    with write_transaction(db):
+        order = db.execute(
+            f"""
+            SELECT o.id, o.status, o.tracking_code, o.password, b.id AS box_id, b.size
+            FROM orders o JOIN boxes b ON o.box_id = b.id
+            WHERE o.locker_id=? AND o.closet_id=? AND o.password=? AND o.{ACTIVE_ORDER_SQL}
+              AND b.box_number=? AND o.order_type='deposit'
+            """,
+            (locker["id"], closet_id, password, box_number),
+        ).fetchone()
+        if order and order["status"] != "leased" and order["tracking_code"] != tracking_code:
+            return jsonify({"message": "Box déjà utilisée par un autre colis"}), 409
+        if order:
+            registered = order["status"] == "leased"
+            if registered:
+                db.execute(
+                    """
+                    UPDATE orders SET status='awaiting_close', tracking_code=?,
+                        created_at=CURRENT_TIMESTAMP, updated_at=CURRENT_TIMESTAMP
+                    WHERE id=?
+                    """,
+                    (tracking_code, order["id"]),
+                )
+                db.execute("UPDATE boxes SET status='deposit_open' WHERE id=?", (order["box_id"],))
+                db.execute("DELETE FROM box_leases WHERE order_id=?", (order["id"],))
+            previous = "leased"
+        else:
+            expired = find_expired(db, locker["id"], box_number, closet_id, password)
+            if expired is None:
+                return jsonify({"message": "Aucun bail pour cette box"}), 409
+            box = db.execute(
+                "SELECT id, status, size FROM boxes WHERE locker_id=? AND box_number=?",
+                (locker["id"], box_number),
+            ).fetchone()
+            order = _reclaim_leased_box(db, locker["id"], box, closet_id, tracking_code, password)
+            registered = order is not None
+            previous = "available"
+            if registered:
+                db.execute("DELETE FROM expired_leases WHERE order_id=?", (expired["order_id"],))
+
+    if order is None:
+        current_app.logger.warning(
+            "Expired lease on machine %s box %s (closet %s, tracking %s) could not be reclaimed, box in use",
+            machine_id, box_number, closet_id, tracking_code,
+        )
+        return jsonify({
+            "boxId": box_number,
+            "closetId": closet_id,
+            "flagged": True,
+            "message": f"Bail expiré, box {box_number} à vérifier par un opérateur",
+        }), 202
+    if registered:
+        _publish_transition(machine_id, order["box_id"], box_number, "deposit_open", previous, {
+            "id": order["id"],
+            "closetId": closet_id,
+            "trackingCode": tracking_code,
+            "type": "deposit",
+            "status": "awaiting_close",
+        })
+    return jsonify({
+        "boxId": box_number,
+        "closetId": closet_id,
+        "orderId": order["id"],
+        "password": order["password"],
+        "size": order["size"],
+        "message": f"Box {box_number} assignée, déposez votre colis"
+    })
+
+
+def _reclaim_leased_box(db, locker_id: int, box, closet_id: int, tracking_code: str, password: str):
+    """
+    Reprendre la box d'un bail expiré avec les codes déjà donnés au client.
+    Retourne la commande créée, ou None (box inchangée) si la box a été
+    prise par un autre dépôt ou si un code est passé à une autre commande
+    active.
+    """
+    cur = db.execute("UPDATE boxes SET status='deposit_open' WHERE id=? AND status='available'", (box["id"],))
+    if cur.rowcount != 1:
+        return None
+    try:
+        order = db.execute(
+            """
+            INSERT INTO orders (locker_id, box_id, closet_id, password, tracking_code, order_type, status)
+            VALUES (?, ?, ?, ?, ?, 'deposit', 'awaiting_close')
+            RETURNING id
+            """,
+            (locker_id, box["id"], closet_id, password, tracking_code),
+        ).fetchone()
+    except sqlite3.IntegrityError as exc:
+        if is_moved_error(exc):
+            raise
+        db.execute("UPDATE boxes SET status='available' WHERE id=?", (box["id"],))
+        return None
+    # L'index de l'allocateur voit encore la box libre: l'UPDATE conditionnel de claim() l'écartera
+    return {"id": order["id"], "box_id": box["id"], "password": password, "size": box["size"]}
+
+
+@bp.route("/api/leases", methods=["POST"])
+def lease_boxes():
+    """
+    Bail sur quelques boxes libres: le kiosque ouvre la porte d'un dépôt
+    sans attendre le serveur, puis l'enregistre via /api/deposit/open avec
+    boxId et closetId. Renouvelle les baux en cours de la machine et la
+    complète jusqu'à `count` boxes.
+    """
+    payload = request.get_json(force=True)
+    machine_id = int(payload.get("lockerId", 0))
+    try:
+        count = max(0, min(int(payload.get("count", LEASE_BOXES)), LEASE_MAX_BOXES))
+    except (TypeError, ValueError):
+        return jsonify({"message": "count invalide"}), 400
+    if not machine_id:
+        return jsonify({"message": "lockerId requis"}), 400
+
+    db, locker = _get_locker(machine_id)
+    if not locker:
+        return jsonify({"message": "Machine non trouvée"}), 404
+    if locker["status"] != "active":
+        count = 0  # Baux en cours renouvelés, aucun nouveau
+
+    allocator = get_allocator(current_app)
+    try:
+        with write_transaction(db):
+            leases = grant_leases(
+                db, allocator,
+                lambda kind, sql, params: _write_with_code(db, kind, locker["id"], sql, params),
+                locker["id"], count,
+            )
+    except Exception:
+        allocator.invalidate(locker["id"])
+        raise
+
+    return jsonify({
+        "ttl": LEASE_TTL,
+        "boxes": [
+            {
+                "boxId": r["box_number"],
+                "closetId": r["closet_id"],
+                "password": r["password"],
+                "orderId": r["order_id"],
+                "size": r["size"],
+                "expiresIn": r["expires_in"],
+            }
+            for r in leases
+        ],
+    })
+
+
 @bp.route("/api/deposit/close", methods=["POST"])
 def close_deposit():
     """
     Fermeture dépôt: Le client confirme la fermeture.
-    Le serveur génère et retourne le mot de passe.
+    Le serveur retourne le mot de passe réservé à l'ouverture (ou en génère
+    un pour les commandes ouvertes sans). Rejouer une confirmation déjà
+    appliquée retourne le même résultat.
     """
     payload = request.get_json(force=True)
     machine_id = int(payload.get("lockerId", 0))
@@ -156,49 +371,67 @@ def close_deposit():
     if not (machine_id and box_number and closet_id and tracking_code):
         return jsonify({"message": "Paramètres manquants"}), 400
 
-    if not _box_allowed(box_number):
-        return jsonify({"message": "Box non valide"}), 400
-
-    db = _get_db()
-    
     # Récupérer la machine et la box
-    locker = _get_locker_by_machine_id(db, machine_id)
+    db, locker = _get_locker(machine_id)
     if not locker:
         return jsonify({"message": "Machine non trouvée"}), 404
     
     box = db.execute(
-        "SELECT id FROM boxes WHERE locker_id=? AND box_number=?",
+        "SELECT id, reserved FROM boxes WHERE locker_id=? AND box_number=?",
         (locker["id"], box_number)
     ).fetchone()
     if not box:
         return jsonify({"message": "Box non trouvée"}), 404
+    if box["reserved"]:
+        return jsonify({"message": "Box non valide"}), 400
 
-    # Récupérer la commande
-    order = db.execute(
-        """
-        SELECT id, status FROM orders 
-        WHERE box_id=? AND closet_id=? AND tracking_code=? AND order_type='deposit'
-        ORDER BY created_at DESC
-        LIMIT 1
-        """,
-        (box["id"], closet_id, tracking_code),
-    ).fetchone()
-    
-    if not order:
-        return jsonify({"message": "Commande non trouvée"}), 404
-    if order["status"] != "awaiting_close":
-        return jsonify({"message": "État de commande invalide"}), 409
-
-    # Générer le mot de passe
-    password = _generate_password()
+    with write_transaction(db):
+        # Récupérer la commande
+        order = db.execute(
+            """
+            SELECT id, status, password FROM orders 
+            WHERE box_id=? AND closet_id=? AND tracking_code=? AND order_type='deposit'
+            ORDER BY created_at DESC
+            LIMIT 1
+            """,
+            (box["id"], closet_id, tracking_code),
+        ).fetchone()
     
-    # Mettre à jour
-    db.execute("UPDATE boxes SET status='occupied' WHERE id=?", (box["id"],))
-    db.execute(
-        "UPDATE orders SET status='closed', password=?, updated_at=CURRENT_TIMESTAMP WHERE id=?",
-        (password, order["id"]),
-    )
-    db.commit()
+        if not order:
+            return jsonify({"message": "Commande non trouvée"}), 404
+        if order["status"] in ("closed", "withdraw_in_progress", "withdrawn"):
+            # Déjà confirmée (réponse perdue, rejeu du journal du kiosque)
+            return jsonify({
+                "boxId": box_number,
+                "closetId": closet_id,
+                "password": order["password"],
+                "orderId": order["id"],
+                "message": "Dépôt terminé"
+            })
+        if order["status"] != "awaiting_close":
+            return jsonify({"message": "État de commande invalide"}), 409
+
+        # Mettre à jour, avec un mot de passe unique parmi les commandes actives
+        db.execute("UPDATE boxes SET status='occupied' WHERE id=?", (box["id"],))
+        password = order["password"]
+        if password is not None:
+            db.execute(
+                "UPDATE orders SET status='closed', updated_at=CURRENT_TIMESTAMP, closed_at=CURRENT_TIMESTAMP WHERE id=?",
+                (order["id"],),
+            )
+        else:
+            password, _ = _write_with_code(
+                db, "password", locker["id"],
+                """
+                UPDATE orders SET status='closed', password=?, updated_at=CURRENT_TIMESTAMP, closed_at=CURRENT_TIMESTAMP
+                WHERE id=?
+                """,
+                lambda code: (code, order["id"]),
+            )
+        rollups.record(db, locker["id"], deposits=1)
+    _publish_transition(machine_id, box["id"], box_number, "occupied", "deposit_open", {
+        "id": order["id"], "status": "closed", "password": password,
+    })
     
     return jsonify({
         "boxId": box_number,
@@ -222,40 +455,39 @@ def open_withdraw():
     if not (machine_id and password):
         return jsonify({"message": "Paramètres manquants"}), 400
 
-    db = _get_db()
-    
     # Récupérer la machine
-    locker = _get_locker_by_machine_id(db, machine_id)
+    db, locker = _get_locker(machine_id)
     if not locker:
         return jsonify({"message": "Machine non trouvée"}), 404
 
-    # Trouver la commande avec ce mot de passe
-    order = db.execute(
-        """
-        SELECT o.id, o.closet_id, o.status, b.id as box_id, b.box_number, b.status as box_status
-        FROM orders o
-        JOIN boxes b ON o.box_id = b.id
-        WHERE o.locker_id=? AND o.password=? AND o.order_type='deposit' 
-        ORDER BY o.created_at DESC
-        LIMIT 1
-        """,
-        (locker["id"], password),
-    ).fetchone()
+    with write_transaction(db):
+        # Trouver la commande active avec ce mot de passe (unique, index partiel)
+        order = db.execute(
+            f"""
+            SELECT o.id, o.closet_id, o.status, b.id as box_id, b.box_number, b.status as box_status
+            FROM orders o
+            JOIN boxes b ON o.box_id = b.id
+            WHERE o.locker_id=? AND o.password=? AND o.{ACTIVE_ORDER_SQL} AND o.order_type='deposit'
+            """,
+            (locker["id"], password),
+        ).fetchone()
     
-    if not order:
-        return jsonify({"message": "Mot de passe invalide"}), 404
-    if order["status"] != "closed":
-        return jsonify({"message": "Colis déjà retiré ou non disponible"}), 409
-    if order["box_status"] != "occupied":
-        return jsonify({"message": "Box non occupée"}), 409
-
-    # Marquer comme retrait en cours
-    db.execute("UPDATE boxes SET status='withdraw_open' WHERE id=?", (order["box_id"],))
-    db.execute(
-        "UPDATE orders SET status='withdraw_in_progress', updated_at=CURRENT_TIMESTAMP WHERE id=?",
-        (order["id"],),
-    )
-    db.commit()
+        if not order:
+            return jsonify({"message": "Mot de passe invalide"}), 404
+        if order["status"] != "closed":
+            return jsonify({"message": "Colis déjà retiré ou non disponible"}), 409
+        if order["box_status"] != "occupied":
+            return jsonify({"message": "Box non occupée"}), 409
+
+        # Marquer comme retrait en cours
+        db.execute("UPDATE boxes SET status='withdraw_open' WHERE id=?", (order["box_id"],))
+        db.execute(
+            "UPDATE orders SET status='withdraw_in_progress', updated_at=CURRENT_TIMESTAMP WHERE id=?",
+            (order["id"],),
+        )
+    _publish_transition(machine_id, order["box_id"], order["box_number"], "withdraw_open", "occupied", {
+        "id": order["id"], "status": "withdraw_in_progress",
+    })
     
     return jsonify({
         "boxId": order["box_number"],  # Retourne le numéro de box
@@ -269,6 +501,7 @@ def open_withdraw():
 def close_withdraw():
     """
     Fermeture retrait: Le client confirme avoir récupéré le colis.
+    Rejouer une confirmation déjà appliquée retourne le même résultat.
     """
     payload = request.get_json(force=True)
     machine_id = int(payload.get("lockerId", 0))
@@ -278,10 +511,8 @@ def close_withdraw():
     if not (machine_id and box_number and closet_id):
         return jsonify({"message": "Paramètres manquants"}), 400
 
-    db = _get_db()
-    
     # Récupérer la machine et la box
-    locker = _get_locker_by_machine_id(db, machine_id)
+    db, locker = _get_locker(machine_id)
     if not locker:
         return jsonify({"message": "Machine non trouvée"}), 404
     
@@ -292,29 +523,38 @@ def close_withdraw():
     if not box:
         return jsonify({"message": "Box non trouvée"}), 404
 
-    # Récupérer la commande
-    order = db.execute(
-        """
-        SELECT id, status FROM orders 
-        WHERE box_id=? AND closet_id=? AND order_type='deposit'
-        ORDER BY created_at DESC
-        LIMIT 1
-        """,
-        (box["id"], closet_id),
-    ).fetchone()
+    with write_transaction(db):
+        # Récupérer la commande
+        order = db.execute(
+            """
+            SELECT id, status, created_at, closed_at FROM orders 
+            WHERE box_id=? AND closet_id=? AND order_type='deposit'
+            ORDER BY created_at DESC
+            LIMIT 1
+            """,
+            (box["id"], closet_id),
+        ).fetchone()
     
-    if not order:
-        return jsonify({"message": "Commande non trouvée"}), 404
-    if order["status"] != "withdraw_in_progress":
-        return jsonify({"message": "État de commande invalide"}), 409
-
-    # Libérer la box
-    db.execute("UPDATE boxes SET status='available' WHERE id=?", (box["id"],))
-    db.execute(
-        "UPDATE orders SET status='withdrawn', updated_at=CURRENT_TIMESTAMP WHERE id=?",
-        (order["id"],),
-    )
-    db.commit()
+        if not order:
+            return jsonify({"message": "Commande non trouvée"}), 404
+        if order["status"] == "withdrawn":
+            # Déjà confirmé (réponse perdue, rejeu du journal du kiosque)
+            return jsonify({"boxId": box_number, "closetId": closet_id, "message": "Retrait terminé"})
+        if order["status"] != "withdraw_in_progress":
+            return jsonify({"message": "État de commande invalide"}), 409
+
+        # Libérer la box
+        db.execute("UPDATE boxes SET status='available' WHERE id=?", (box["id"],))
+        db.execute(
+            "UPDATE orders SET status='withdrawn', updated_at=CURRENT_TIMESTAMP WHERE id=?",
+            (order["id"],),
+        )
+        # Commandes fermées avant l'ajout de closed_at: séjour compté depuis le dépôt
+        rollups.record(db, locker["id"], withdrawals=1, dwell_from=order["closed_at"] or order["created_at"])
+    get_allocator(current_app).release(locker["id"], box_number)
+    _publish_transition(machine_id, box["id"], box_number, "available", "withdraw_open", {
+        "id": order["id"], "status": "withdrawn",
+    })
     
     return jsonify({
         "boxId": box_number,
@@ -0,0 +1,326 @@
+import json
+import logging
+import time
+
+from database import MOVED_STATUS, connect, write_transaction
+
+
+LOG = logging.getLogger(__name__)
+
+MOVE_CHUNK = 1000  # Lignes supprimées ou copiées par transaction après la copie principale
+MOVE_PAUSE = 0.02  # Secondes entre deux lots: laisse passer les requêtes kiosque
+
+
+def shard_stats(router) -> list:
+    """Par shard: fichier, machines actives et machines fixées par shard_map"""
+    home = connect(router.paths[0])
+    try:
+        mapped = dict(home.execute("SELECT shard, count(*) FROM shard_map GROUP BY shard").fetchall())
+    finally:
+        home.close()
+    stats = []
+    for shard, path in enumerate(router.paths):
+        db = connect(path)
+        try:
+            machines = db.execute("SELECT count(*) FROM lockers WHERE status != ?", (MOVED_STATUS,)).fetchone()[0]
+        finally:
+            db.close()
+        stats.append({"shard": shard, "path": path, "machines": machines, "mapped": mapped.get(shard, 0)})
+    return stats
+
+
+def _columns(db, table: str, skip=()) -> str:
+    return ", ".join(row[1] for row in db.execute(f"PRAGMA main.table_info({table})") if row[1] not in skip)
+
+
+def _delete_locker(db, locker_id: int):
+    """Supprimer un locker et toutes ses lignes (restes d'un déplacement interrompu)"""
+    db.execute("DELETE FROM box_leases WHERE locker_id=?", (locker_id,))
+    db.execute("DELETE FROM expired_leases WHERE locker_id=?", (locker_id,))
+    db.execute("DELETE FROM orders WHERE box_id IN (SELECT id FROM boxes WHERE locker_id=?)", (locker_id,))
+    db.execute("DELETE FROM orders WHERE locker_id=?", (locker_id,))
+    db.execute("DELETE FROM orders_archive WHERE locker_id=?", (locker_id,))
+    db.execute("DELETE FROM order_rollups WHERE locker_id=?", (locker_id,))
+    db.execute("DELETE FROM telemetry_samples WHERE locker_id=?", (locker_id,))
+    db.execute("DELETE FROM boxes WHERE locker_id=?", (locker_id,))
+    db.execute("DELETE FROM lockers WHERE id=?", (locker_id,))
+
+
+def _copy_locker(dst, old_id: int) -> int:
+    """
+    Copier dans le shard cible (main) le locker `old_id` du shard source
+    (attaché en `src`): boxes, commandes, archive, baux (en cours et repris)
+    et agrégats.
+    Boxes et commandes reçoivent des identifiants du shard cible (voir
+    SHARD_ID_SPAN). Retourne le nouvel id du locker.
+    """
+    leftover = dst.execute(
+        "SELECT id FROM main.lockers WHERE machine_id = (SELECT machine_id FROM src.lockers WHERE id=?)",
+        (old_id,),
+    ).fetchone()
+    if leftover:
+        _delete_locker(dst, leftover[0])
+
+    columns = _columns(dst, "lockers", ("id",))
+    new_id = dst.execute(
+        f"INSERT INTO main.lockers ({columns}) SELECT {columns} FROM src.lockers WHERE id=? RETURNING id",
+        (old_id,),
+    ).fetchone()[0]
+    columns = _columns(dst, "boxes", ("id", "locker_id"))
+    dst.execute(
+        f"INSERT INTO main.boxes (locker_id, {columns}) SELECT ?, {columns} FROM src.boxes WHERE locker_id=? ORDER BY box_number",
+        (new_id, old_id),
+    )
+
+    # Correspondance ancien -> nouvel id des boxes (même numéro) et des commandes
+    dst.execute("CREATE TEMP TABLE IF NOT EXISTS move_ids (kind TEXT, old INTEGER, new INTEGER, PRIMARY KEY (kind, old))")
+    dst.execute("DELETE FROM temp.move_ids")
+    dst.execute(
+        """
+        INSERT INTO temp.move_ids
+        SELECT 'box', s.id, d.id FROM src.boxes s
+        JOIN main.boxes d ON d.locker_id = ? AND d.box_number = s.box_number
+        WHERE s.locker_id = ?
+        """,
+        (new_id, old_id),
+    )
+    next_id = dst.execute(
+        """
+        SELECT max(COALESCE((SELECT seq FROM main.sqlite_sequence WHERE name='orders'), 0),
+                   COALESCE((SELECT max(id) FROM main.orders), 0),
+                   COALESCE((SELECT max(id) FROM main.orders_archive), 0))
+        """
+    ).fetchone()[0]
+    dst.execute(
+        """
+        INSERT INTO temp.move_ids
+        SELECT 'order', id, ? + row_number() OVER (ORDER BY id) FROM (
+            SELECT id FROM src.orders
+            WHERE box_id IN (SELECT id FROM src.boxes WHERE locker_id=?) AND locker_id=?
+            UNION
+            SELECT id FROM src.orders_archive WHERE locker_id=?
+        )
+        """,
+        (next_id, old_id, old_id, old_id),
+    )
+
+    for table in ("orders", "orders_archive"):
+        columns = _columns(dst, table, ("id", "locker_id", "box_id"))
+        selected = ", ".join(f"o.{c.strip()}" for c in columns.split(","))
+        dst.execute(
+            f"""
+            INSERT INTO main.{table} (id, locker_id, box_id, {columns})
+            SELECT m.new, ?, COALESCE(b.new, o.box_id), {selected}
+            FROM src.{table} o
+            JOIN temp.move_ids m ON m.kind = 'order' AND m.old = o.id
+            LEFT JOIN temp.move_ids b ON b.kind = 'box' AND b.old = o.box_id
+            ORDER BY m.new
+            """,
+            (new_id,),
+        )
+    dst.execute(
+        """
+        INSERT INTO main.box_leases (order_id, locker_id, expires_at)
+        SELECT m.new, ?, l.expires_at FROM src.box_leases l
+        JOIN temp.move_ids m ON m.kind = 'order' AND m.old = l.order_id
+        WHERE l.locker_id = ?
+        """,
+        (new_id, old_id),
+    )
+    columns = _columns(dst, "expired_leases", ("locker_id",))
+    dst.execute(
+        f"INSERT OR IGNORE INTO main.expired_leases (locker_id, {columns}) SELECT ?, {columns} FROM src.expired_leases WHERE locker_id=?",
+        (new_id, old_id),
+    )
+    columns = _columns(dst, "order_rollups", ("locker_id",))
+    dst.execute(
+        f"INSERT INTO main.order_rollups (locker_id, {columns}) SELECT ?, {columns} FROM src.order_rollups WHERE locker_id=?",
+        (new_id, old_id),
+    )
+    return new_id
+
+
+def _move_telemetry(src, dst, old_id: int, new_id: int, chunk: int, pause: float) -> int:
+    """
+    Télémétrie de la machine copiée par lots (noms de métriques remappés)
+    puis supprimée du shard source. Des échantillons écrits dans l'ancien
+    shard pendant le déplacement peuvent être perdus.
+    """
+    names = dict(src.execute(
+        """
+        SELECT id, name FROM telemetry_metrics
+        WHERE id IN (SELECT DISTINCT metric_id FROM telemetry_samples WHERE locker_id=?)
+        """,
+        (old_id,),
+    ).fetchall())
+    with write_transaction(dst):
+        dst.executemany("INSERT OR IGNORE INTO telemetry_metrics (name) VALUES (?)", [(n,) for n in names.values()])
+        ids = dict(dst.execute(
+            "SELECT name, id FROM telemetry_metrics WHERE name IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(names.values())),),
+        ).fetchall())
+    total = 0
+    for metric_id, name in names.items():
+        while True:
+            rows = src.execute(
+                "SELECT ts, value FROM telemetry_samples WHERE locker_id=? AND metric_id=? ORDER BY ts LIMIT ?",
+                (old_id, metric_id, chunk),
+            ).fetchall()
+            if not rows:
+                break
+            with write_transaction(dst):
+                dst.executemany(
+                    "INSERT OR IGNORE INTO telemetry_samples (locker_id, metric_id, ts, value) VALUES (?, ?, ?, ?)",
+                    [(new_id, ids[name], ts, value) for ts, value in rows],
+                )
+            with write_transaction(src):
+                src.execute(
+                    "DELETE FROM telemetry_samples WHERE locker_id=? AND metric_id=? AND ts <= ?",
+                    (old_id, metric_id, rows[-1][0]),
+                )
+            total += len(rows)
+            time.sleep(pause)
+    return total
+
+
+def _purge(src, old_id: int, chunk: int, pause: float):
+    """
+    Supprimer du shard source les lignes de la machine déplacée, par lots
+    courts. Le locker 'moved' reste: les triggers de garde y refusent les
+    écritures des requêtes parties avant le déplacement.
+    """
+    statements = (
+        "DELETE FROM box_leases WHERE order_id IN (SELECT order_id FROM box_leases WHERE locker_id=? LIMIT ?)",
+        "DELETE FROM expired_leases WHERE order_id IN (SELECT order_id FROM expired_leases WHERE locker_id=? LIMIT ?)",
+        """
+        DELETE FROM orders WHERE id IN (
+            SELECT id FROM orders WHERE box_id IN (SELECT id FROM boxes WHERE locker_id=?) LIMIT ?
+        )
+        """,
+        "DELETE FROM orders_archive WHERE id IN (SELECT id FROM orders_archive WHERE locker_id=? LIMIT ?)",
+        """
+        DELETE FROM order_rollups WHERE (locker_id, period, bucket) IN (
+            SELECT locker_id, period, bucket FROM order_rollups WHERE locker_id=? LIMIT ?
+        )
+        """,
+        "DELETE FROM boxes WHERE id IN (SELECT id FROM boxes WHERE locker_id=? LIMIT ?)",
+    )
+    for sql in statements:
+        while True:
+            with write_transaction(src):
+                deleted = src.execute(sql, (old_id, chunk)).rowcount
+            if deleted < chunk:
+                break
+            time.sleep(pause)
+
+
+def move_machine(router, machine_id: int, target: int, chunk: int = MOVE_CHUNK, pause: float = MOVE_PAUSE) -> dict:
+    """
+    Déplacer une machine vers le shard `target`, serveur en marche:
+    1. verrou d'écriture du shard source, copie dans le shard cible
+       (une transaction), puis locker source marqué 'moved';
+    2. shard_map mis à jour: les workers relisent la carte au premier
+       'moved' rencontré (503 + Retry-After entre-temps);
+    3. télémétrie copiée puis lignes source supprimées, par lots.
+    Un déplacement interrompu se reprend en relançant la même commande.
+    Un seul déplacement à la fois.
+    """
+    if not 0 <= target < router.count:
+        raise ValueError(f"Shard {target} inexistant ({router.count} shards)")
+    router.reload(force=True)
+    source = router.shard_for(machine_id)
+    if source == target:
+        return {"machineId": machine_id, "source": source, "target": target, "moved": False}
+
+    src, dst = connect(router.paths[source]), connect(router.paths[target])
+    try:
+        locker = src.execute("SELECT id, status FROM lockers WHERE machine_id=?", (machine_id,)).fetchone()
+        if locker is None:
+            raise LookupError(f"Machine {machine_id} absente du shard {source}")
+        start = time.perf_counter()
+        if locker["status"] != MOVED_STATUS:
+            dst.execute("ATTACH DATABASE ? AS src", (router.paths[source],))
+            try:
+                # Copie sous le verrou d'écriture du shard source: aucune
+                # écriture de la machine ne peut s'y glisser. Transaction
+                # cible différée: seul le verrou de la cible est pris.
+                with write_transaction(src):
+                    dst.execute("BEGIN")
+                    try:
+                        _copy_locker(dst, locker["id"])
+                        dst.commit()
+                    except Exception:
+                        dst.rollback()
+                        raise
+                    src.execute("UPDATE lockers SET status=? WHERE id=?", (MOVED_STATUS, locker["id"]))
+            finally:
+                dst.execute("DETACH DATABASE src")
+        locked = time.perf_counter() - start
+        new_id = dst.execute(
+            "SELECT id FROM lockers WHERE machine_id=? AND status != ?",
+            (machine_id, MOVED_STATUS),
+        ).fetchone()
+        if new_id is None:
+            raise LookupError(f"Machine {machine_id} marquée déplacée mais absente du shard {target}")
+
+        home = connect(router.paths[0])
+        try:
+            with write_transaction(home):
+                home.execute(
+                    """
+                    INSERT INTO shard_map (machine_id, shard) VALUES (?, ?)
+                    ON CONFLICT(machine_id) DO UPDATE SET shard=excluded.shard
+                    """,
+                    (machine_id, target),
+                )
+        finally:
+            home.close()
+        router.reload(force=True)
+
+        samples = _move_telemetry(src, dst, locker["id"], new_id[0], chunk, pause)
+        _purge(src, locker["id"], chunk, pause)
+    finally:
+        src.close()
+        dst.close()
+    LOG.info("Machine %s moved from shard %s to shard %s (source locked %.3f s)", machine_id, source, target, locked)
+    return {
+        "machineId": machine_id,
+        "source": source,
+        "target": target,
+        "moved": True,
+        "lockedSeconds": round(locked, 4),
+        "telemetrySamples": samples,
+    }
+
+
+def plan_rebalance(router) -> list:
+    """
+    Déplacements [(machine_id, source, cible)] qui égalisent le nombre de
+    machines par shard (à une près) en déplaçant le moins de machines
+    possible: les shards en excès cèdent leurs plus grands machine_id.
+    """
+    home = connect(router.paths[0])
+    try:
+        mapped = home.execute("SELECT machine_id, shard FROM shard_map ORDER BY machine_id").fetchall()
+    finally:
+        home.close()
+    by_shard = {shard: [] for shard in router.shards()}
+    for machine_id, shard in mapped:
+        by_shard[shard].append(machine_id)
+
+    # Les shards les plus chargés gardent la machine en plus
+    base, extra = divmod(len(mapped), router.count)
+    ranked = sorted(by_shard, key=lambda s: (-len(by_shard[s]), s))
+    quota = {shard: base + (1 if rank < extra else 0) for rank, shard in enumerate(ranked)}
+
+    surplus = []
+    for shard in ranked:
+        while len(by_shard[shard]) > quota[shard]:
+            surplus.append((by_shard[shard].pop(), shard))
+    moves = []
+    for shard in reversed(ranked):
+        while len(by_shard[shard]) < quota[shard]:
+            machine_id, source = surplus.pop()
+            by_shard[shard].append(machine_id)
+            moves.append((machine_id, source, shard))
+    return moves
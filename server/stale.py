@@ -0,0 +1,250 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from database import write_transaction
+import rollups
+
+
+LOG = logging.getLogger(__name__)
+
+STALE_AFTER = 15 * 60  # Secondes sans confirmation de fermeture avant de traiter une ouverture
+DOOR_STATE_MAX_AGE = 120  # Âge max de l'état des portes remonté par la télémétrie du kiosque
+REAPER_INTERVAL = 60  # Secondes entre deux passages du thread
+REAPER_BATCH_SIZE = 100  # Commandes par transaction
+REAPER_PAUSE = 0.05  # Secondes après un lot qui a écrit: laisse passer les requêtes kiosque
+STUCK = "stuck"  # Box à vérifier sur place: ni attribuée ni réinitialisée automatiquement
+# Commande en cours -> statut de sa box pendant l'ouverture
+IN_FLIGHT = {"awaiting_close": "deposit_open", "withdraw_in_progress": "withdraw_open"}
+RESET_STATUSES = ("deposit_open", "withdraw_open", STUCK)  # Reset d'une machine entière, par défaut
+
+
+def _json_ids(ids) -> str:
+    return json.dumps(list(ids))
+
+
+def reset_boxes(db, box_ids) -> list:
+    """
+    Remettre des boxes à 'available' et annuler leurs commandes pas
+    terminées (bouton Reset du dashboard). À appeler dans une transaction
+    d'écriture. Retourne les changements (voir publish_changes).
+    """
+    ids = _json_ids(box_ids)
+    boxes = db.execute(
+        """
+        SELECT b.id, b.locker_id, b.box_number, b.status, l.machine_id
+        FROM boxes b JOIN lockers l ON b.locker_id = l.id
+        WHERE b.id IN (SELECT value FROM json_each(?))
+        """,
+        (ids,),
+    ).fetchall()
+    db.execute("UPDATE boxes SET status='available' WHERE id IN (SELECT value FROM json_each(?))", (ids,))
+    cancelled = db.execute(
+        """
+        UPDATE orders SET status='cancelled', updated_at=CURRENT_TIMESTAMP
+        WHERE box_id IN (SELECT value FROM json_each(?)) AND status NOT IN ('closed', 'withdrawn', 'cancelled')
+        RETURNING id, box_id
+        """,
+        (ids,),
+    ).fetchall()
+    orders = {}
+    for row in cancelled:
+        orders.setdefault(row["box_id"], []).append({"id": row["id"], "status": "cancelled"})
+    for locker_id in {b["locker_id"] for b in boxes}:
+        mine = [b for b in boxes if b["locker_id"] == locker_id]
+        rollups.record(
+            db, locker_id,
+            cancelled=sum(len(orders.get(b["id"], ())) for b in mine),
+            released=sum(b["status"] in rollups.OCCUPIED_STATUSES for b in mine),
+        )
+    return [
+        {
+            "lockerId": b["locker_id"],
+            "machineId": b["machine_id"],
+            "boxId": b["id"],
+            "boxNumber": b["box_number"],
+            "status": "available",
+            "previousStatus": b["status"],
+            "orders": orders.get(b["id"], []),
+        }
+        for b in boxes
+    ]
+
+
+def publish_changes(broker, changes):
+    """Diffuser aux dashboards (SSE) les changements de boxes et de commandes"""
+    for change in changes:
+        broker.publish("box", {
+            "machineId": change["machineId"],
+            "boxId": change["boxId"],
+            "boxNumber": change["boxNumber"],
+            "status": change["status"],
+            "previousStatus": change["previousStatus"],
+        })
+        for order in change["orders"]:
+            broker.publish("order", dict(order, machineId=change["machineId"], boxNumber=change["boxNumber"]))
+
+
+def door_closed_mask(db, locker_id: int, max_age: int = DOOR_STATE_MAX_AGE):
+    """
+    Masque des portes fermées (bit n-1: box n) remonté par le kiosque dans
+    sa télémétrie (doors.closed_mask), ou None s'il date de plus de `max_age`
+    secondes: kiosque éteint, hors ligne ou Arduino débranché.
+    """
+    row = db.execute(
+        """
+        SELECT s.value FROM telemetry_samples s
+        WHERE s.locker_id=? AND s.metric_id=(SELECT id FROM telemetry_metrics WHERE name='doors.closed_mask')
+          AND s.ts >= ?
+        ORDER BY s.ts DESC
+        LIMIT 1
+        """,
+        (locker_id, int(time.time()) - int(max_age)),
+    ).fetchone()
+    return None if row is None else int(row["value"])
+
+
+def find_stale(db, stale_after: int = STALE_AFTER) -> list:
+    """
+    IDs des commandes ouvertes sans fermeture confirmée depuis
+    `stale_after` secondes. Un dépôt dont la box est déjà 'stuck' n'a plus
+    rien à attendre du reaper (jamais libéré automatiquement): il n'est
+    plus relu ni reverrouillé à chaque passage.
+    """
+    placeholders = ", ".join("?" for _ in IN_FLIGHT)
+    return [
+        row["id"]
+        for row in db.execute(
+            f"""
+            SELECT o.id FROM orders o JOIN boxes b ON b.id = o.box_id
+            WHERE o.status IN ({placeholders}) AND o.updated_at < datetime('now', ?)
+              AND NOT (o.status = 'awaiting_close' AND b.status = ?)
+            """,
+            (*IN_FLIGHT, f"-{int(stale_after)} seconds", STUCK),
+        )
+    ]
+
+
+def _reap_batch(db, order_ids, stale_after: int, door_max_age: int):
+    changes, counts = [], {"reverted": 0, "flagged": 0}
+    placeholders = ", ".join("?" for _ in IN_FLIGHT)
+    # Relu dans la transaction: une fermeture confirmée entre-temps n'est pas touchée
+    rows = db.execute(
+        f"""
+        SELECT o.id, o.status, o.locker_id, b.id AS box_id, b.box_number, b.status AS box_status, l.machine_id
+        FROM orders o
+        JOIN boxes b ON b.id = o.box_id
+        JOIN lockers l ON l.id = o.locker_id
+        WHERE o.id IN (SELECT value FROM json_each(?))
+          AND o.status IN ({placeholders}) AND o.updated_at < datetime('now', ?)
+        """,
+        (_json_ids(order_ids), *IN_FLIGHT, f"-{int(stale_after)} seconds"),
+    ).fetchall()
+    masks = {}
+    for r in rows:
+        if r["box_status"] not in (IN_FLIGHT[r["status"]], STUCK):
+            continue  # Box modifiée à la main depuis
+        if r["locker_id"] not in masks:
+            masks[r["locker_id"]] = door_closed_mask(db, r["locker_id"], door_max_age)
+        mask = masks[r["locker_id"]]
+        closed = mask is not None and bool(mask >> (r["box_number"] - 1) & 1)
+        if closed and r["status"] == "withdraw_in_progress":
+            # Retrait jamais confirmé: retour à l'état d'avant, le mot de passe reste valable
+            db.execute("UPDATE orders SET status='closed', updated_at=CURRENT_TIMESTAMP WHERE id=?", (r["id"],))
+            db.execute("UPDATE boxes SET status='occupied' WHERE id=?", (r["box_id"],))
+            counts["reverted"] += 1
+            changes.append({
+                "lockerId": r["locker_id"], "machineId": r["machine_id"], "boxId": r["box_id"],
+                "boxNumber": r["box_number"], "status": "occupied", "previousStatus": r["box_status"],
+                "orders": [{"id": r["id"], "status": "closed"}],
+            })
+        elif r["box_status"] != STUCK:
+            # Porte ouverte, état inconnu, ou dépôt jamais confirmé porte fermée (le colis
+            # est sans doute dedans, confirmation perdue): à vérifier sur place
+            db.execute("UPDATE boxes SET status=? WHERE id=?", (STUCK, r["box_id"]))
+            counts["flagged"] += 1
+            changes.append({
+                "lockerId": r["locker_id"], "machineId": r["machine_id"], "boxId": r["box_id"],
+                "boxNumber": r["box_number"], "status": STUCK, "previousStatus": r["box_status"], "orders": [],
+            })
+    return changes, counts
+
+
+def reap_stale(
+    db,
+    stale_after: int = STALE_AFTER,
+    door_max_age: int = DOOR_STATE_MAX_AGE,
+    batch_size: int = REAPER_BATCH_SIZE,
+    pause: float = REAPER_PAUSE,
+):
+    """
+    Traiter les ouvertures (deposit_open, withdraw_open) sans fermeture
+    confirmée depuis `stale_after` secondes, d'après l'état des portes
+    remonté par le kiosque:
+    - porte fermée, retrait: commande remise à 'closed', box 'occupied';
+    - sinon (dépôt, porte ouverte ou état inconnu): box marquée 'stuck'
+      (plus attribuée). Un retrait est réévalué aux passages suivants; un
+      dépôt n'est jamais libéré automatiquement (porte fermée, le colis
+      est sans doute dedans et seule la confirmation manque) et n'est plus
+      relu. Reset par un opérateur.
+    Lots en transactions courtes. Retourne (changements, compteurs).
+    """
+    order_ids = find_stale(db, stale_after)
+    changes, counts = [], {"reverted": 0, "flagged": 0}
+    for start in range(0, len(order_ids), batch_size):
+        with write_transaction(db):
+            batch_changes, batch_counts = _reap_batch(db, order_ids[start:start + batch_size], stale_after, door_max_age)
+        if batch_changes:
+            time.sleep(pause)
+        changes.extend(batch_changes)
+        for key, value in batch_counts.items():
+            counts[key] += value
+    if any(counts.values()):
+        LOG.info("Stale openings: %s", counts)
+    return changes, counts
+
+
+class StaleReaper:
+    """
+    Thread qui traite les ouvertures restées sans fermeture (kiosque planté
+    ou hors ligne entre l'ouverture et la fermeture). Démarré à la première
+    requête de chaque processus; plusieurs workers peuvent tourner en même
+    temps, chaque lot relit l'état dans sa transaction.
+    """
+
+    def __init__(
+        self,
+        connect_db,
+        on_changes,
+        stale_after: int = STALE_AFTER,
+        door_max_age: int = DOOR_STATE_MAX_AGE,
+        interval: float = REAPER_INTERVAL,
+    ):
+        self._connect_db = connect_db
+        self._on_changes = on_changes
+        self.stale_after = stale_after
+        self.door_max_age = door_max_age
+        self.interval = interval
+        self._start_lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                threading.Thread(target=self._run, name="stale-reaper", daemon=True).start()
+                self._pid = os.getpid()
+
+    def _run(self):
+        db = self._connect_db()
+        while True:
+            time.sleep(self.interval)
+            try:
+                changes, _ = reap_stale(db, self.stale_after, self.door_max_age)
+                if changes:
+                    self._on_changes(changes)
+            except Exception as exc:  # pragma: no cover
+                LOG.error("Stale opening reaper failed: %s", exc)
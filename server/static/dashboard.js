@@ -0,0 +1,250 @@
+// Les changements arrivent par /api/events; le polling ne sert que de filet de sécurité
+const POLL_INTERVAL_MS = 30000;
+
+// Dernière réponse par URL: permet de renvoyer If-None-Match et de réutiliser le JSON sur 304
+const cache = new Map();
+let selectedMachine = null;
+let orderFilters = {};
+let ordersPaged = false;
+let loadedOrders = [];
+
+async function fetchJson(url) {
+  const cached = cache.get(url);
+  const headers = cached ? { "If-None-Match": cached.etag } : {};
+  const resp = await fetch(url, { headers });
+  if (resp.status === 304 && cached) {
+    return { data: cached.data, changed: false };
+  }
+  if (!resp.ok) {
+    throw new Error(`${url}: ${resp.status}`);
+  }
+  const data = await resp.json();
+  const etag = resp.headers.get("ETag");
+  if (etag) {
+    cache.set(url, { etag, data });
+  }
+  return { data, changed: true };
+}
+
+function el(tag, className, text) {
+  const node = document.createElement(tag);
+  if (className) node.className = className;
+  if (text !== undefined && text !== null) node.textContent = text;
+  return node;
+}
+
+function renderMachines(machines) {
+  const container = document.getElementById("machines");
+  container.replaceChildren();
+  machines.forEach((m) => {
+    const card = el("div", "card machine" + (m.machineId === selectedMachine ? " selected" : ""));
+    card.appendChild(el("div", null, `Machine ${m.machineId}`)).style.fontWeight = "bold";
+    card.appendChild(el("div", null, m.name || ""));
+    const entries = Object.entries(m.boxes);
+    if (m.reserved) entries.push(["reserved", m.reserved]);
+    const counts = entries.map(([status, n]) => `${status}: ${n}`).join(", ");
+    card.appendChild(el("div", "status", counts || "no boxes"));
+    card.onclick = () => selectMachine(m.machineId);
+    container.appendChild(card);
+  });
+}
+
+function renderBoxes(grid) {
+  document.getElementById("boxes-machine").textContent = `- Machine ${grid.machineId}`;
+  const container = document.getElementById("boxes");
+  container.replaceChildren();
+  grid.boxes.forEach((box) => {
+    const card = el("div", "card");
+    card.appendChild(el("div", null, `Box ${box.number} (${box.size})`));
+    card.appendChild(el("div", `status ${box.status}`, box.status));
+    if (!box.reserved) {
+      const button = card.appendChild(el("button", null, "Reset"));
+      button.type = "button";
+      button.onclick = () => resetBoxes({ machineId: grid.machineId, boxes: [box.number] });
+    } else {
+      card.appendChild(el("p", null, "Reserved"));
+    }
+    container.appendChild(card);
+  });
+}
+
+// Reset groupé en une transaction; les changements reviennent par /api/events
+async function resetBoxes(body) {
+  try {
+    const resp = await fetch("/api/admin/boxes/reset", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify(body),
+    });
+    if (!resp.ok) throw new Error(`reset: ${resp.status}`);
+  } catch (error) {
+    console.error(error);
+  }
+}
+
+function renderOrders() {
+  const tbody = document.getElementById("orders");
+  tbody.replaceChildren();
+  loadedOrders.forEach((o) => {
+    const tr = el("tr");
+    [o.id, o.machineId, o.boxNumber, o.closetId, o.type, o.status, o.trackingCode || "-", o.password || "-", o.createdAt]
+      .forEach((value) => tr.appendChild(el("td", null, value)));
+    tbody.appendChild(tr);
+  });
+}
+
+function ordersUrl(cursor) {
+  const params = new URLSearchParams(orderFilters);
+  if (cursor) params.set("cursor", cursor);
+  return `/api/admin/orders?${params}`;
+}
+
+function setNextCursor(cursor) {
+  const button = document.getElementById("orders-more");
+  button.dataset.cursor = cursor || "";
+  button.classList.toggle("hidden", !cursor);
+}
+
+async function refreshMachines() {
+  const { data, changed } = await fetchJson("/api/admin/machines");
+  if (selectedMachine === null && data.machines.length) {
+    selectedMachine = data.machines[0].machineId;
+  }
+  if (changed) renderMachines(data.machines);
+}
+
+async function refreshBoxes() {
+  if (selectedMachine === null) return;
+  const { data, changed } = await fetchJson(`/api/admin/machines/${selectedMachine}/boxes`);
+  if (changed) renderBoxes(data);
+}
+
+async function refreshOrders() {
+  // Les pages suivantes déjà chargées ne sont pas rafraîchies
+  if (ordersPaged) return;
+  const { data, changed } = await fetchJson(ordersUrl());
+  if (changed) {
+    loadedOrders = data.orders.slice();
+    renderOrders();
+    setNextCursor(data.nextCursor);
+  }
+}
+
+async function loadMoreOrders() {
+  const cursor = document.getElementById("orders-more").dataset.cursor;
+  if (!cursor) return;
+  const { data } = await fetchJson(ordersUrl(cursor));
+  ordersPaged = true;
+  loadedOrders = loadedOrders.concat(data.orders);
+  renderOrders();
+  setNextCursor(data.nextCursor);
+}
+
+async function selectMachine(machineId) {
+  selectedMachine = machineId;
+  cache.delete("/api/admin/machines");
+  await Promise.all([refreshMachines(), refreshBoxes()]);
+}
+
+async function refresh() {
+  try {
+    await refreshMachines();
+    await Promise.all([refreshBoxes(), refreshOrders()]);
+  } catch (error) {
+    console.error(error);
+  }
+}
+
+function applyBoxEvent(event) {
+  const machines = cache.get("/api/admin/machines");
+  const machine = machines && machines.data.machines.find((m) => m.machineId === event.machineId);
+  if (machine) {
+    const counts = machine.boxes;
+    if (counts[event.previousStatus]) counts[event.previousStatus] -= 1;
+    if (!counts[event.previousStatus]) delete counts[event.previousStatus];
+    counts[event.status] = (counts[event.status] || 0) + 1;
+    renderMachines(machines.data.machines);
+  }
+  const grid = cache.get(`/api/admin/machines/${event.machineId}/boxes`);
+  const box = grid && grid.data.boxes.find((b) => b.id === event.boxId);
+  if (box) {
+    box.status = event.status;
+    if (event.machineId === selectedMachine) renderBoxes(grid.data);
+  }
+}
+
+function orderMatchesFilters(order) {
+  return (!orderFilters.machine || String(order.machineId) === orderFilters.machine)
+    && (!orderFilters.status || order.status === orderFilters.status)
+    && (!orderFilters.type || order.type === orderFilters.type);
+}
+
+function applyOrderEvent(event) {
+  const existing = loadedOrders.find((o) => o.id === event.id);
+  if (existing) {
+    Object.assign(existing, event);
+  } else if (event.type && orderMatchesFilters(event)) {
+    loadedOrders.unshift(event);
+  } else {
+    return;
+  }
+  // Le cache HTTP de la première page ne correspond plus: le prochain polling la recharge
+  cache.delete(ordersUrl());
+  renderOrders();
+}
+
+// Flux refusé (worker plein, 503) ou coupé pour de bon: nouvelle connexion,
+// sans doute sur un autre worker, reprise après le dernier événement reçu
+const EVENTS_RETRY_MS = 5000;
+let lastEventId = "";
+
+function listenEvents() {
+  const query = lastEventId ? `?lastEventId=${encodeURIComponent(lastEventId)}` : "";
+  const source = new EventSource(`/api/events${query}`);
+  const track = (handler) => (e) => {
+    if (e.lastEventId) lastEventId = e.lastEventId;
+    handler(e);
+  };
+  source.addEventListener("box", track((e) => applyBoxEvent(JSON.parse(e.data))));
+  source.addEventListener("order", track((e) => applyOrderEvent(JSON.parse(e.data))));
+  source.addEventListener("reset", () => {
+    lastEventId = "";
+    cache.clear();
+    refresh();
+  });
+  source.onerror = () => {
+    if (source.readyState === EventSource.CLOSED) {
+      setTimeout(listenEvents, EVENTS_RETRY_MS * (1 + Math.random()));
+    }
+  };
+}
+
+document.getElementById("order-filters").addEventListener("submit", (e) => {
+  e.preventDefault();
+  orderFilters = {};
+  new FormData(e.target).forEach((value, key) => {
+    if (value) orderFilters[key] = value;
+  });
+  ordersPaged = false;
+  refreshOrders();
+});
+
+document.getElementById("orders-more").addEventListener("click", loadMoreOrders);
+
+// Export de tout l'historique filtré, envoyé en flux par le serveur
+document.getElementById("orders-export").addEventListener("click", () => {
+  const params = new URLSearchParams(orderFilters);
+  params.set("format", "csv");
+  window.location.href = `/api/admin/orders/export?${params}`;
+});
+
+document.getElementById("boxes-reset").addEventListener("click", () => {
+  if (selectedMachine === null) return;
+  if (confirm(`Reset open and stuck boxes of machine ${selectedMachine}?`)) {
+    resetBoxes({ machineId: selectedMachine });
+  }
+});
+
+refresh();
+listenEvents();
+setInterval(refresh, POLL_INTERVAL_MS);
@@ -0,0 +1,316 @@
+import atexit
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+import zlib
+from flask import Blueprint, current_app, jsonify, request
+from database import locate_machine, shard_of_id, write_transaction
+
+
+LOG = logging.getLogger(__name__)
+
+bp = Blueprint("telemetry", __name__)
+
+MAX_BATCH_BYTES = 1 << 20  # Taille max d'un lot, décompressé
+MAX_SAMPLES = 500  # Échantillons par lot
+MAX_METRICS_PER_SAMPLE = 200
+MAX_METRIC_NAMES = 1000  # Noms de métriques distincts en base (au-delà: ignorés)
+METRIC_NAME = re.compile(r"^[A-Za-z0-9_.:-]{1,64}$")
+MAX_PENDING_ROWS = 100_000  # File d'écriture par processus; pleine: 503
+FLUSH_INTERVAL = 1.0  # Secondes entre deux écritures
+FLUSH_CHUNK = 500  # Lignes par transaction: le verrou d'écriture est relâché entre deux
+RETRY_AFTER = 10  # Secondes conseillées au kiosque quand la file est pleine
+READ_MAX_POINTS = 5000
+PRUNE_BATCH_SIZE = 5000
+PRUNE_PAUSE = 0.05
+
+
+class TelemetryWriter:
+    """
+    File d'écriture de la télémétrie des kiosques, propre au processus.
+
+    L'endpoint d'ingestion ne touche pas au verrou d'écriture SQLite: il
+    met les lignes en file et répond 202. Un thread les écrit toutes les
+    `flush_interval` secondes, par transactions de `chunk` lignes
+    (executemany), en une fois pour tous les kiosques: les routes de
+    commande attendent au plus une transaction courte. File pleine: le
+    lot est refusé (503) et le kiosque le garde pour plus tard.
+
+    Les lignes acceptées mais pas encore écrites sont perdues si le
+    processus est tué (écrites à l'arrêt normal).
+    """
+
+    def __init__(
+        self,
+        connect_db,
+        registry=None,
+        max_pending: int = MAX_PENDING_ROWS,
+        flush_interval: float = FLUSH_INTERVAL,
+        chunk: int = FLUSH_CHUNK,
+    ):
+        self._connect_db = connect_db
+        self.registry = registry
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.chunk = chunk
+        self._pending = []  # (locker_id, nom de métrique, ts, valeur)
+        self._metric_ids = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._start_lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                threading.Thread(target=self._run, name="telemetry-writer", daemon=True).start()
+                atexit.register(self._flush_at_exit)
+                self._pid = os.getpid()
+
+    def submit(self, rows) -> bool:
+        """Mettre des lignes en file; False si la file est pleine (rien n'est pris)"""
+        with self._lock:
+            if len(self._pending) + len(rows) > self.max_pending:
+                self._count("smartlock_telemetry_rejected_total", (("reason", "queue_full"),), len(rows))
+                return False
+            self._pending.extend(rows)
+            if len(self._pending) >= self.chunk:
+                self._wakeup.set()
+        return True
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self, db) -> int:
+        """Écrire toute la file; retourne le nombre de lignes écrites"""
+        with self._flush_lock:
+            with self._lock:
+                rows, self._pending = self._pending, []
+            written = 0
+            for start in range(0, len(rows), self.chunk):
+                try:
+                    written += self._write(db, rows[start:start + self.chunk])
+                except Exception:
+                    # Base occupée ou indisponible: remettre en file ce qui reste (si la place le permet)
+                    self._requeue(rows[start:])
+                    raise
+            return written
+
+    def _requeue(self, rows):
+        with self._lock:
+            room = max(0, self.max_pending - len(self._pending))
+            self._pending[:0] = rows[:room]
+            if len(rows) > room:
+                self._count("smartlock_telemetry_rejected_total", (("reason", "write_failed"),), len(rows) - room)
+
+    def _write(self, db, rows) -> int:
+        with write_transaction(db):
+            ids = self._resolve_metrics(db, {name for _, name, _, _ in rows})
+            values = [(locker_id, ids[name], ts, value) for locker_id, name, ts, value in rows if name in ids]
+            # Lot renvoyé après une erreur réseau: mêmes clés, la ligne est remplacée
+            db.executemany(
+                "INSERT OR REPLACE INTO telemetry_samples (locker_id, metric_id, ts, value) VALUES (?, ?, ?, ?)",
+                values,
+            )
+        # Cache mis à jour après le commit: un rollback n'y laisse pas d'ID inexistant
+        self._metric_ids.update(ids)
+        self._count("smartlock_telemetry_rows_total", (), len(values))
+        if len(values) < len(rows):
+            self._count("smartlock_telemetry_rejected_total", (("reason", "too_many_metrics"),), len(rows) - len(values))
+        return len(values)
+
+    def _resolve_metrics(self, db, names) -> dict:
+        """ID de chaque nom de métrique, créé au besoin dans la limite de MAX_METRIC_NAMES"""
+        ids = {name: self._metric_ids[name] for name in names if name in self._metric_ids}
+        missing = sorted(names - ids.keys())
+        if not missing:
+            return ids
+        known = db.execute(
+            "SELECT id, name FROM telemetry_metrics WHERE name IN (SELECT value FROM json_each(?))",
+            (json.dumps(missing),),
+        ).fetchall()
+        ids.update((row["name"], row["id"]) for row in known)
+        missing = [name for name in missing if name not in ids]
+        room = MAX_METRIC_NAMES - db.execute("SELECT COUNT(*) AS n FROM telemetry_metrics").fetchone()["n"]
+        if len(missing) > room:
+            LOG.warning("Telemetry metric limit reached, ignoring %s", missing[max(room, 0):])
+            missing = missing[:max(room, 0)]
+        for name in missing:
+            ids[name] = db.execute("INSERT INTO telemetry_metrics (name) VALUES (?) RETURNING id", (name,)).fetchone()["id"]
+        return ids
+
+    def _count(self, name: str, labels: tuple, value: int):
+        if self.registry is not None and value:
+            self.registry.inc(name, labels, value)
+
+    def _run(self):
+        db = self._connect_db()
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush(db)
+            except Exception as exc:  # pragma: no cover
+                LOG.error("Telemetry write failed: %s", exc)
+                time.sleep(self.flush_interval)
+
+    def _flush_at_exit(self):
+        if self.pending():
+            db = self._connect_db()
+            try:
+                self.flush(db)
+            except Exception as exc:  # pragma: no cover
+                LOG.error("Telemetry write at exit failed: %s", exc)
+            finally:
+                db.close()
+
+
+def get_writer(app, shard: int = 0) -> TelemetryWriter:
+    return app.extensions["smartlock_telemetry"][shard]
+
+
+def parse_batch(body: dict):
+    """
+    {"machineId": 1, "samples": [{"ts": 1700000000, "metrics": {"serial.rtt_p95_ms": 4.2}}]}
+    -> (machine_id, [(nom, ts, valeur)]). Lève ValueError si le lot est invalide.
+    """
+    if not isinstance(body, dict):
+        raise ValueError("Lot JSON attendu")
+    machine_id = body.get("machineId")
+    samples = body.get("samples")
+    if not isinstance(machine_id, int) or isinstance(machine_id, bool):
+        raise ValueError("machineId requis")
+    if not isinstance(samples, list) or not samples:
+        raise ValueError("samples requis")
+    if len(samples) > MAX_SAMPLES:
+        raise ValueError(f"Au plus {MAX_SAMPLES} échantillons par lot")
+    rows = []
+    for sample in samples:
+        ts = sample.get("ts") if isinstance(sample, dict) else None
+        metrics = sample.get("metrics") if isinstance(sample, dict) else None
+        if not isinstance(ts, int) or isinstance(ts, bool) or ts <= 0 or not isinstance(metrics, dict):
+            raise ValueError("Échantillon invalide: {ts, metrics} attendus")
+        if len(metrics) > MAX_METRICS_PER_SAMPLE:
+            raise ValueError(f"Au plus {MAX_METRICS_PER_SAMPLE} métriques par échantillon")
+        for name, value in metrics.items():
+            if not METRIC_NAME.match(name):
+                raise ValueError(f"Nom de métrique invalide: {name[:80]}")
+            if value is None:
+                continue  # Pas de mesure sur l'intervalle (ex. aucun appel)
+            if not isinstance(value, (int, float)) or not math.isfinite(value):
+                raise ValueError(f"Valeur invalide pour {name}")
+            rows.append((name, ts, float(value)))
+    return machine_id, rows
+
+
+def _read_body() -> bytes:
+    """Corps de la requête, décompressé si Content-Encoding: gzip (taille bornée)"""
+    if request.content_length is not None and request.content_length > MAX_BATCH_BYTES:
+        raise OverflowError
+    raw = request.get_data(cache=False)
+    if request.content_encoding == "gzip":
+        decoder = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+        try:
+            raw = decoder.decompress(raw, MAX_BATCH_BYTES)
+        except zlib.error as exc:
+            raise ValueError(f"gzip invalide: {exc}")
+        if decoder.unconsumed_tail:
+            raise OverflowError
+    elif request.content_encoding not in (None, "identity"):
+        raise ValueError(f"Content-Encoding non supporté: {request.content_encoding}")
+    return raw
+
+
+@bp.route("/api/telemetry", methods=["POST"])
+def ingest():
+    """
+    Lot de télémétrie d'un kiosque (JSON, de préférence gzip). Mis en file
+    pour écriture groupée: 202 si accepté, 503 + Retry-After si la file
+    est pleine (le kiosque renvoie le lot plus tard).
+    """
+    try:
+        machine_id, rows = parse_batch(json.loads(_read_body()))
+    except OverflowError:
+        return jsonify({"message": f"Lot trop volumineux (max {MAX_BATCH_BYTES} octets)"}), 413
+    except (ValueError, UnicodeDecodeError) as exc:
+        return jsonify({"message": str(exc)}), 400
+
+    _, locker = locate_machine(current_app, machine_id)
+    if not locker:
+        return jsonify({"message": "Machine non trouvée"}), 404
+
+    writer = get_writer(current_app, shard_of_id(locker["id"]))
+    writer.start()
+    if not writer.submit([(locker["id"], name, ts, value) for name, ts, value in rows]):
+        resp = jsonify({"message": "Télémétrie en surcharge, réessayez plus tard"})
+        resp.headers["Retry-After"] = str(RETRY_AFTER)
+        return resp, 503
+    return jsonify({"accepted": len(rows)}), 202
+
+
+@bp.route("/api/admin/machines/<int:machine_id>/telemetry")
+def machine_telemetry(machine_id):
+    """
+    Séries brutes d'une machine: ?since=<secondes> (défaut 3600), ?metric=<nom>
+    (répétable). {machineId, series: {nom: [[ts, valeur], ...]}}
+    """
+    try:
+        since = int(request.args.get("since", 3600))
+    except ValueError:
+        return jsonify({"message": "Paramètres invalides"}), 400
+    db, locker = locate_machine(current_app, machine_id)
+    if not locker:
+        return jsonify({"message": "Machine non trouvée"}), 404
+
+    metric_filter, params = "", [locker["id"], int(time.time()) - since]
+    names = request.args.getlist("metric")
+    if names:
+        metric_filter = "AND m.name IN (SELECT value FROM json_each(?))"
+        params.append(json.dumps(names))
+    rows = db.execute(
+        f"""
+        SELECT m.name, s.ts, s.value
+        FROM telemetry_samples s
+        JOIN telemetry_metrics m ON m.id = s.metric_id
+        WHERE s.locker_id=? AND s.ts >= ? {metric_filter}
+        ORDER BY s.metric_id, s.ts
+        LIMIT ?
+        """,
+        (*params, READ_MAX_POINTS),
+    ).fetchall()
+    series = {}
+    for row in rows:
+        series.setdefault(row["name"], []).append([row["ts"], row["value"]])
+    return jsonify({"machineId": machine_id, "series": series, "truncated": len(rows) == READ_MAX_POINTS})
+
+
+def prune_telemetry(db, older_than_days: int, batch_size: int = PRUNE_BATCH_SIZE, pause: float = PRUNE_PAUSE):
+    """
+    Supprimer les échantillons de plus de `older_than_days` jours, par lots
+    (transactions courtes, comme archive_orders). Retourne le nombre supprimé.
+    """
+    cutoff = int(time.time()) - int(older_than_days) * 86400
+    total = 0
+    while True:
+        with write_transaction(db):
+            cur = db.execute(
+                """
+                DELETE FROM telemetry_samples
+                WHERE (locker_id, metric_id, ts) IN (
+                    SELECT locker_id, metric_id, ts FROM telemetry_samples WHERE ts < ? LIMIT ?
+                )
+                """,
+                (cutoff, batch_size),
+            )
+        total += cur.rowcount
+        if cur.rowcount < batch_size:
+            return total
+        time.sleep(pause)
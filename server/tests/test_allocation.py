@@ -0,0 +1,154 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from allocator import BoxAllocator
+from app import create_app
+from database import get_db, write_transaction
+
+
+THREADS = 32  # Plus de dépôts simultanés que de boxes libres
+
+
+class ConcurrentDepositTest(unittest.TestCase):
+    """
+    Dépôts simultanés sur une même machine: chaque box libre est attribuée
+    une seule fois, les dépôts en trop reçoivent 409.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self._env = os.environ.get("SMART_LOCK_DB")
+        os.environ["SMART_LOCK_DB"] = os.path.join(self.tmp, "smartlock.db")
+
+    def tearDown(self):
+        if self._env is None:
+            os.environ.pop("SMART_LOCK_DB", None)
+        else:
+            os.environ["SMART_LOCK_DB"] = self._env
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _available(self, app) -> int:
+        with app.app_context():
+            return get_db(app).execute(
+                "SELECT COUNT(*) FROM boxes WHERE status='available' AND reserved=0"
+            ).fetchone()[0]
+
+    def _deposit_all(self, apps):
+        """THREADS dépôts lancés ensemble, répartis entre `apps` (un allocateur par processus)"""
+        barrier = threading.Barrier(THREADS)
+        results = [None] * THREADS
+
+        def deposit(i):
+            client = apps[i % len(apps)].test_client()
+            barrier.wait()
+            resp = client.post("/api/deposit/open", json={"lockerId": 1, "trackingCode": f"T{i}"})
+            results[i] = (resp.status_code, resp.get_json())
+
+        threads = [threading.Thread(target=deposit, args=(i,)) for i in range(THREADS)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def _check(self, app, results, available: int):
+        allocated = [body["boxId"] for status, body in results if status == 200]
+        refused = [status for status, _ in results if status != 200]
+        self.assertEqual(len(allocated), available)
+        self.assertEqual(len(set(allocated)), len(allocated), "box attribuée deux fois")
+        self.assertEqual(set(refused), {409})
+        with app.app_context():
+            db = get_db(app)
+            opened = db.execute("SELECT box_number FROM boxes WHERE status='deposit_open'").fetchall()
+            orders = db.execute(
+                "SELECT box_id, COUNT(*) AS n FROM orders WHERE status='awaiting_close' GROUP BY box_id"
+            ).fetchall()
+        self.assertEqual(sorted(row[0] for row in opened), sorted(allocated))
+        self.assertEqual(len(orders), available)
+        self.assertTrue(all(row["n"] == 1 for row in orders))
+
+    def test_one_process(self):
+        app = create_app()
+        available = self._available(app)
+        self.assertGreater(available, 0)
+        self._check(app, self._deposit_all([app]), available)
+
+    def test_two_processes(self):
+        # Deux applications sur la même base: index en mémoire distincts, comme deux workers
+        apps = [create_app(), create_app()]
+        available = self._available(apps[0])
+        self._check(apps[0], self._deposit_all(apps), available)
+
+
+class CountingAllocator(BoxAllocator):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loads = 0
+
+    def _load(self, db, locker_id, cursor=0):
+        self.loads += 1
+        return super()._load(db, locker_id, cursor)
+
+
+class IndexRefreshTest(unittest.TestCase):
+    """
+    Index de deux workers sur la même base: rechargé quand une box de la
+    machine redevient libre ou change de taille, pas à chaque écriture.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self._env = os.environ.get("SMART_LOCK_DB")
+        os.environ["SMART_LOCK_DB"] = os.path.join(self.tmp, "smartlock.db")
+        self.app = create_app()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.db = get_db(self.app)
+        self.locker = self.db.execute("SELECT id FROM lockers WHERE machine_id=1").fetchone()[0]
+        self.a = CountingAllocator("lowest", reload_interval=0)
+        self.b = CountingAllocator("lowest", reload_interval=0)
+
+    def tearDown(self):
+        self.ctx.pop()
+        if self._env is None:
+            os.environ.pop("SMART_LOCK_DB", None)
+        else:
+            os.environ["SMART_LOCK_DB"] = self._env
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _claim(self, allocator):
+        with write_transaction(self.db):
+            return allocator.claim(self.db, self.locker)["box_number"]
+
+    def _write(self, sql, params=()):
+        with write_transaction(self.db):
+            self.db.execute(sql, params)
+
+    def test_claims_and_other_writes_do_not_reload(self):
+        self.assertEqual((self._claim(self.a), self._claim(self.b)), (1, 2))
+        self.assertEqual(self._claim(self.a), 3)  # Box 2 prise par b: écartée par l'UPDATE conditionnel
+        self._write("UPDATE lockers SET name='Autre' WHERE id=?", (self.locker,))
+        self._write("UPDATE boxes SET status='occupied' WHERE locker_id=? AND box_number=10", (self.locker,))
+        self._claim(self.b)
+        self.assertEqual((self.a.loads, self.b.loads), (1, 1))
+
+    def test_freed_box_is_seen_by_other_worker(self):
+        self._claim(self.a)
+        self.assertEqual(self._claim(self.b), 2)
+        self._write("UPDATE boxes SET status='available' WHERE locker_id=? AND box_number=1", (self.locker,))
+        self.assertEqual(self._claim(self.b), 1)
+        self.assertEqual(self.b.loads, 2)
+
+    def test_size_change_is_seen(self):
+        self._claim(self.a)
+        self._write("UPDATE boxes SET size='S' WHERE locker_id=? AND box_number > 1", (self.locker,))
+        self._write("UPDATE boxes SET size='L' WHERE locker_id=? AND box_number = 9", (self.locker,))
+        with write_transaction(self.db):
+            self.assertEqual(self.a.claim(self.db, self.locker, "L")["box_number"], 9)
+
+
+if __name__ == "__main__":
+    unittest.main()
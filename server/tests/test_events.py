@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from app import create_app
+from events import get_broker
+
+
+class SharedEventsTest(unittest.TestCase):
+    """Deux applications sur la même base, comme deux workers: un événement publié par l'une atteint les abonnés de l'autre"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self._env = os.environ.get("SMART_LOCK_DB")
+        os.environ["SMART_LOCK_DB"] = os.path.join(self.tmp, "smartlock.db")
+        self.writer, self.reader = create_app(), create_app()
+
+    def tearDown(self):
+        if self._env is None:
+            os.environ.pop("SMART_LOCK_DB", None)
+        else:
+            os.environ["SMART_LOCK_DB"] = self._env
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _deposit(self, tracking_code):
+        resp = self.writer.test_client().post("/api/deposit/open", json={"lockerId": 1, "trackingCode": tracking_code})
+        self.assertEqual(resp.status_code, 200)
+        return resp.get_json()
+
+    def test_event_reaches_other_worker(self):
+        broker = get_broker(self.reader)
+        sub, replay = broker.subscribe()
+        self.assertEqual(replay, [])
+        box = self._deposit("T1")["boxId"]
+        events = [sub.get(timeout=2), sub.get(timeout=2)]
+        self.assertEqual([event for _, event, _ in events], ["box", "order"])
+        self.assertIn(f'"boxNumber": {box}', events[0][2])
+        broker.unsubscribe(sub)
+
+    def test_resume_on_other_worker(self):
+        writer = get_broker(self.writer)
+        sub, _ = writer.subscribe()
+        self._deposit("T1")
+        first = sub.get(timeout=2)
+        writer.unsubscribe(sub)
+        self._deposit("T2")
+        # Reconnexion sur l'autre worker avec l'identifiant reçu du premier
+        last_id = writer.format(first).split("\n")[0][len("id: "):]
+        _, replay = get_broker(self.reader).subscribe(last_id)
+        self.assertEqual(len(replay), 3)  # order T1, box + order T2
+        self.assertEqual(replay[0][0], first[0] + 1)
+
+    def test_clients_per_worker_are_capped(self):
+        broker = get_broker(self.reader)
+        subs = [broker.subscribe() for _ in range(broker.max_clients)]
+        self.assertNotIn(None, subs)
+        resp = self.reader.test_client().get("/api/events")
+        self.assertEqual(resp.status_code, 503)
+        self.assertIn("Retry-After", resp.headers)
+        broker.unsubscribe(subs[0][0])
+        broker.unsubscribe(subs[0][0])  # Deuxième appel sans effet
+        self.assertIsNotNone(broker.subscribe())
+        self.assertIsNone(broker.subscribe())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+import csv
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from app import create_app
+from database import get_db, get_pool, write_transaction
+from export import iter_orders
+
+
+class OrderKeysetTest(unittest.TestCase):
+    """
+    Parcours par keyset (created_at, id) de l'historique chaud + archive:
+    chaque commande une fois, dans l'ordre, y compris avec des dates égales
+    de part et d'autre d'une limite de page ou de lot.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self._env = os.environ.get("SMART_LOCK_DB")
+        os.environ["SMART_LOCK_DB"] = os.path.join(self.tmp, "smartlock.db")
+        self.app = create_app()
+        self.client = self.app.test_client()
+        # Dates en double: 3 commandes à 10:00 (2 chaudes, 1 archivée), 2 à 11:00
+        self.dates = {
+            1: "2026-01-05 10:00:00",
+            2: "2026-01-05 10:00:00",
+            3: "2026-01-05 10:00:00",
+            4: "2026-01-05 11:00:00",
+            5: "2026-01-05 11:00:00",
+            6: "2026-01-06 09:00:00",
+            7: "2026-01-07 09:00:00",
+        }
+        archived = {2, 5, 6}
+        with self.app.app_context():
+            db = get_db(self.app)
+            box_id = db.execute("SELECT id FROM boxes WHERE locker_id=1 AND box_number=1").fetchone()[0]
+            with write_transaction(db):
+                for order_id, created_at in self.dates.items():
+                    table = "orders_archive" if order_id in archived else "orders"
+                    db.execute(
+                        f"""
+                        INSERT INTO {table} (id, locker_id, box_id, closet_id, tracking_code, password,
+                                             order_type, status, created_at, updated_at)
+                        VALUES (?, 1, ?, ?, ?, 'secret', 'deposit', ?, ?, ?)
+                        """,
+                        (
+                            order_id,
+                            box_id,
+                            1000 + order_id,
+                            f"T{order_id}",
+                            "withdrawn" if order_id % 2 else "cancelled",
+                            created_at,
+                            created_at,
+                        ),
+                    )
+
+    def tearDown(self):
+        if self._env is None:
+            os.environ.pop("SMART_LOCK_DB", None)
+        else:
+            os.environ["SMART_LOCK_DB"] = self._env
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def test_iter_orders_small_chunks(self):
+        with self.app.app_context():
+            chunks = list(iter_orders(get_pool(self.app), [], [], chunk=2))
+        self.assertEqual([len(rows) for rows in chunks], [2, 2, 2, 1])
+        self.assertEqual([row["id"] for rows in chunks for row in rows], [1, 2, 3, 4, 5, 6, 7])
+
+    def test_iter_orders_exact_multiple_ends(self):
+        with self.app.app_context():
+            chunks = list(iter_orders(get_pool(self.app), ["order_type = ?"], ["deposit"], chunk=7))
+        self.assertEqual([row["id"] for rows in chunks for row in rows], [1, 2, 3, 4, 5, 6, 7])
+
+    def test_orders_pages_follow_cursor(self):
+        ids, url = [], "/api/admin/orders?limit=2"
+        while url:
+            data = self.client.get(url).get_json()
+            ids.extend(order["id"] for order in data["orders"])
+            url = f"/api/admin/orders?limit=2&cursor={data['nextCursor']}" if data["nextCursor"] else None
+        self.assertEqual(ids, [7, 6, 5, 4, 3, 2, 1])
+
+    def test_orders_bad_cursor_is_rejected(self):
+        self.assertEqual(self.client.get("/api/admin/orders?cursor=nope").status_code, 400)
+
+    def test_export_csv_oldest_first_without_passwords(self):
+        resp = self.client.get("/api/admin/orders/export?format=csv")
+        self.assertEqual(resp.status_code, 200)
+        rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+        self.assertEqual([int(row["id"]) for row in rows], [1, 2, 3, 4, 5, 6, 7])
+        self.assertNotIn("password", rows[0])
+
+    def test_export_ndjson_gzip_with_filters(self):
+        resp = self.client.get("/api/admin/orders/export?format=ndjson&gzip=1&status=withdrawn&from=2026-01-05&to=2026-01-06")
+        self.assertEqual(resp.status_code, 200)
+        lines = gzip.decompress(resp.get_data()).decode("utf-8").splitlines()
+        self.assertEqual([json.loads(line)["id"] for line in lines], [1, 3, 5])
+
+    def test_export_unknown_format_is_rejected(self):
+        self.assertEqual(self.client.get("/api/admin/orders/export?format=xml").status_code, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from app import create_app
+from database import get_db, write_transaction
+from leases import reclaim_expired
+
+
+class LeaseRegistrationTest(unittest.TestCase):
+    """
+    Enregistrement des dépôts sur box prêtée: bail en cours, bail repris
+    pendant que le kiosque était hors ligne, enregistrements qui ne
+    correspondent à aucun bail.
+    """
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self._env = os.environ.get("SMART_LOCK_DB")
+        os.environ["SMART_LOCK_DB"] = os.path.join(self.tmp, "smartlock.db")
+        self.app = create_app()
+        self.client = self.app.test_client()
+        resp = self.client.post("/api/leases", json={"lockerId": 1, "count": 2})
+        self.assertEqual(resp.status_code, 200)
+        self.leases = resp.get_json()["boxes"]
+        self.assertEqual(len(self.leases), 2)
+
+    def tearDown(self):
+        if self._env is None:
+            os.environ.pop("SMART_LOCK_DB", None)
+        else:
+            os.environ["SMART_LOCK_DB"] = self._env
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _register(self, lease, tracking_code="T1", **overrides):
+        payload = {
+            "lockerId": 1,
+            "trackingCode": tracking_code,
+            "boxId": lease["boxId"],
+            "closetId": lease["closetId"],
+            "password": lease["password"],
+        }
+        payload.update(overrides)
+        return self.client.post("/api/deposit/open", json=payload)
+
+    def _query(self, sql, params=()):
+        with self.app.app_context():
+            return get_db(self.app).execute(sql, params).fetchall()
+
+    def _box_status(self, box_number) -> str:
+        return self._query("SELECT status FROM boxes WHERE locker_id=1 AND box_number=?", (box_number,))[0][0]
+
+    def _expire_all(self):
+        with self.app.app_context():
+            db = get_db(self.app)
+            with write_transaction(db):
+                db.execute("UPDATE box_leases SET expires_at=datetime('now', '-1 hour')")
+                reclaim_expired(db)
+
+    def test_register_and_replay(self):
+        lease = self.leases[0]
+        first = self._register(lease)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(first.get_json()["password"], lease["password"])
+        self.assertEqual(self._box_status(lease["boxId"]), "deposit_open")
+        replay = self._register(lease)
+        self.assertEqual(replay.status_code, 200)
+        self.assertEqual(replay.get_json()["orderId"], first.get_json()["orderId"])
+
+    def test_unknown_lease_is_refused(self):
+        free = self._query("SELECT box_number FROM boxes WHERE status='available' AND reserved=0 LIMIT 1")[0][0]
+        resp = self._register({"boxId": free, "closetId": 1234, "password": "000000"})
+        self.assertEqual(resp.status_code, 409)
+        self.assertEqual(self._box_status(free), "available")
+        self.assertEqual(self._query("SELECT COUNT(*) FROM orders WHERE status='awaiting_close'")[0][0], 0)
+
+    def test_wrong_password_is_refused(self):
+        lease = self.leases[0]
+        resp = self._register(lease, password="not-the-code")
+        self.assertEqual(resp.status_code, 409)
+        self.assertEqual(self._box_status(lease["boxId"]), "leased")
+
+    def test_missing_codes_are_rejected(self):
+        lease = self.leases[0]
+        payload = {"lockerId": 1, "trackingCode": "T1", "boxId": lease["boxId"], "password": lease["password"]}
+        self.assertEqual(self.client.post("/api/deposit/open", json=payload).status_code, 400)
+        del payload["password"]
+        payload["closetId"] = lease["closetId"]
+        self.assertEqual(self.client.post("/api/deposit/open", json=payload).status_code, 400)
+
+    def test_other_parcel_on_registered_box_is_refused(self):
+        lease = self.leases[0]
+        self.assertEqual(self._register(lease, "T1").status_code, 200)
+        resp = self._register(lease, "T2")
+        self.assertEqual(resp.status_code, 409)
+        self.assertEqual(self._box_status(lease["boxId"]), "deposit_open")
+
+    def test_expired_lease_is_reclaimed_with_kiosk_codes(self):
+        lease = self.leases[0]
+        self._expire_all()
+        self.assertEqual(self._box_status(lease["boxId"]), "available")
+        resp = self._register(lease)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()["password"], lease["password"])
+        self.assertEqual(self._box_status(lease["boxId"]), "deposit_open")
+        rows = self._query("SELECT closet_id, password, status FROM orders WHERE tracking_code='T1'")
+        self.assertEqual([tuple(r) for r in rows], [(lease["closetId"], lease["password"], "awaiting_close")])
+        self.assertEqual(self._query("SELECT COUNT(*) FROM expired_leases WHERE box_number=?", (lease["boxId"],))[0][0], 0)
+        # Rejeu après reprise: même commande
+        self.assertEqual(self._register(lease).get_json()["orderId"], resp.get_json()["orderId"])
+
+    def test_expired_lease_codes_on_another_box_are_refused(self):
+        lease, other = self.leases
+        self._expire_all()
+        resp = self._register(lease, boxId=other["boxId"])
+        self.assertEqual(resp.status_code, 409)
+        self.assertEqual(self._box_status(other["boxId"]), "available")
+
+    def test_expired_lease_on_reused_box_leaves_box_alone(self):
+        lease = self.leases[0]
+        self._expire_all()
+        with self.app.app_context():
+            db = get_db(self.app)
+            with write_transaction(db):
+                db.execute("UPDATE boxes SET status='occupied' WHERE locker_id=1 AND box_number=?", (lease["boxId"],))
+        resp = self._register(lease)
+        self.assertEqual(resp.status_code, 202)
+        self.assertTrue(resp.get_json()["flagged"])
+        self.assertEqual(self._box_status(lease["boxId"]), "occupied")
+        self.assertEqual(self._query("SELECT COUNT(*) FROM orders WHERE tracking_code='T1'")[0][0], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+from app import create_app
+
+
+def responses_total(text: str, endpoint: str) -> float:
+    pattern = rf'^smartlock_http_responses_total\{{endpoint="{endpoint}",method="GET",status="200"\}} (\S+)$'
+    return sum(float(v) for v in re.findall(pattern, text, re.MULTILINE))
+
+
+@unittest.skipUnless(hasattr(os, "fork"), "fork requis")
+class SharedMetricsTest(unittest.TestCase):
+    """Workers forkés après préchargement: /metrics additionne les compteurs de tous les processus"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self._env = {k: os.environ.get(k) for k in ("SMART_LOCK_DB", "SMART_LOCK_METRICS_DIR")}
+        os.environ["SMART_LOCK_DB"] = os.path.join(self.tmp, "smartlock.db")
+        os.environ["SMART_LOCK_METRICS_DIR"] = os.path.join(self.tmp, "metrics")
+        self.app = create_app()  # Préchargée, comme dans le maître gunicorn
+
+    def tearDown(self):
+        for key, value in self._env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _worker(self, requests: int):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                client = self.app.test_client()
+                for _ in range(requests):
+                    client.get("/api/admin/machines")
+                self.app.extensions["smartlock_metrics_shared"].flush()
+                code = 0
+            finally:
+                os._exit(code)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+
+    def test_counters_are_summed_across_workers(self):
+        self._worker(3)
+        self._worker(5)
+        text = self.app.test_client().get("/metrics").get_data(as_text=True)
+        self.assertEqual(responses_total(text, "admin_api.machines"), 8)
+        # Écritures du préchargement (machines de départ): pas recomptées par chaque worker
+        self.assertNotIn('query="insert boxes"', text)
+
+    def test_counters_never_go_back(self):
+        self._worker(4)
+        client = self.app.test_client()
+        first = responses_total(client.get("/metrics").get_data(as_text=True), "admin_api.machines")
+        self._worker(1)
+        second = responses_total(client.get("/metrics").get_data(as_text=True), "admin_api.machines")
+        self.assertEqual((first, second), (4, 5))
+
+
+if __name__ == "__main__":
+    unittest.main()
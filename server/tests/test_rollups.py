@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import rollups
+from app import create_app
+from database import connect, get_db, write_transaction
+from rollups import backfill_rollups
+
+
+class RollupBackfillTest(unittest.TestCase):
+    """Reconstruction des agrégats depuis l'historique, machine par machine"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self._env = os.environ.get("SMART_LOCK_DB")
+        self.path = os.path.join(self.tmp, "smartlock.db")
+        os.environ["SMART_LOCK_DB"] = self.path
+        self.app = create_app()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.db = get_db(self.app)
+        self.reader = connect(self.path)
+
+    def tearDown(self):
+        self.reader.close()
+        self.ctx.pop()
+        if self._env is None:
+            os.environ.pop("SMART_LOCK_DB", None)
+        else:
+            os.environ["SMART_LOCK_DB"] = self._env
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _deposit(self, closed_at, status="closed", updated_at=None):
+        box_id = self.db.execute("SELECT id FROM boxes WHERE locker_id=1 AND box_number=1").fetchone()[0]
+        with write_transaction(self.db):
+            self.db.execute(
+                """
+                INSERT INTO orders (locker_id, box_id, closet_id, order_type, status, created_at, updated_at, closed_at)
+                VALUES (1, ?, 1, 'deposit', ?, ?, ?, ?)
+                """,
+                (box_id, status, closed_at, updated_at or closed_at, closed_at),
+            )
+
+    def _rows(self, period):
+        return {
+            row["bucket"]: (row["deposits"], row["withdrawals"], row["cancelled"], row["dwell_seconds"])
+            for row in self.db.execute(
+                "SELECT * FROM order_rollups WHERE locker_id=1 AND period=? ORDER BY bucket", (period,)
+            )
+        }
+
+    def _version(self):
+        return self.db.execute("SELECT version FROM change_counter WHERE id=1").fetchone()[0]
+
+    def test_backfill_builds_hours_and_days(self):
+        self._deposit("2026-01-05 10:15:00", "withdrawn", "2026-01-05 12:15:00")
+        self._deposit("2026-01-05 11:00:00", "cancelled", "2026-01-06 09:30:00")
+        self._deposit("2026-01-06 09:10:00")
+        before = self._version()
+        self.assertEqual(backfill_rollups(self.db, self.reader, pause=0), 1)
+        self.assertGreater(self._version(), before)
+        self.assertEqual(
+            self._rows("hour"),
+            {
+                "2026-01-05 10:00:00": (1, 0, 0, 0),
+                "2026-01-05 11:00:00": (1, 0, 0, 0),
+                "2026-01-05 12:00:00": (0, 1, 0, 7200),
+                "2026-01-06 09:00:00": (1, 0, 1, 0),
+            },
+        )
+        self.assertEqual(
+            self._rows("day"),
+            {"2026-01-05": (2, 1, 0, 7200), "2026-01-06": (1, 0, 1, 0)},
+        )
+        # Deuxième passage: mêmes lignes
+        backfill_rollups(self.db, self.reader, pause=0)
+        self.assertEqual(len(self._rows("hour")), 4)
+
+    def test_hour_in_progress_is_left_to_live_updates(self):
+        self._deposit("2026-01-05 10:15:00")
+        with write_transaction(self.db):
+            rollups.record(self.db, 1, deposits=3)
+        hour = self.db.execute(rollups._CURRENT_HOUR_SQL).fetchone()[0]
+        backfill_rollups(self.db, self.reader, pause=0)
+        hours = self._rows("hour")
+        self.assertEqual(hours["2026-01-05 10:00:00"], (1, 0, 0, 0))
+        self.assertEqual(hours[hour], (3, 0, 0, 0))
+        self.assertEqual(self._rows("day")[hour[:10]][0], 3)
+
+    def test_machine_is_read_again_when_the_hour_changes(self):
+        self._deposit("2026-01-05 10:15:00")
+        real = rollups._read_locker
+        calls = []
+
+        def read_locker(reader, locker_id):
+            until, events = real(reader, locker_id)
+            calls.append(until)
+            # Première lecture: faite pendant l'heure précédente
+            return ("2026-01-05 10:00:00" if len(calls) == 1 else until), events
+
+        with mock.patch.object(rollups, "_read_locker", read_locker):
+            self.assertEqual(backfill_rollups(self.db, self.reader, pause=0), 1)
+        self.assertEqual(len(calls), 2)
+        self.assertIn("2026-01-05 10:00:00", self._rows("hour"))
+
+
+if __name__ == "__main__":
+    unittest.main()
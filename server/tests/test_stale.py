@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from app import create_app
+from database import get_db, write_transaction
+from stale import STUCK, find_stale, reap_stale
+
+
+class StaleReaperTest(unittest.TestCase):
+    """Ouvertures jamais confirmées: dépôts signalés une fois, retraits remis en état porte fermée"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self._env = {k: os.environ.get(k) for k in ("SMART_LOCK_DB", "SMART_LOCK_STALE_AFTER")}
+        os.environ["SMART_LOCK_DB"] = os.path.join(self.tmp, "smartlock.db")
+        os.environ["SMART_LOCK_STALE_AFTER"] = "0"  # Pas de thread de fond: le test appelle reap_stale
+        self.app = create_app()
+        self.client = self.app.test_client()
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.db = get_db(self.app)
+
+    def tearDown(self):
+        self.ctx.pop()
+        for key, value in self._env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def _write(self, sql, params=()):
+        with write_transaction(self.db):
+            self.db.execute(sql, params)
+
+    def _age_orders(self):
+        self._write("UPDATE orders SET updated_at=datetime('now', '-1 hour')")
+
+    def _doors(self, closed_mask: int):
+        self._write("INSERT OR IGNORE INTO telemetry_metrics (name) VALUES ('doors.closed_mask')")
+        self._write(
+            """
+            INSERT OR REPLACE INTO telemetry_samples (locker_id, metric_id, ts, value)
+            SELECT 1, id, ?, ? FROM telemetry_metrics WHERE name='doors.closed_mask'
+            """,
+            (int(time.time()), closed_mask),
+        )
+
+    def _box_status(self, box_number) -> str:
+        return self.db.execute(
+            "SELECT status FROM boxes WHERE locker_id=1 AND box_number=?", (box_number,)
+        ).fetchone()[0]
+
+    def _reap(self):
+        return reap_stale(self.db, stale_after=60, pause=0)[1]
+
+    def test_stuck_deposit_is_not_selected_again(self):
+        box = self.client.post("/api/deposit/open", json={"lockerId": 1, "trackingCode": "T1"}).get_json()["boxId"]
+        self._age_orders()
+        self._doors(0xFFFF)  # Porte fermée: le dépôt n'est pas libéré pour autant
+        self.assertEqual(self._reap(), {"reverted": 0, "flagged": 1})
+        self.assertEqual(self._box_status(box), STUCK)
+        self.assertEqual(find_stale(self.db, 60), [])
+        self.assertEqual(self._reap(), {"reverted": 0, "flagged": 0})
+        status = self.db.execute("SELECT status FROM orders WHERE tracking_code='T1'").fetchone()[0]
+        self.assertEqual(status, "awaiting_close")
+
+    def test_stuck_withdrawal_is_reverted_once_door_closes(self):
+        deposit = self.client.post("/api/deposit/open", json={"lockerId": 1, "trackingCode": "T1"}).get_json()
+        box = deposit["boxId"]
+        self._write("UPDATE orders SET status='withdraw_in_progress' WHERE tracking_code='T1'")
+        self._write("UPDATE boxes SET status='withdraw_open' WHERE locker_id=1 AND box_number=?", (box,))
+        self._age_orders()
+        self._doors(0)  # Porte ouverte
+        self.assertEqual(self._reap(), {"reverted": 0, "flagged": 1})
+        self.assertEqual(self._box_status(box), STUCK)
+        self.assertEqual(len(find_stale(self.db, 60)), 1)  # Retrait: réévalué
+        self._doors(1 << (box - 1))
+        self.assertEqual(self._reap(), {"reverted": 1, "flagged": 0})
+        self.assertEqual(self._box_status(box), "occupied")
+
+
+if __name__ == "__main__":
+    unittest.main()
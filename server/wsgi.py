@@ -0,0 +1,7 @@
+"""
+Point d'entrée de production:
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+from app import create_app
+
+app = create_app()